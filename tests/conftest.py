@@ -0,0 +1,2 @@
+# the commands log with `logging.done`, a level that's added when the CLI is imported
+import vdsearch.rich_wrapper  # noqa: F401
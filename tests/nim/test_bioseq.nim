@@ -0,0 +1,71 @@
+import std/[math, random, sequtils, strutils, tables, unittest]
+import bioseq
+
+proc randomSequence(rng: var Rand, n: int, alphabet = "ACGT"): string =
+  for _ in 0..<n:
+    result.add(alphabet[rng.rand(alphabet.high)])
+
+proc naiveCode(kmer: string): uint64 =
+  for c in kmer:
+    result = (result shl 2) or "ACGT".find(c.toUpperAscii).uint64
+
+proc naiveKmerCodes(x: string, k: int, canonical = false): seq[uint64] =
+  ## Slice out every window and encode the ones with only ACGT in them.
+  let x = x.replace('U', 'T').replace('u', 't')
+  for i in 0..x.len - k:
+    let kmer = x[i..<i + k]
+    if not kmer.allIt(it in "ACGTacgt"):
+      continue
+    var code = naiveCode(kmer)
+    if canonical:
+      code = min(code, naiveCode(kmer.toUpperAscii.Dna.reverseComplement.string))
+    result.add(code)
+
+proc naiveCmpRotations(x: string, xOffset: int, y: string, yOffset: int): int =
+  sgn(cmp(x[xOffset..^1] & x[0..<xOffset], y[yOffset..^1] & y[0..<yOffset]))
+
+suite "packed sequences":
+  var rng = initRand(7)
+
+  test "packing round trips, escapes included":
+    for n in [0, 1, 31, 32, 33, 64, 100]:
+      for alphabet in ["ACGT", "ACGTN", "ACGTRYN"]:
+        let x = rng.randomSequence(n, alphabet)
+        check x.Dna.pack.unpack.string == x
+
+  test "rotations compare like their strings":
+    for n in [1, 5, 31, 32, 33, 63, 64, 65, 100]:
+      for alphabet in ["AC", "ACGT", "ACGTN"]:
+        for _ in 0..<20:
+          let x = rng.randomSequence(n, alphabet)
+          # a rotation of x so that long shared prefixes come up
+          let shift = rng.rand(n - 1)
+          let y = if rng.rand(1) == 0: x[shift..^1] & x[0..<shift] else: rng.randomSequence(n, alphabet)
+          let (i, j) = (rng.rand(n - 1), rng.rand(n - 1))
+          check cmpRotations(x.Dna.pack, i, y.Dna.pack, j) == naiveCmpRotations(x, i, y, j)
+
+suite "integer k-mers":
+  var rng = initRand(11)
+
+  test "k-mers match slicing out each window":
+    for k in [1, 3, 8, 31, 32]:
+      for alphabet in ["ACGT", "ACGTN", "ACGTacgtRY"]:
+        let x = rng.randomSequence(200, alphabet)
+        check toSeq(x.Dna.kmerCodes(k)) == naiveKmerCodes(x, k)
+        check toSeq(x.Dna.pack.kmerCodes(k)) == naiveKmerCodes(x, k)
+
+  test "RNA k-mers match their DNA counterparts":
+    let x = rng.randomSequence(100, "ACGUN")
+    check toSeq(x.Rna.kmerCodes(5)) == naiveKmerCodes(x, 5)
+
+  test "canonical k-mers are the smaller strand":
+    for k in [1, 4, 17, 32]:
+      let x = rng.randomSequence(200, "ACGTN")
+      check toSeq(x.Dna.canonicalKmerCodes(k)) == naiveKmerCodes(x, k, canonical = true)
+      check toSeq(x.Dna.pack.canonicalKmerCodes(k)) == naiveKmerCodes(x, k, canonical = true)
+
+  test "counting and decoding":
+    let counts = "ACGTACGNACG".Dna.countKmerCodes(3)
+    check counts[naiveCode("ACG")] == 3
+    check counts[naiveCode("CGT")] == 1
+    check naiveCode("GTAC").decodeKmer(4).string == "GTAC"
@@ -0,0 +1,33 @@
+import std/[random, unittest]
+import bioseq
+import canonicalize
+
+proc bruteForceCanonical(x: string): string =
+  ## Build every rotation of both strands and take the smallest.
+  result = x
+  for strand in [x, x.Dna.reverseComplement.string]:
+    for i in 0..<strand.len:
+      result = min(result, strand[i..^1] & strand[0..<i])
+
+suite "minimal canonical rotations":
+  var rng = initRand(2)
+
+  test "match building every rotation":
+    for n in [1, 2, 3, 10, 31, 32, 33, 64, 65, 200]:
+      # small alphabets make for long runs and repeated rotations, which is where the linear-time search can go wrong
+      for alphabet in ["A", "AC", "ACGT", "ACGTN"]:
+        for _ in 0..<50:
+          var x = ""
+          for _ in 0..<n:
+            x.add(alphabet[rng.rand(alphabet.high)])
+          check x.Dna.minimalCanonicalRotation.string == bruteForceCanonical(x)
+
+  test "repeats of a unit":
+    for unit in ["ACG", "AAC", "GATTACA"]:
+      var x = ""
+      for _ in 0..<7:
+        x.add(unit)
+      check x.Dna.minimalCanonicalRotation.string == bruteForceCanonical(x)
+
+  test "the empty sequence":
+    check Dna"".minimalCanonicalRotation.string == ""
@@ -0,0 +1,37 @@
+import std/[os, unittest, strutils]
+import catalog
+
+proc committedKeys(dir: string): int =
+  for kind, path in walkDir(dir):
+    if path.endsWith(".seg"):
+      result.inc((getFileSize(path).int - "VDSCAT01".len) div sizeof(uint64))
+
+suite "catalog":
+  let dir = getTempDir() / "vdsearch-test-catalog"
+  setup:
+    removeDir(dir)
+  teardown:
+    removeDir(dir)
+
+  test "a key repeated in one run is novel once and committed once":
+    var c = openCatalog(dir)
+    let key = catalogKey("ACGU")
+    check c.addIfNovel(key)
+    check not c.addIfNovel(key)
+    check c.addIfNovel(catalogKey("GGCC"))
+    c.commit()
+    c.close()
+    check committedKeys(dir) == 2
+
+  test "committed keys are known to later runs":
+    var first = openCatalog(dir)
+    discard first.addIfNovel(catalogKey("ACGU"))
+    first.commit()
+    first.close()
+    var second = openCatalog(dir)
+    check catalogKey("ACGU") in second
+    check not second.addIfNovel(catalogKey("ACGU"))
+    check second.addIfNovel(catalogKey("GGCC"))
+    second.commit()
+    second.close()
+    check committedKeys(dir) == 2
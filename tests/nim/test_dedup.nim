@@ -0,0 +1,48 @@
+import std/[os, random, sets, strutils, unittest]
+import dedup
+
+proc bruteForceDedup(records: seq[(string, string)]): seq[(string, string)] =
+  ## Keep the first record with each sequence, ignoring case.
+  var seen: HashSet[string]
+  for (id, sequence) in records:
+    if not seen.containsOrIncl(sequence.toUpperAscii):
+      result.add((id, sequence))
+
+proc readRecords(path: string): seq[(string, string)] =
+  for line in lines(path):
+    if line.startsWith(">"):
+      result.add((line[1..^1], ""))
+    else:
+      result[^1][1].add(line)
+
+suite "dedup":
+  let dir = getTempDir() / "vdsearch-test-dedup"
+  setup:
+    removeDir(dir)
+    createDir(dir)
+  teardown:
+    removeDir(dir)
+
+  test "spilling to disk keeps the same records in the same order":
+    var rng = initRand(12)
+    var pool: seq[string]
+    for _ in 0..<300:
+      var sequence = ""
+      for _ in 0..<rng.rand(1..60):
+        sequence.add("ACGTacgt"[rng.rand(7)])
+      pool.add(sequence)
+    var records: seq[(string, string)]
+    var fasta = ""
+    for i in 0..<3000:
+      records.add(("seq" & $i, pool[rng.rand(pool.high)]))
+      fasta.add(">" & records[^1][0] & "\n" & records[^1][1] & "\n")
+    writeFile(dir / "in.fasta", fasta)
+    let expected = bruteForceDedup(records)
+
+    for maxMemory in [1 shl 30, 64 * 100, 1]:
+      let outfile = dir / ("out" & $maxMemory & ".fasta")
+      let (total, duplicates, spilled, _) = dedup(dir / "in.fasta", outfile, maxMemory, scratchDir = dir)
+      check total == records.len
+      check duplicates == records.len - expected.len
+      check spilled == (maxMemory < 1 shl 30)
+      check readRecords(outfile) == expected
@@ -0,0 +1,108 @@
+import std/[os, random, strutils, unittest]
+import bioseq
+import find_circs
+
+proc cirit(x: string, seedLen: int, minIdentity: float): string =
+  ## Peel one copy off the end of `x` by searching the whole of what's left for the seed, or return "" if there
+  ## isn't one.
+  if x.len < seedLen:
+    return ""
+  let seed = x[^seedLen..^1]
+  let idx = x.find(seed, last = x.len - seedLen)
+  if idx == -1:
+    return ""
+  let maxMismatches = (idx.float * (1.0 - minIdentity)).int
+  var mismatches = 0
+  for i in 0..idx:
+    if x[i] != x[x.high - idx + i - seedLen + 1]:
+      inc mismatches
+    if mismatches > maxMismatches:
+      return ""
+  return x[0..x.high - idx - seedLen]
+
+proc naivePeriod(x: string, seedLen: int, minIdentity: float): tuple[unitLen, copies: int] =
+  ## Peel off copies with `cirit` until there are none left, copying the rest of the sequence every time.
+  var unit = x
+  var copies = 1
+  while true:
+    let shorter = unit.cirit(seedLen, minIdentity)
+    if shorter == "":
+      break
+    unit = shorter
+    inc copies
+  if copies == 1:
+    return (0, 0)
+  return (unit.len, copies)
+
+proc mutate(rng: var Rand, x: string, rate: float): string =
+  result = x
+  for c in result.mitems:
+    if rng.rand(1.0) < rate:
+      c = "ACGT"[rng.rand(3)]
+
+suite "monomer period":
+  var rng = initRand(3)
+
+  test "matches peeling copies off one search at a time":
+    for _ in 0..<2000:
+      var unit = ""
+      for _ in 0..<rng.rand(5..120):
+        unit.add("ACGT"[rng.rand(3)])
+      var x = ""
+      for _ in 0..<rng.rand(1..4):
+        x.add(rng.mutate(unit, 0.02))
+      x.add(unit[0..<rng.rand(0..unit.high)])
+      for seedLen in [4, 10]:
+        for minIdentity in [0.9, 0.95, 1.0]:
+          check x.Dna.monomerPeriod(seedLen, minIdentity) == naivePeriod(x, seedLen, minIdentity)
+
+  test "an exact tandem repeat":
+    check "GATTACACCGGTTAAGATTACACCGGTTAAGATTA".Dna.monomerPeriod(seedLen = 5) == (15, 3)
+
+  test "sequences that aren't repeats":
+    check "ACGTACGTAC".Dna.monomerPeriod == (0, 0) # no room for anything before the seed
+    check "ACGTTGCAACGGATCCA".Dna.monomerPeriod(seedLen = 4) == (0, 0)
+
+suite "find_circs":
+  let dir = getTempDir() / "vdsearch-test-find-circs"
+  setup:
+    removeDir(dir)
+    createDir(dir)
+  teardown:
+    removeDir(dir)
+
+  test "counts the circRNAs it writes, not the ones it finds":
+    var rng = initRand(11)
+    var units: seq[string]
+    for _ in 0..<30:
+      var unit = ""
+      for _ in 0..<rng.rand(60..120):
+        unit.add("ACGT"[rng.rand(3)])
+      units.add(unit)
+    # every unit is read around twice, starting at several different places, so most records are duplicates
+    var fasta = ""
+    for i in 0..<500:
+      let unit = units[rng.rand(units.high)]
+      let start = rng.rand(unit.high)
+      let rotated = unit[start..^1] & unit[0..<start]
+      fasta.add(">read" & $i & "\n" & rotated & rotated & "\n")
+    writeFile(dir / "reads.fasta", fasta)
+
+    proc written(path: string): int =
+      for line in lines(path):
+        if line.startsWith(">"):
+          inc result
+
+    for threads in [1, 3]:
+      for dedup in [false, true]:
+        let catalogDir = dir / ("catalog" & $threads & $dedup)
+        let outfile = dir / "circs.fasta"
+        let first = find_circs(dir / "reads.fasta", outfile, outTsv = false, threads = threads, minLen = 50,
+                               dedup = dedup, catalogDir = catalogDir)
+        check first[0] == written(outfile)
+        check first[0] == (if dedup: units.len else: 500)
+        # everything is in the catalog now, so nothing is written
+        let second = find_circs(dir / "reads.fasta", outfile, outTsv = false, threads = threads, minLen = 50,
+                                dedup = dedup, catalogDir = catalogDir, novelOnly = true)
+        check second[0] == 0
+        check written(outfile) == 0
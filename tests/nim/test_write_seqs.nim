@@ -0,0 +1,48 @@
+import std/[os, unittest]
+import write_seqs
+
+suite "write_clusters":
+  let dir = getTempDir() / "vdsearch-test-write-seqs"
+  setup:
+    removeDir(dir)
+    createDir(dir / "clusters")
+  teardown:
+    removeDir(dir)
+
+  test "clusters without records get an empty file even with few open files":
+    writeFile(dir / "in.fasta", ">a\nACGU\n>b\nGGCC\n>c\nUUAA\n")
+    # x and y have no records in the FASTA, so they're only created when the pool is closed
+    writeFile(dir / "clusters.tsv", "a\ta\nx\tx\na\tb\ny\ty\nc\tc\n")
+    check write_clusters(dir / "in.fasta", dir / "clusters.tsv", dir / "clusters", maxOpenFiles = 1) == 4
+    check readFile(dir / "clusters" / "a.fasta") == ">a\nACGU\n>b\nGGCC\n"
+    check readFile(dir / "clusters" / "c.fasta") == ">c\nUUAA\n"
+    check readFile(dir / "clusters" / "x.fasta") == ""
+    check readFile(dir / "clusters" / "y.fasta") == ""
+
+suite "junction_windows":
+  let dir = getTempDir() / "vdsearch-test-junction-windows"
+  setup:
+    removeDir(dir)
+    createDir(dir)
+  teardown:
+    removeDir(dir)
+
+  test "windows have the junction once even for sequences shorter than them":
+    writeFile(dir / "in.fasta", ">long x\nACGUACGUAC\n>short\nAGCU\n>single\nA\n>empty\n\n")
+    check junction_windows(dir / "in.fasta", dir / "windows.fasta", 3, "/junction") == (4, 15)
+    check readFile(dir / "windows.fasta") == (
+      ">long/junction length=10 tail=3\nUACACG\n" &
+      ">short/junction length=4 tail=3\nGCUAGC\n"
+    )
+
+suite "record_ids":
+  let dir = getTempDir() / "vdsearch-test-record-ids"
+  setup:
+    removeDir(dir)
+    createDir(dir)
+  teardown:
+    removeDir(dir)
+
+  test "IDs are the first word of each header":
+    writeFile(dir / "in.fasta", ">a first\nACGU\n>b\nGG\nCC\n>c\n\n")
+    check record_ids(dir / "in.fasta") == @["a", "b", "c"]
@@ -0,0 +1,54 @@
+import json
+import random
+from pathlib import Path
+
+import vdsearch.hit_cache
+from vdsearch.hit_cache import ENTRY_OVERHEAD, HitCache
+
+
+class Clock:
+    """A stand-in for the `time` module whose time only moves forward when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+
+def test_eviction_keeps_the_most_recently_used_entries(tmp_path: Path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vdsearch.hit_cache, "time", clock)
+    rng = random.Random(21)
+
+    last_used = {}
+    sizes = {}
+    with HitCache(tmp_path, "fingerprint") as cache:
+        for i in range(200):
+            clock.now += 1
+            rows = [f"NV_{i} hit {j}\n" for j in range(rng.randint(0, 5))]
+            cache.store({f"NV_{i}": rows}, 1.0)
+            last_used[f"NV_{i}"] = clock.now
+            sizes[f"NV_{i}"] = len(json.dumps(rows)) + ENTRY_OVERHEAD
+        for _ in range(20):
+            clock.now += 1
+            used = rng.sample(sorted(last_used), 10)
+            cache.lookup(used)
+            last_used.update(dict.fromkeys(used, clock.now))
+
+        max_size = sum(sizes.values()) // 3
+        # keep the most recently used entries for as long as they fit, the one stored last first if there's a tie
+        kept = set()
+        total = 0
+        stored = list(last_used)
+        for digest in sorted(
+            last_used, key=lambda d: (last_used[d], stored.index(d)), reverse=True
+        ):
+            total += sizes[digest]
+            if total > max_size:
+                break
+            kept.add(digest)
+
+        assert cache.evict(max_size) == len(last_used) - len(kept)
+        assert set(cache.lookup(last_used)) == kept
+        assert cache.evict(max_size) == 0
@@ -0,0 +1,457 @@
+import random
+import sys
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from vdsearch.commands.infernal import (
+    JUNCTION_SUFFIX,
+    infernal,
+    map_junction_hits,
+    merge_tblouts,
+    on_shard_done,
+    parse_options,
+    rescale_row,
+    rewrite_option_settings,
+)
+
+HEADER = """\
+#target name         accession query name           accession mdl mdl from   mdl to seq from   seq to strand trunc pass   gc  bias  score   E-value inc description of target
+#------------------- --------- -------------------- --------- --- -------- -------- -------- -------- ------ ----- ---- ---- ----- ------ --------- --- ---------------------
+"""
+
+
+# stands in for cmsearch: each GAAA starts a hit whose score depends on the bases after it, and like in cmsearch, the
+# filters get stricter in larger search spaces
+FAKE_CMSEARCH = f"""\
+#!{sys.executable}
+import bisect, sys, zlib
+
+args = sys.argv[1:]
+if args == ["-h"]:
+    print("# cmsearch :: search CM(s) against a sequence database\\n# INFERNAL 1.1.4 (fake)")
+    sys.exit()
+*tokens, cm_file, fasta = args
+options = dict(zip(tokens[::2], tokens[1::2]))
+with open(fasta) as f:
+    seqs = [(r.split()[0], "".join(r.splitlines()[1:])) for r in f.read().split(">")[1:]]
+database_size = float(options.get("-Z", sum(len(seq) for _, seq in seqs) * 2 / 1e6))
+tier = bisect.bisect_right((2, 20, 200, 2000, 20000), float(options.get("--FZ", database_size)))
+hits = []
+for name, seq in seqs:
+    start = seq.find("GAAA")
+    while start != -1:
+        score = zlib.crc32(seq[start : start + 12].encode()) % 40
+        evalue = database_size * 2.0**-score
+        if score >= 5 * tier and evalue <= float(options.get("-E", 10)):
+            hits.append((evalue, -score, name, start + 1, start + 12))
+        start = seq.find("GAAA", start + 1)
+hits.sort(key=lambda hit: hit[:2])
+with open(options["--tblout"], "w") as out:
+    out.write({HEADER!r})
+    for evalue, score, name, start, end in hits:
+        inc = "!" if evalue <= 0.01 else "?"
+        out.write(
+            f"{{name:<20}} -         Hammerhead_3         RF00008    cm        1       12 {{start:>8}} {{end:>8}}      +    no "
+            f"   1 0.45   0.0 {{-score:>6.1f}} {{evalue:>9.2g}} {{inc:>3}} -\\n"
+        )
+    out.write(f"#\\n# Target file:     {{fasta}}\\n# Option settings: cmsearch {{' '.join(args)}}\\n# [ok]\\n")
+with open(options["-o"], "w") as out:
+    out.write(f"{{len(hits)}} alignments\\n")
+"""
+
+
+def footer(fasta: Path) -> str:
+    return f"#\n# Program:         cmsearch\n# Target file:     {fasta}\n# [ok]\n"
+
+
+def tblout_row(
+    target: str,
+    model: str,
+    seq_from: int,
+    seq_to: int,
+    score: float,
+    evalue: float,
+    description: str = "-",
+) -> str:
+    strand = "+" if seq_from <= seq_to else "-"
+    inc = "!" if evalue <= 0.01 else "?"
+    return (
+        f"{target:<20} {'-':<9} {model:<20} {'RF00000':<9} {'cm':>3} {1:>8} {50:>8} "
+        f"{seq_from:>8} {seq_to:>8} {strand:>6} {'no':>5} {1:>4} {0.45:>4.2f} {0.0:>5.1f} "
+        f"{score:>6.1f} {evalue:>9.2g} {inc:>3} {description}\n"
+    )
+
+
+def write_tblout(path: Path, rows: List[str], fasta: Path):
+    path.write_text(HEADER + "".join(rows) + footer(fasta))
+
+
+def test_merged_shards_match_a_single_search(tmp_path: Path):
+    rng = random.Random(18)
+    models = ["Hammerhead_3", "Hammerhead_1", "HDV_ribozyme", "twister-P1"]
+    # a single cmsearch lists the hits of each model in the order of the CM file, then by E-value
+    rows = []
+    for model in models[:-1]:  # the last model has no hits
+        evalue = 1e-30
+        for _ in range(rng.randint(0, 40)):
+            evalue *= rng.uniform(1.5, 10)
+            rows.append(
+                tblout_row(
+                    f"seq{rng.randint(0, 999)}",
+                    model,
+                    rng.randint(1, 400),
+                    rng.randint(1, 400),
+                    round(200 / (1 + len(rows)), 1),
+                    evalue,
+                )
+            )
+    fasta = tmp_path / "in.fasta"
+    write_tblout(tmp_path / "single.tblout", rows, fasta)
+
+    # each shard is a single search of its own sequences, so its hits are in the same order
+    shard_fastas = [tmp_path / f"shard{i}.fasta" for i in range(3)]
+    shard_rows: List[List[str]] = [[] for _ in shard_fastas]
+    for row in rows:
+        shard_rows[rng.randrange(len(shard_fastas))].append(row)
+    shard_tblouts = [tmp_path / f"shard{i}.tblout" for i in range(3)]
+    for tblout, shard_fasta, hits in zip(shard_tblouts, shard_fastas, shard_rows):
+        write_tblout(tblout, hits, shard_fasta)
+
+    merge_tblouts(
+        shard_tblouts, tmp_path / "merged.tblout", shard_fastas, fasta, models=models
+    )
+    assert (tmp_path / "merged.tblout").read_text() == (
+        tmp_path / "single.tblout"
+    ).read_text()
+
+
+def test_merging_without_models_concatenates_the_shards(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    shard_fastas = [tmp_path / "shard0.fasta", tmp_path / "shard1.fasta"]
+    rows = [
+        tblout_row("seq1", "Hammerhead_3", 1, 40, 30.0, 1e-5),
+        tblout_row("seq2", "HDV_ribozyme", 1, 40, 50.0, 1e-9),
+        tblout_row("seq3", "Hammerhead_3", 40, 1, 20.0, 1e-3),
+    ]
+    write_tblout(tmp_path / "shard0.tblout", rows[:2], shard_fastas[0])
+    write_tblout(tmp_path / "shard1.tblout", rows[2:], shard_fastas[1])
+
+    merge_tblouts(
+        [tmp_path / "shard0.tblout", tmp_path / "shard1.tblout"],
+        tmp_path / "merged.tblout",
+        shard_fastas,
+        fasta,
+    )
+    assert (tmp_path / "merged.tblout").read_text() == HEADER + "".join(rows) + footer(
+        fasta
+    )
+
+
+def test_merging_shards_without_hits(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    shard_fastas = [tmp_path / "shard0.fasta", tmp_path / "shard1.fasta"]
+    for i, shard_fasta in enumerate(shard_fastas):
+        write_tblout(tmp_path / f"shard{i}.tblout", [], shard_fasta)
+
+    merge_tblouts(
+        [tmp_path / "shard0.tblout", tmp_path / "shard1.tblout"],
+        tmp_path / "merged.tblout",
+        shard_fastas,
+        fasta,
+        models=["Hammerhead_3"],
+    )
+    assert (tmp_path / "merged.tblout").read_text() == HEADER + footer(fasta)
+
+
+def test_merged_option_settings_name_the_merged_files(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    shard_fastas = [tmp_path / "shard0.fasta", tmp_path / "shard1.fasta"]
+    for i, shard_fasta in enumerate(shard_fastas):
+        (tmp_path / f"shard{i}.tblout").write_text(
+            HEADER
+            + "#\n# Program:         cmsearch\n"
+            + f"# Target file:     {shard_fasta}\n"
+            + f"# Option settings: cmsearch --tblout {tmp_path}/shard{i}.tblout -o {tmp_path}/shard{i}.out "
+            + f"-Z 0.002000 --cpu 2 models.cm {shard_fasta}\n"
+            + "# [ok]\n"
+        )
+
+    merge_tblouts(
+        [tmp_path / "shard0.tblout", tmp_path / "shard1.tblout"],
+        tmp_path / "merged.tblout",
+        shard_fastas,
+        fasta,
+        models=["Hammerhead_3"],
+        settings={"-o": str(tmp_path / "merged.out"), "--cpu": "4"},
+    )
+    assert (tmp_path / "merged.tblout").read_text() == (
+        HEADER
+        + "#\n# Program:         cmsearch\n"
+        + f"# Target file:     {fasta}\n"
+        + f"# Option settings: cmsearch --tblout {tmp_path}/merged.tblout -o {tmp_path}/merged.out "
+        + f"-Z 0.002000 --cpu 4 models.cm {fasta}\n"
+        + "# [ok]\n"
+    )
+
+
+def test_option_settings_can_be_added_and_removed():
+    line = "# Option settings: cmsearch --tblout a.tblout --hmmonly -E 10 -o a.out models.cm in.fasta\n"
+    assert (
+        rewrite_option_settings(
+            line, {"--hmmonly": None, "-E": None, "--cut_ga": "", "-o": "b.out"}
+        )
+        == "# Option settings: cmsearch --tblout a.tblout -o b.out --cut_ga models.cm in.fasta\n"
+    )
+    # other comments are left alone
+    assert rewrite_option_settings("# [ok]\n", {"-o": "b.out"}) == "# [ok]\n"
+
+
+def test_junction_hits_map_back_to_their_sequences(tmp_path: Path):
+    rng = random.Random(20)
+    rows = []
+    expected = []
+    for i in range(500):
+        length = rng.randint(2, 300)
+        tail = min(rng.choice([10, 50, 150]), length - 1)
+        # the window is the last `tail` bases of the sequence and then the first `tail`, as written by
+        # `junction_windows`, so each of its positions comes from this position of the sequence
+        origins = list(range(length - tail, length)) + list(range(tail))
+        start, end = rng.randint(1, 2 * tail), rng.randint(1, 2 * tail)
+        if start == end:
+            continue
+        rows.append(
+            tblout_row(
+                f"seq{i}{JUNCTION_SUFFIX}",
+                "Hammerhead_3",
+                start,
+                end,
+                30.0,
+                1e-5,
+                f"length={length} tail={tail}",
+            )
+        )
+        # only the hits that run from the last base of the sequence straight into the first one are kept, as long as
+        # they don't cover any of it twice
+        covered = origins[min(start, end) - 1 : max(start, end)]
+        if len(covered) <= length and any(
+            a == length - 1 and b == 0 for a, b in zip(covered, covered[1:])
+        ):
+            fields = rows[-1].split()
+            fields[0] = f"seq{i}"
+            fields[7] = str(origins[start - 1] + 1)
+            fields[8] = str(origins[end - 1] + 1)
+            fields[17:] = ["-"]
+            expected.append(fields)
+    write_tblout(tmp_path / "windows.tblout", rows, tmp_path / "windows.fasta")
+
+    kept = map_junction_hits(tmp_path / "windows.tblout", tmp_path / "mapped.tblout")
+    mapped = (tmp_path / "mapped.tblout").read_text().splitlines(keepends=True)
+    hits = [line for line in mapped if not line.startswith("#")]
+    assert kept == len(expected) > 0
+    assert [line.split() for line in hits] == expected
+    # the columns stay aligned
+    assert all(len(line) == len(hits[0]) for line in hits)
+
+
+def test_junction_hits_of_short_sequences_cover_them_once(tmp_path: Path):
+    # a 4 nt sequence ACGU with a 10 nt window has the window CGUACG (tail=3)
+    rows = [
+        # GUAC: U then A spans the junction
+        tblout_row(
+            f"seq{JUNCTION_SUFFIX}", "Hammerhead_3", 2, 5, 30.0, 1e-5, "length=4 tail=3"
+        ),
+        # CGUAC would cover C twice
+        tblout_row(
+            f"seq{JUNCTION_SUFFIX}", "Hammerhead_3", 1, 5, 30.0, 1e-5, "length=4 tail=3"
+        ),
+        # GUACG on the minus strand would cover G twice
+        tblout_row(
+            f"seq{JUNCTION_SUFFIX}", "Hammerhead_3", 6, 2, 30.0, 1e-5, "length=4 tail=3"
+        ),
+    ]
+    write_tblout(tmp_path / "windows.tblout", rows, tmp_path / "windows.fasta")
+
+    assert (
+        map_junction_hits(tmp_path / "windows.tblout", tmp_path / "mapped.tblout") == 1
+    )
+    hits = [
+        line.split()
+        for line in (tmp_path / "mapped.tblout").read_text().splitlines()
+        if not line.startswith("#")
+    ]
+    assert [(fields[0], fields[7], fields[8]) for fields in hits] == [("seq", "3", "2")]
+
+
+def test_rescaled_rows_match_editing_the_fields():
+    rng = random.Random(21)
+    for _ in range(1000):
+        row = tblout_row(
+            f"seq{rng.randint(0, 99)}",
+            "Hammerhead_3",
+            1,
+            40,
+            30.0,
+            10 ** rng.uniform(-30, 1),
+            "some description",
+        )
+        # the search space of the cached row and the current one are usually close
+        scale = rng.choice([1, rng.uniform(0.5, 2), rng.uniform(1, 100)])
+        max_evalue = rng.choice([None, 10.0, 0.01])
+        seq_id = f"NV_{rng.getrandbits(64):016x}"[: rng.randint(4, 19)]
+        rescaled = rescale_row(row, seq_id, scale, max_evalue)
+
+        fields = row.split(maxsplit=17)
+        evalue = float(fields[15]) * scale
+        if max_evalue is not None and evalue > max_evalue:
+            assert rescaled is None
+            continue
+        fields[0] = seq_id
+        if scale != 1:
+            fields[15] = f"{evalue:.2g}"
+        if max_evalue is not None:
+            fields[16] = "!" if evalue <= 0.01 else "?"
+        assert rescaled is not None
+        assert rescaled.split(maxsplit=17) == fields
+        # the E-value and the new name fit in their columns, so the row is as wide as before
+        assert len(rescaled) == len(row)
+
+
+def test_triage_settings_are_replaced_by_the_full_search(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    (tmp_path / "triage.tblout").write_text(
+        HEADER
+        + f"# Option settings: cmsearch --cpu 2 --tblout {tmp_path}/triage.tblout --hmmonly -E 10.0 "
+        + f"-o {tmp_path}/triage.out -Z 2.000000 models.cm {fasta}\n"
+        + "# [ok]\n"
+    )
+    merge_tblouts(
+        [tmp_path / "triage.tblout"],
+        tmp_path / "out.tblout",
+        [fasta],
+        fasta,
+        settings={
+            "-o": str(tmp_path / "out.out"),
+            "--hmmonly": None,
+            "-E": None,
+            **parse_options("--cut_ga -E 0.5 ".split()),
+        },
+    )
+    assert (tmp_path / "out.tblout").read_text() == (
+        HEADER
+        + f"# Option settings: cmsearch --cpu 2 --tblout {tmp_path}/out.tblout -E 0.5 -o {tmp_path}/out.out "
+        + f"-Z 2.000000 --cut_ga models.cm {fasta}\n"
+        + "# [ok]\n"
+    )
+
+
+@pytest.fixture
+def cm_file(tmp_path: Path, monkeypatch) -> Path:
+    """A CM file for `FAKE_CMSEARCH`, which is put on the PATH as cmsearch."""
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "cmsearch").write_text(FAKE_CMSEARCH)
+    (tmp_path / "bin" / "cmsearch").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{Path(sys.executable).parent}")
+    cm_file = tmp_path / "models.cm"
+    cm_file.write_text(
+        "INFERNAL1/a [1.1.4]\nNAME  Hammerhead_3\nCLEN  50\nW     80\n//\n"
+    )
+    return cm_file
+
+
+def random_seqs(rng: random.Random, count: int) -> List[str]:
+    return [
+        f">seq{i}\n{''.join(rng.choices('ACGU', k=rng.randint(100, 500)))}\n"
+        for i in range(count)
+    ]
+
+
+def test_cached_searches_match_uncached_ones(tmp_path: Path, cm_file: Path):
+    seqs = random_seqs(random.Random(21), 50)
+    small = tmp_path / "small.fasta"
+    small.write_text("".join(seqs))
+    # over 2 Mb to search, so in the next filter tier
+    large = tmp_path / "large.fasta"
+    large.write_text("".join(seqs) + f">filler\n{'C' * 1_000_000}\n")
+
+    def tblout(fasta: Path, cache: bool) -> List[str]:
+        infernal(
+            fasta=fasta,
+            reference_cms=cm_file,
+            output=tmp_path / "out.out",
+            output_tsv=tmp_path / "out.tblout",
+            threads=1,
+            cache=tmp_path / "cache" if cache else None,
+        )
+        # the search space is only given with -Z when it's needed
+        return [
+            line
+            for line in (tmp_path / "out.tblout").read_text().splitlines()
+            if not line.startswith("# Option settings:")
+        ]
+
+    uncached = tblout(small, cache=False)
+    assert len(uncached) > 20
+    # once with every sequence searched and once with every sequence taken from the cache
+    assert tblout(small, cache=True) == uncached
+    assert tblout(small, cache=True) == uncached
+    assert (
+        (tmp_path / "out.out")
+        .read_text()
+        .endswith("# 50 sequences served from the cache, alignments omitted\n")
+    )
+    # hits cached in a smaller search space were found with more lenient filters
+    assert tblout(large, cache=True) == tblout(large, cache=False)
+
+
+def test_cached_searches_stream_every_sequence_once(tmp_path: Path, cm_file: Path):
+    seqs = random_seqs(random.Random(24), 60)
+    (tmp_path / "cached.fasta").write_text("".join(seqs[::2]))
+    (tmp_path / "all.fasta").write_text("".join(seqs))
+    infernal(
+        fasta=tmp_path / "cached.fasta",
+        reference_cms=cm_file,
+        output=tmp_path / "out.out",
+        output_tsv=tmp_path / "out.tblout",
+        threads=1,
+        cache=tmp_path / "cache",
+    )
+
+    calls = []
+
+    def add_shard(fasta: Path, tblout: Path):
+        ids = [
+            line[1:].split()[0]
+            for line in fasta.read_text().splitlines()
+            if line.startswith(">")
+        ]
+        rows = [
+            line.split()
+            for line in tblout.read_text().splitlines()
+            if not line.startswith("#")
+        ]
+        calls.append((ids, rows))
+
+    with on_shard_done(add_shard):
+        infernal(
+            fasta=tmp_path / "all.fasta",
+            reference_cms=cm_file,
+            output=tmp_path / "out.out",
+            output_tsv=tmp_path / "out.tblout",
+            threads=1,
+            cache=tmp_path / "cache",
+        )
+
+    # first the sequences taken from the cache, then the ones that were searched
+    assert [sorted(ids) for ids, _ in calls] == [
+        sorted(f"seq{i}" for i in range(0, 60, 2)),
+        sorted(f"seq{i}" for i in range(1, 60, 2)),
+    ]
+    streamed = sorted(row for _, rows in calls for row in rows)
+    assert streamed == sorted(
+        line.split()
+        for line in (tmp_path / "out.tblout").read_text().splitlines()
+        if not line.startswith("#")
+    )
+    assert streamed
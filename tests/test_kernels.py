@@ -0,0 +1,141 @@
+import hashlib
+import random
+from pathlib import Path
+
+import pytest
+
+from vdsearch import kernels
+from vdsearch.nim import canonicalize as rotcanon
+from vdsearch.nim import find_circs as fc
+
+COMPLEMENT = str.maketrans("ACGTU", "TGCAA")
+
+
+def random_circs(n=200, seed=0):
+    """Random records and their units, about half of them circRNAs that were read around more than once."""
+    rng = random.Random(seed)
+    circs = []
+    for i in range(n):
+        unit = "".join(rng.choices("ACGU", k=rng.randint(20, 80)))
+        if i % 2:
+            sequence = unit * 2 + unit[: rng.randint(0, len(unit))]
+        else:
+            sequence = unit
+        circs.append((f"seq{i} sample={i % 7} circular={i % 2}", sequence, unit))
+    return circs
+
+
+def random_records(n=200, seed=0):
+    return [(header, sequence) for header, sequence, _ in random_circs(n, seed)]
+
+
+def to_fasta(records):
+    return "".join(f">{header}\n{sequence}\n" for header, sequence in records)
+
+
+def read_fasta(path: Path):
+    return [
+        (header, "".join(lines))
+        for header, *lines in (
+            record.splitlines() for record in path.read_text().split(">")[1:]
+        )
+    ]
+
+
+def read_tsv(path: Path):
+    header, *rows = (line.split("\t") for line in path.read_text().splitlines())
+    return [dict(zip(header, row)) for row in rows]
+
+
+def canonical_rotation(sequence: str) -> str:
+    """The least rotation of a sequence or of its reverse complement, by trying all of them."""
+    reverse_complement = sequence.translate(COMPLEMENT)[::-1]
+    return min(
+        strand[i:] + strand[:i]
+        for strand in (sequence, reverse_complement)
+        for i in range(len(strand))
+    )
+
+
+def vdsearch_id(sequence: str) -> str:
+    """The `NV_` ID that `summarize` gives a sequence."""
+    return "NV_" + hashlib.blake2b(sequence.encode(), digest_size=8).hexdigest()
+
+
+def test_find_circs_buffer_matches_batch():
+    records = random_records()
+    from_buffer = kernels.find_circs(to_fasta(records))
+    # a FASTA buffer's IDs are the whole headers, so the same records give the same columns
+    from_batches = kernels.find_circs(records, batch_size=17)
+    assert from_buffer == from_batches
+    assert from_buffer["seq_id"]
+    assert all(" sample=" in seq_id for seq_id in from_buffer["seq_id"])
+
+
+def test_canonicalize_buffer_matches_batch():
+    records = random_records()
+    from_buffer = kernels.canonicalize(to_fasta(records), min_len=30, max_len=150)
+    from_batches = kernels.canonicalize(records, min_len=30, max_len=150, batch_size=17)
+    assert from_buffer == from_batches
+
+
+def test_find_circs_finds_the_units():
+    circs = random_circs()
+    found = kernels.find_circs([(header, sequence) for header, sequence, _ in circs])
+    repeated = [circ for circ in circs if circ[1] != circ[2]]
+    assert found["seq_id"] == [header for header, _, _ in repeated]
+    assert found["monomer"] == [canonical_rotation(unit) for _, _, unit in repeated]
+    assert found["original_length"] == [len(sequence) for _, sequence, _ in repeated]
+    assert found["unit_length"] == [len(unit) for _, _, unit in repeated]
+    assert found["ratio"] == pytest.approx(
+        [len(sequence) / len(unit) for _, sequence, unit in repeated]
+    )
+
+
+def test_canonicalize_finds_the_least_rotations():
+    assert kernels.canonicalize([("x", "CAGT")])["sequence"] == ["ACTG"]
+    records = random_records()
+    found = kernels.canonicalize(records, min_len=30, max_len=150)
+    kept = [(header, seq) for header, seq in records if 30 <= len(seq) <= 150]
+    assert found["seq_id"] == [header for header, _ in kept]
+    assert found["sequence"] == [canonical_rotation(seq) for _, seq in kept]
+
+
+def test_find_circs_matches_the_file_kernel(tmp_path: Path):
+    records = random_records()
+    (tmp_path / "in.fasta").write_text(to_fasta(records))
+    fc.find_circs(str(tmp_path / "in.fasta"), str(tmp_path / "circs.fasta"))
+    found = kernels.find_circs(records)
+
+    written = read_fasta(tmp_path / "circs.fasta")
+    assert [header for header, _ in written] == found["seq_id"]
+    assert [monomer for _, monomer in written] == found["monomer"]
+    rows = read_tsv(tmp_path / "circs.tsv")
+    assert [row["seq_id"] for row in rows] == found["seq_id"]
+    assert [float(row["ratio"]) for row in rows] == pytest.approx(found["ratio"])
+    assert [int(row["original_length"]) for row in rows] == found["original_length"]
+    assert [int(row["unit_length"]) for row in rows] == found["unit_length"]
+    assert [row["vdsearch_id"] for row in rows] == [
+        vdsearch_id(monomer) for monomer in found["monomer"]
+    ]
+
+
+def test_canonicalize_matches_the_file_kernel(tmp_path: Path):
+    records = random_records()
+    (tmp_path / "in.fasta").write_text(to_fasta(records))
+    rotcanon.canonicalize(
+        str(tmp_path / "in.fasta"), str(tmp_path / "canonical.fasta"), 30, 150
+    )
+    found = kernels.canonicalize(records, min_len=30, max_len=150)
+
+    assert read_fasta(tmp_path / "canonical.fasta") == list(
+        zip(found["seq_id"], found["sequence"])
+    )
+    rows = read_tsv(tmp_path / "canonical.tsv")
+    assert [row["seq_id"] for row in rows] == found["seq_id"]
+    assert [int(row["unit_length"]) for row in rows] == [
+        len(sequence) for sequence in found["sequence"]
+    ]
+    assert [row["vdsearch_id"] for row in rows] == [
+        vdsearch_id(sequence) for sequence in found["sequence"]
+    ]
@@ -0,0 +1,290 @@
+import random
+from pathlib import Path
+from typing import Dict, Optional
+
+import pandas as pd
+import pytest
+
+from vdsearch.commands.ribozyme_filter import (
+    RibozymeStream,
+    parse_cm_file,
+    ribozyme_filter,
+)
+
+TBLOUT_HEADER = "#target name  accession  query name  ...\n"
+
+
+def test_stream_uses_rnamotif_hits_without_infernal_hits(tmp_path: Path):
+    fasta = tmp_path / "shard.fasta"
+    fasta.write_text(">a\nACGU\n>b\nGGCC\n>c\nUUAA\n")
+    tblout = tmp_path / "shard.tblout"
+    tblout.write_text(TBLOUT_HEADER)
+    rnamotif_txt = tmp_path / "rnamotif.tsv"
+    # a has a hammerhead on both strands and b on one, but Infernal found nothing
+    # (RNAmotif hits alone are never significant, so only a is viroid-like)
+    rnamotif_txt.write_text(
+        "a -10.0 0 1 40 Hammerhead_3\na -9.0 1 5 40 Hammerhead_3\nb -8.0 0 1 40 Hammerhead_1\n"
+    )
+
+    stream = RibozymeStream(
+        fasta,
+        tmp_path / "viroid_like.fasta",
+        tmp_path / "viroid_like.tsv",
+        rnamotif_txt=rnamotif_txt,
+        use_cm_cutoff=False,
+    )
+    stream.add_shard(fasta, tblout)
+    results = stream.finish()
+
+    assert results is not None
+    assert set(results["double_rzs"].seq_id) == {"a"}
+    assert results["single_rzs"].empty
+    hits = pd.read_csv(tmp_path / "viroid_like.tsv", sep="\t")
+    assert set(hits.seq_id) == {"a"}
+    assert (tmp_path / "viroid_like.fasta").read_text() == ">a\nACGU\n"
+
+
+def test_both_paths_use_rnamotif_hits_without_infernal_hits(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    fasta.write_text(">a\nACGU\n>b\nGGCC\n>c\nUUAA\n>d\nCCGG\n")
+    tblout = tmp_path / "in.tblout"
+    tblout.write_text(TBLOUT_HEADER)
+    rnamotif_txt = tmp_path / "rnamotif.tsv"
+    rnamotif_txt.write_text(
+        "a -10.0 0 1 40 Hammerhead_3\na -9.0 1 5 40 Hammerhead_3\nb -8.0 0 1 40 Hammerhead_1\n"
+        "d -7.0 1 1 40 Hammerhead_1\nd -7.0 0 9 40 Hammerhead_3\n"
+    )
+
+    filtered = ribozyme_filter(
+        tblout,
+        rnamotif_txt=rnamotif_txt,
+        output_tsv=tmp_path / "filtered.tsv",
+        use_cm_cutoff=False,
+    )
+    stream = RibozymeStream(
+        fasta,
+        tmp_path / "streamed.fasta",
+        tmp_path / "streamed.tsv",
+        rnamotif_txt=rnamotif_txt,
+        use_cm_cutoff=False,
+    )
+    stream.add_shard(fasta, tblout)
+    streamed = stream.finish()
+
+    assert filtered is not None and streamed is not None
+    for key in ("single_rzs", "double_rzs", "ribozy_likes"):
+        assert set(filtered[key].seq_id) == set(streamed[key].seq_id)
+    assert set(filtered["double_rzs"].seq_id) == {"a", "d"}
+    assert set(pd.read_csv(tmp_path / "filtered.tsv", sep="\t").seq_id) == {"a", "d"}
+
+
+def test_stream_writes_the_records_in_input_order(tmp_path: Path):
+    fasta = tmp_path / "in.fasta"
+    fasta.write_text(">a\nACGU\n>b\nGGCC\n>c\nUUAA\n>d\nCCGG\n")
+    rnamotif_txt = tmp_path / "rnamotif.tsv"
+    rnamotif_txt.write_text(
+        "".join(
+            f"{seq_id} -10.0 {strand} 1 40 Hammerhead_3\n"
+            for seq_id in "abd"
+            for strand in (0, 1)
+        )
+    )
+    stream = RibozymeStream(
+        fasta,
+        tmp_path / "viroid_like.fasta",
+        rnamotif_txt=rnamotif_txt,
+        use_cm_cutoff=False,
+    )
+    # the second shard is done first
+    for shard, records in [
+        ("1", ">c\nUUAA\n>d\nCCGG\n"),
+        ("0", ">a\nACGU\n>b\nGGCC\n"),
+    ]:
+        (tmp_path / f"shard{shard}.fasta").write_text(records)
+        (tmp_path / f"shard{shard}.tblout").write_text(TBLOUT_HEADER)
+        stream.add_shard(
+            tmp_path / f"shard{shard}.fasta", tmp_path / f"shard{shard}.tblout"
+        )
+    assert (
+        tmp_path / "viroid_like.fasta"
+    ).read_text() == ">d\nCCGG\n>a\nACGU\n>b\nGGCC\n"
+
+    stream.finish()
+    assert (
+        tmp_path / "viroid_like.fasta"
+    ).read_text() == ">a\nACGU\n>b\nGGCC\n>d\nCCGG\n"
+
+
+def baseline_ribozyme_filter(
+    infernal_tblout: Path,
+    rnamotif_txt: Optional[Path],
+    rnamotif_name: str,
+    cutoffs: Dict[str, Dict[str, float]],
+    cm_cutoff_type: str,
+    use_evalue_cutoff: bool,
+    max_evalue: float,
+):
+    """The original classification, which queries the hits family by family and adds the RNAmotif hits one by one."""
+    ribozymes = pd.read_csv(
+        infernal_tblout,
+        delim_whitespace=True,
+        comment="#",
+        usecols=[0, 1, 2, 7, 8, 9, 14, 15, 16],
+        header=None,
+        names=[
+            "seq_id",
+            "accession",
+            "ribozyme",
+            "from",
+            "to",
+            "strand",
+            "score",
+            "evalue",
+            "inc",
+        ],
+    )
+    rz_plus = set()
+    rz_minus = set()
+    rz_significant = set()
+    strict = max_evalue ** (0.5 if max_evalue < 1 else 2)
+    for rz_name, rz_df in ribozymes.groupby("ribozyme"):
+        if cutoffs:
+            cutoff = cutoffs[rz_name][cm_cutoff_type]
+            rz_plus.update(rz_df.query(f"strand == '+' & score > {cutoff}").seq_id)
+            rz_minus.update(rz_df.query(f"strand == '-' & score > {cutoff}").seq_id)
+            rz_significant.update(rz_df.query(f"score > {cutoff}").seq_id)
+        if use_evalue_cutoff:
+            rz_plus.update(rz_df.query(f"strand == '+' & evalue < {strict}").seq_id)
+            rz_minus.update(rz_df.query(f"strand == '-' & evalue < {strict}").seq_id)
+            rz_significant.update(rz_df.query(f"evalue < {max_evalue}").seq_id)
+
+    if rnamotif_txt:
+        rnamotifs = pd.read_csv(
+            rnamotif_txt,
+            delim_whitespace=True,
+            comment="#",
+            header=None,
+            names=["seq_id", "score", "strand", "from_", "length"],
+            usecols=[0, 1, 2, 3, 4],
+        )
+        rz_plus.update(rnamotifs.query("strand == 0").seq_id)
+        rz_minus.update(rnamotifs.query("strand == 1").seq_id)
+        for rnamotif in rnamotifs.itertuples(index=False):
+            row = {
+                "seq_id": rnamotif.seq_id,
+                "ribozyme": rnamotif_name,
+                "strand": "+" if rnamotif.strand == 0 else "-",
+                "evalue": max_evalue**0.5,
+                "from": rnamotif.from_,
+                "to": rnamotif.from_
+                + (rnamotif.length if rnamotif.strand == 0 else -rnamotif.length),
+            }
+            ribozymes = pd.concat([ribozymes, pd.DataFrame([row])], ignore_index=True)
+
+    double_rz_ids = rz_plus.intersection(rz_minus)
+    single_rz_ids = rz_significant.difference(double_rz_ids)
+    ribozymes.loc[ribozymes.seq_id.isin(double_rz_ids), "symmetric"] = True
+    ribozymes.loc[ribozymes.seq_id.isin(single_rz_ids), "symmetric"] = False
+    return {
+        "single_rzs": ribozymes.loc[ribozymes.seq_id.isin(single_rz_ids)],
+        "double_rzs": ribozymes.loc[ribozymes.seq_id.isin(double_rz_ids)],
+        "ribozy_likes": ribozymes.loc[
+            ribozymes.seq_id.isin(single_rz_ids | double_rz_ids)
+        ],
+    }
+
+
+@pytest.fixture(scope="module")
+def random_search(tmp_path_factory):
+    """A CM file, a tabular output with random hits of its models, and random RNAmotif hits."""
+    rng = random.Random(22)
+    tmp_path = tmp_path_factory.mktemp("random_search")
+    families = ["Hammerhead_3", "twister-P5", "HDV_ribozyme", "Pistol"]
+    cm_file = tmp_path / "ribozymes.cm"
+    cm_file.write_text(
+        "".join(
+            f"INFERNAL1/a [1.1.4]\nNAME     {family}\nGA       {rng.uniform(20, 40):.1f}\n"
+            "TC       30.0\nNC       25.0\n//\n"
+            for family in families
+        )
+    )
+    tblout = tmp_path / "infernal.tblout"
+    tblout.write_text(
+        "#header\n"
+        + "".join(
+            f"seq{rng.randint(0, 800)} - {rng.choice(families)} RF00000 cm 1 50 "
+            f"{rng.randint(1, 300)} {rng.randint(1, 300)} {rng.choice('+-')} no 1 0.4 0.0 "
+            f"{rng.uniform(0, 60):.1f} {10 ** rng.uniform(-12, 1):.2g} {rng.choice('!?')} -\n"
+            for _ in range(3000)
+        )
+        + "# end\n"
+    )
+    rnamotif_txt = tmp_path / "rnamotif.tsv"
+    rnamotif_txt.write_text(
+        "".join(
+            f"seq{rng.randint(0, 1200)} {rng.uniform(-20, 0):.2f} {rng.randint(0, 1)} "
+            f"{rng.randint(1, 300)} {rng.randint(40, 60)}\n"
+            for _ in range(300)
+        )
+    )
+    return cm_file, tblout, rnamotif_txt
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"use_cm_cutoff": False},
+        {"use_evalue_cutoff": False},
+        {"max_evalue": 2.0},
+        {"cm_cutoff_type": "TC"},
+    ],
+)
+@pytest.mark.parametrize("with_rnamotif", [False, True])
+def test_matches_the_baseline_classification(
+    random_search, tmp_path: Path, options, with_rnamotif
+):
+    cm_file, tblout, rnamotif_txt = random_search
+    options = {
+        "use_cm_cutoff": True,
+        "cm_cutoff_type": "GA",
+        "use_evalue_cutoff": True,
+        "max_evalue": 0.01,
+        **options,
+    }
+    results = ribozyme_filter(
+        tblout,
+        rnamotif_txt=rnamotif_txt if with_rnamotif else None,
+        rnamotif_name="Hammerhead_3",
+        output_tsv=tmp_path / "viroid_like.tsv",
+        cm_file=cm_file,
+        **options,
+    )
+    expected = baseline_ribozyme_filter(
+        tblout,
+        rnamotif_txt if with_rnamotif else None,
+        "Hammerhead_3",
+        parse_cm_file(cm_file) if options["use_cm_cutoff"] else {},
+        options["cm_cutoff_type"],
+        options["use_evalue_cutoff"],
+        options["max_evalue"],
+    )
+
+    assert results is not None
+    for key, frame in expected.items():
+        pd.testing.assert_frame_equal(
+            results[key].astype(object).reset_index(drop=True),
+            frame.astype(object).reset_index(drop=True),
+            check_dtype=False,
+        )
+    # hits with the same E-value can be in any order
+    written = pd.read_csv(tmp_path / "viroid_like.tsv", sep="\t")
+    assert written.evalue.is_monotonic_increasing
+    expected["ribozy_likes"].to_csv(tmp_path / "expected.tsv", sep="\t", index=False)
+    columns = list(written.columns)
+    pd.testing.assert_frame_equal(
+        written.sort_values(columns).reset_index(drop=True),
+        pd.read_csv(tmp_path / "expected.tsv", sep="\t")
+        .sort_values(columns)
+        .reset_index(drop=True),
+    )
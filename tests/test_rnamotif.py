@@ -0,0 +1,38 @@
+import io
+from pathlib import Path
+
+from vdsearch.commands.rnamotif import bundled_descriptors, tag_hits, tagged_with
+
+RMFMT_OUTPUT = """\
+# nses=3 descr=Hammerhead_3
+seq1   -12.30 0     4    52 aaa gcuga ccuu
+seq2    -9.10 1    10    48 ccg uuca aggc
+"""
+
+
+def test_tagged_hits_are_recognized(tmp_path: Path):
+    rmfmt_output = tmp_path / "rmfmt.txt"
+    rmfmt_output.write_text(RMFMT_OUTPUT)
+    tagged = io.StringIO()
+    tag_hits(rmfmt_output, "Hammerhead_3", tagged)
+    assert tagged.getvalue().splitlines()[1:] == [
+        "seq1 -12.30 0 4 52 Hammerhead_3 aaa gcuga ccuu",
+        "seq2 -9.10 1 10 48 Hammerhead_3 ccg uuca aggc",
+    ]
+
+    rnamotif_output = tmp_path / "rnamotif.tsv"
+    rnamotif_output.write_text(tagged.getvalue())
+    assert tagged_with(rnamotif_output, bundled_descriptors())
+
+
+def test_untagged_hits_are_detected(tmp_path: Path):
+    # written by an older version, so the sixth field is part of the structure
+    rnamotif_output = tmp_path / "rnamotif.tsv"
+    rnamotif_output.write_text(RMFMT_OUTPUT)
+    assert not tagged_with(rnamotif_output, bundled_descriptors())
+
+
+def test_output_without_hits_counts_as_tagged(tmp_path: Path):
+    rnamotif_output = tmp_path / "rnamotif.tsv"
+    rnamotif_output.write_text("# nses=3 descr=Hammerhead_3\n")
+    assert tagged_with(rnamotif_output, bundled_descriptors())
@@ -0,0 +1,142 @@
+"""
+Metadata about the models in a CM file, cached in a small sidecar file next to it.
+
+The merged ribozyme CM file is several MB of text but the stages that use it mostly need a few numbers for each model:
+its GA, TC, and NC bit score cutoffs, its consensus length (`CLEN`), and the longest hit it can have (`W`). These are
+parsed once (by `download-cms`, or the first time they're needed) and written to `<cm file>.meta.json` along with the
+size, modification time, and SHA-256 of the CM file. The sidecar is rebuilt whenever the CM file changes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict
+
+SIDECAR_VERSION = 1
+Metadata = Dict[str, Dict[str, Any]]  # from model name to its metadata
+
+
+def sidecar_path(cm_file: Path) -> Path:
+    return Path(f"{cm_file}.meta.json")
+
+
+def parse_models(cm_file: Path) -> Metadata:
+    """
+    Parse the metadata of each model in a CM file, in the order they're in the file:
+
+    ```
+    {
+        'Twister-P5': {
+            'accession': 'RF02684',
+            'description': 'Type-P5 twister ribozyme',
+            'clen': 59,
+            'window': 77,
+            'GA': 45.0,
+            'TC': 45.3,
+            'NC': 32.3,
+        },
+    }
+    ```
+
+    Cutoffs that a model doesn't have are 0.
+    """
+    models: Metadata = {}
+    model: Dict[str, Any] = {}
+    name = ""
+    with open(cm_file) as f:
+        for line in f:
+            if "INFERNAL" in line:
+                # each CM starts with its format version and is followed by its filter HMM
+                if name:
+                    models[name] = model
+                name = ""
+                model = {"GA": 0.0, "TC": 0.0, "NC": 0.0}
+                continue
+            fields = line.split(maxsplit=1)
+            if len(fields) < 2:
+                continue
+            tag, value = fields[0], fields[1].strip()
+            if tag == "NAME":
+                name = value
+            elif tag == "ACC":
+                model["accession"] = value
+            elif tag == "DESC":
+                model["description"] = value
+            elif tag == "CLEN":
+                model["clen"] = int(value)
+            elif tag == "W":
+                model["window"] = int(value)
+            elif tag in ("GA", "TC", "NC"):
+                model[tag] = float(value.split()[0])
+    if name:
+        models[name] = model
+    return models
+
+
+def _source_info(cm_file: Path) -> Dict[str, int]:
+    stat = cm_file.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _build_sidecar(cm_file: Path) -> Dict[str, Any]:
+    return {
+        "version": SIDECAR_VERSION,
+        "source": {**_source_info(cm_file), "sha256": _sha256(cm_file)},
+        "models": parse_models(cm_file),
+    }
+
+
+def _write_sidecar(cm_file: Path, sidecar: Dict[str, Any]):
+    # written to a temporary file first so that other runs never read half of it
+    path = sidecar_path(cm_file)
+    partial = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    partial.write_text(json.dumps(sidecar, indent=1))
+    partial.replace(path)
+
+
+def _load_sidecar(cm_file: Path) -> Dict[str, Any]:
+    """The sidecar of `cm_file` if it's up to date. Otherwise, it's rebuilt and saved if possible."""
+    cm_file = Path(cm_file)
+    try:
+        sidecar = json.loads(sidecar_path(cm_file).read_text())
+        if sidecar["version"] == SIDECAR_VERSION and {
+            key: sidecar["source"][key] for key in ("size", "mtime_ns")
+        } == _source_info(cm_file):
+            return sidecar
+    except (OSError, ValueError, KeyError):
+        pass
+
+    logging.debug(f"Reading the model metadata from {cm_file}")
+    sidecar = _build_sidecar(cm_file)
+    try:
+        _write_sidecar(cm_file, sidecar)
+    except OSError:
+        pass  # e.g. a read-only directory, so the CM file is parsed every time
+    return sidecar
+
+
+def write_metadata(cm_file: Path) -> Metadata:
+    """Parse the models in `cm_file` and write them to its sidecar."""
+    sidecar = _build_sidecar(cm_file)
+    _write_sidecar(cm_file, sidecar)
+    return sidecar["models"]
+
+
+def load_metadata(cm_file: Path) -> Metadata:
+    """The metadata of the models in `cm_file`, parsing it only if it changed since the sidecar was written."""
+    return _load_sidecar(cm_file)["models"]
+
+
+def cm_fingerprint(cm_file: Path) -> str:
+    """The SHA-256 of the contents of `cm_file`, computed only if it changed since the sidecar was written."""
+    return _load_sidecar(cm_file)["source"]["sha256"]
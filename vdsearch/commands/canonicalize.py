@@ -24,18 +24,24 @@ def canonicalize(
         sys.maxsize,
         help="Maximum length of a sequence to be canonicalized and included in the output",
     ),
+    tsv: bool = typer.Option(
+        True,
+        help="Output a .tsv file with the length and vdsearch ID of each canonicalized sequence. If present, the output file will be named <output>.tsv",
+    ),
 ):
     """Compute a rotationally canonical representation of each sequence in a FASTA file.
 
     ## Performance notes
 
     By default, every sequence is canonicalized.
-    This can be slow for large sequences since canonicalization is O(n^2).
-    To speed things up, you can provide a limit on the smallest (**--min-len**) and largest input sequence lengths (**--max-len**) to output.
+    Canonicalization takes linear time, so even long sequences are cheap to canonicalize.
+    If you only need a subset, you can provide a limit on the smallest (**--min-len**) and largest input sequence lengths (**--max-len**) to output.
     """
     logging.info(f"Canonicalizing sequences in {fasta}.")
     logging.debug(
         f"Only sequences of length {min_len} to {max_len} will be canonicalized. "
     )
-    rotcanon.canonicalize(str(fasta), str(output), minLen=min_len, maxLen=max_len)
+    rotcanon.canonicalize(
+        str(fasta), str(output), minLen=min_len, maxLen=max_len, outTsv=tsv
+    )
     logging.done("Done canonicalizing.")  # type: ignore
@@ -1,49 +1,75 @@
 from pathlib import Path
-import subprocess
-import click
+import logging
+import tempfile
+from typing import Optional
+
+import rich_click as click
 import typer
 
-from vdsearch.types import FASTA, Threads
-from vdsearch.utils import check_executable_exists
-import logging
+from vdsearch.nim import dedup as dd
+from vdsearch.types import FASTA, Catalog, NovelOnly, Threads
+from vdsearch.utils import parse_size, typer_unpacker
 
 
+@typer_unpacker
 def dedup(
     fasta: Path = FASTA,
     output: Path = typer.Argument(
         ..., file_okay=True, dir_okay=False, writable=True, help="Path to output file"
     ),
     threads: int = Threads,
+    max_memory: str = typer.Option(
+        "4G",
+        help="Approximately how much memory to use, e.g. 512M or 16G. Beyond this, work is spilled to the scratch directory.",
+    ),
+    scratch_dir: Optional[Path] = typer.Option(
+        None,
+        file_okay=False,
+        dir_okay=True,
+        help="Where to spill to when the sequences don't fit in memory. Defaults to the system's temporary directory.",
+    ),
+    catalog: Optional[Path] = Catalog,
+    novel_only: bool = NovelOnly,
 ):
     """
     Removes duplicate canonicalized sequences.
 
-    Under the hood, this uses seqkit≥2.0.0 and is optimized for canonicalized sequences.
-    As such, it is **not safe** to use with non-canonicalized sequences.
+    The first copy of each sequence (ignoring case) is kept and the order of the input is preserved.
+    Only the forward strand is compared, so it is **not safe** to use with non-canonicalized sequences.
+
+    ## Performance notes
+
+    If the sequences don't fit within **--max-memory**, the rest of the work is done on disk in **--scratch-dir**.
+    The output is the same either way but the input is read twice, so the scratch directory should be on fast storage.
+
+    ## Catalogs
+
+    With **--catalog**, the sequences are also compared to the ones seen in previous runs that used the same catalog,
+    and the new ones are added to it. Add **--novel-only** to only output sequences that no previous run has seen.
+    The catalog uses the same digests as the `NV_` IDs, so it can be shared between runs on different samples.
     """
 
     logging.info("Removing duplicate sequences...")
 
-    check_executable_exists(
-        "seqkit", display_name="Seqkit", test_command="seqkit version"
-    )
-
-    # TODO: check seqkit version is >= 2.0.0
+    if novel_only and catalog is None:
+        raise click.BadParameter("--novel-only requires a --catalog.")
 
-    command = (
-        "seqkit rmdup "
-        "--by-seq "
-        "--only-positive-strand "
-        f"--threads {threads} "
-        f"--ignore-case {fasta} -o {output}"
+    total, duplicates, spilled, known = dd.dedup(
+        str(fasta),
+        str(output),
+        maxMemory=parse_size(max_memory),
+        scratchDir=str(scratch_dir or tempfile.gettempdir()),
+        threads=threads,
+        catalogDir=str(catalog or ""),
+        novelOnly=novel_only,
     )
-    logging.debug("Running command [cyan]{}[/]".format(command))
-
-    try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True)
-        count = result.stderr.decode("utf-8").split()[1]
-        logging.done(f"{count} duplicate sequences removed.")  # type: ignore
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed with exit code {e.returncode}")
-        logging.error(f"Command output: '{e.output.decode('utf-8').rstrip()}'")
-        raise click.Abort("Command failed. See logs for error messages.")
+    if spilled:
+        logging.debug(
+            f"The sequences didn't fit in {max_memory} of memory so some were deduplicated on disk."
+        )
+    logging.done(f"{duplicates:,} duplicate sequences removed from {total:,} sequences.")  # type: ignore
+    if catalog is not None:
+        logging.done(  # type: ignore
+            f"{known:,} sequences were already in the catalog"
+            f"{' and were removed' if novel_only else ''}."
+        )
@@ -4,6 +4,7 @@ from pathlib import Path
 
 import typer
 
+from vdsearch.cm_metadata import sidecar_path, write_metadata
 from vdsearch.types import Threads
 
 """
@@ -223,3 +224,9 @@ def download_cms(
     if merged.read_text().splitlines().count("//") != len(cms) * 2:
         raise ValueError(f"{merged.as_posix()} does not contain 2*{len(cms)} // lines")
     logging.debug("Verified merged CMs")
+
+    # the cutoffs and lengths of the models are saved so that the other stages don't have to parse the CMs
+    models = write_metadata(merged)
+    logging.debug(
+        f"Wrote the metadata of {len(models)} models to {sidecar_path(merged)}"
+    )
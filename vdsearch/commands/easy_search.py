@@ -1,13 +1,14 @@
+import os
 import subprocess
 import logging
 import shutil
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Optional
 
 import rich_click as click
 import pandas as pd
-from pkg_resources import resource_filename  # type: ignore
 import rich
-import skbio
 import typer
 from rich.console import Console
 
@@ -16,13 +17,20 @@ from vdsearch.commands.fold import fold
 from vdsearch.commands.mmseqs import search
 from vdsearch.commands.dedup import dedup
 from vdsearch.commands.find_circs import find_circs
-from vdsearch.commands.infernal import infernal
-from vdsearch.commands.ribozyme_filter import ribozyme_filter
-from vdsearch.commands.rnamotif import rnamotif
+from vdsearch.commands.infernal import infernal, on_shard_done
+from vdsearch.commands.ribozyme_filter import RibozymeStream, ribozyme_filter
+from vdsearch.commands.rnamotif import bundled_descriptors, rnamotif, tagged_with
 from vdsearch.commands.summarize import summarize
 from vdsearch.nim import write_seqs as ws
-from vdsearch.types import FASTA, ReferenceCms, Threads, ViroidDB
-from vdsearch.utils import check_executable_exists
+from vdsearch.types import (
+    FASTA,
+    Catalog,
+    NovelOnly,
+    ReferenceCms,
+    Threads,
+    ViroidDB,
+)
+from vdsearch.utils import check_executable_exists, open_compressed
 
 
 def easy_search(
@@ -49,6 +57,26 @@ def easy_search(
         help="Path to temporary directory for intermediate files",
     ),
     threads: int = Threads,
+    compress: bool = typer.Option(
+        False,
+        help="Gzip the intermediate circs.fasta and deduped_circs.fasta files to save disk space.",
+    ),
+    catalog: Optional[Path] = Catalog,
+    novel_only: bool = NovelOnly,
+    triage: bool = typer.Option(
+        False,
+        help="Only search the circRNAs that a fast HMM-only search finds candidate ribozymes in with the full CMs. See `vdsearch infernal --help`.",
+    ),
+    junctions: bool = typer.Option(
+        False,
+        help="Also find ribozymes that span the start and end of the circRNAs. See `vdsearch infernal --help`.",
+    ),
+    hit_cache: Optional[Path] = typer.Option(
+        None,
+        file_okay=False,
+        dir_okay=True,
+        help="Directory of a cache of ribozyme hits shared between runs so that circRNAs seen before aren't searched again. See `vdsearch infernal --help`.",
+    ),
     force: bool = typer.Option(
         False,
         help="Force running even if lockfile is present. Internal and inadvisable for production.",
@@ -69,6 +97,9 @@ def easy_search(
     4. Search them for ribozymes
     5. Also search the circRNAs against a database of known viroid-like RNAs (ViroidDB)
     6. Using the ribozyme data and search results, output viroid-like sequences
+
+    With **--catalog**, the deduplicated circRNAs are also compared to the ones found in previous runs that used the
+    same catalog. Add **--novel-only** to only search the circRNAs that no previous run has seen.
     """
     # region: preflight checks
     logging.debug("Checking that all needed tools exist...")
@@ -114,65 +145,74 @@ def easy_search(
     # if not reference_cms:
     #     download.download_cms()
 
-    # region: run cirit/rotcanon
-    circs = outdir / "circs.fasta"
+    # region: run cirit/rotcanon and dedup
+    circs = outdir / ("circs.fasta.gz" if compress else "circs.fasta")
+    deduped_circs = outdir / (
+        "deduped_circs.fasta.gz" if compress else "deduped_circs.fasta"
+    )
 
     # when there's nothing to do since the required output files exist, skip
-    if circs.exists():
-        logging.warning("CircRNAs already found. Skipping.")
-    # if the input is assumed to be circular but canonicalization is required
-    elif circular and canonicalize:
-        logging.warning("Skipping circularity detection but canonicalizing.")
-        canonicalize_command(fasta, circs, min_len=100, max_len=10_000)
-    # if the input is circular and canonicalization is not required
-    elif circular and not canonicalize:
-        logging.warning("Assuming input are canonical circular sequences.")
-        shutil.copyfile(fasta, circs)
-    # run integrated circularity detection and canonicalization
-    else:
+    if deduped_circs.exists():
+        logging.warning("CircRNAs already found and deduplicated. Skipping.")
+    # run integrated circularity detection, canonicalization, and deduplication
+    elif not circular:
         find_circs(
             fasta,
-            circs,
+            deduped_circs,
             canonicalize=True,
             tsv=True,
             min_len=100,
             max_monomer_len=10_000,
             max_len=10_000,
+            threads=threads,
+            dedup=True,
+            catalog=catalog,
+            novel_only=novel_only,
         )
-    # endregion
-
-    # region: run dedup using seqkit
-    deduped_circs = outdir / "deduped_circs.fasta"
-    if not deduped_circs.exists():
-        dedup(circs, deduped_circs, threads=threads)
     else:
-        logging.warning("CircRNAs already deduplicated. Skipping.")
-    # endregion
-
-    # region: run infernal
-    cmsearch_output = outdir / "infernal.out"
-    cmsearch_tblout = outdir / "infernal.tblout"
-    if not cmsearch_output.exists() or not cmsearch_tblout.exists():
-        infernal(
+        if circs.exists():
+            logging.warning("CircRNAs already found. Skipping.")
+        # if the input is assumed to be circular but canonicalization is required
+        elif canonicalize:
+            logging.warning("Skipping circularity detection but canonicalizing.")
+            canonicalize_command(fasta, circs, min_len=100, max_len=10_000)
+        # if the input is circular and canonicalization is not required
+        else:
+            logging.warning("Assuming input are canonical circular sequences.")
+            with open_compressed(fasta, "rb") as fin, open_compressed(
+                circs, "wb"
+            ) as fout:
+                shutil.copyfileobj(fin, fout)
+        dedup(
+            circs,
             deduped_circs,
-            output=cmsearch_output,
-            output_tsv=cmsearch_tblout,
-            reference_cms=reference_cms,
             threads=threads,
-            cmscan=False,
+            catalog=catalog,
+            novel_only=novel_only,
         )
-    else:
-        logging.warning("Infernal already run. Skipping.")
+
+    # the fused search writes the circRNA table next to the deduplicated circRNAs
+    circ_tsv = outdir / "deduped_circs.tsv"
+    if not circ_tsv.exists():
+        circ_tsv = outdir / "circs.tsv"
     # endregion
 
     # region: run rnamotif if possible
     rnamotif_output = outdir / "rnamotif.tsv"
+    if rnamotif_output.exists() and not tagged_with(
+        rnamotif_output, bundled_descriptors()
+    ):
+        logging.warning(
+            "RNAmotif output doesn't say which descriptor found each hit. Running RNAmotif again."
+        )
+        rnamotif_output.unlink()
     if not rnamotif_output.exists():
         try:
             rnamotif(
                 deduped_circs,
-                Path(resource_filename("vdsearch", "data/rnamotif/Hammerhead_3.descr")),
+                bundled_descriptors(),
                 rnamotif_output,
+                threads=threads,
             )
         except Exception:
             logging.warn("Could not run RNAmotif. Skipping.")
@@ -180,24 +220,53 @@ def easy_search(
         logging.warning("RNAmotif already run. Skipping.")
     # endregion
 
-    # region: find the viroids in the infernal output
-    rz_seqs = outdir / "seqs_with_rzs.fasta"
+    # region: run infernal, finding the viroid-like sequences in each shard as soon as it's searched
+    cmsearch_output = outdir / "infernal.out"
+    cmsearch_tblout = outdir / "infernal.tblout"
     viroidlike_rzs = outdir / "seqs_with_rzs.tsv"
-    if not rz_seqs.exists() or not viroidlike_rzs.exists():
-        ribozymes = ribozyme_filter(
+    rz_seqs = outdir / "seqs_with_rzs.fasta"
+    rz_seqs_streamed = False
+    if not cmsearch_output.exists() or not cmsearch_tblout.exists():
+        stream = (
+            RibozymeStream(
+                deduped_circs,
+                rz_seqs,
+                output_tsv=viroidlike_rzs,
+                cm_file=reference_cms,
+                rnamotif_txt=rnamotif_output,
+            )
+            if not viroidlike_rzs.exists()
+            else None
+        )
+        with on_shard_done(stream.add_shard) if stream else nullcontext():
+            infernal(
+                deduped_circs,
+                output=cmsearch_output,
+                output_tsv=cmsearch_tblout,
+                reference_cms=reference_cms,
+                threads=threads,
+                cmscan=False,
+                triage=triage,
+                junctions=junctions,
+                cache=hit_cache,
+            )
+        if stream:
+            stream.finish()
+            rz_seqs_streamed = True
+    else:
+        logging.warning("Infernal already run. Skipping.")
+    # endregion
+
+    # region: find the viroids in the infernal output
+    if rz_seqs_streamed:
+        logging.debug("Viroid-like sequences were found during the search.")
+    elif not viroidlike_rzs.exists():
+        ribozyme_filter(
             cmsearch_tblout,
             output_tsv=viroidlike_rzs,
             cm_file=reference_cms,
-            rnamotif_name="Hammerhead_3",
             rnamotif_txt=rnamotif_output,
         )
-        logging.info("Outputting sequences with ribozymes...")
-        ws.write_seqs(
-            str(deduped_circs),
-            str(rz_seqs),
-            ribozymes["ribozy_likes"].seq_id.tolist(),
-        )
-        logging.done(f"Wrote to {rz_seqs}")  # type: ignore
     else:
         logging.warning("Viroid-like sequences already found. Skipping.")
     # endregion
@@ -208,45 +277,46 @@ def easy_search(
         search(deduped_circs, reference_db, output_tsv=viroiddb_hits, threads=threads)
     # endregion
 
-    # region: extract the viroid matches from ViroidDB
+    # region: extract the sequences with ribozymes or matching ViroidDB in one pass
     seqs_matching_viroiddb = outdir / "seqs_matching_viroiddb.fasta"
-    if not seqs_matching_viroiddb.exists():
-        logging.info("Outputting sequences matching ViroidDB...")
-        search_results = pd.read_csv(
-            viroiddb_hits,
-            sep="\t",
-            names="query,target,pident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,evalue,bits,theader,qcov,tcov,cigar".split(
-                ","
-            ),
+    merged_seqs = outdir / "viroid_like.fasta"
+    if (
+        not rz_seqs.exists()
+        or not seqs_matching_viroiddb.exists()
+        or not merged_seqs.exists()
+    ):
+        logging.info("Outputting sequences with ribozymes or matching ViroidDB...")
+        rz_ids = (
+            pd.read_csv(viroidlike_rzs, sep="\t", usecols=["seq_id"])
+            .seq_id.astype(str)
+            .tolist()
+            if viroidlike_rzs.exists()
+            else []
         )
-        ws.write_seqs(
+        viroiddb_ids = (
+            pd.read_csv(viroiddb_hits, sep="\t", header=None, usecols=[0])[0]
+            .astype(str)
+            .tolist()
+            if viroiddb_hits.stat().st_size
+            else []
+        )
+        # we do viroiddb first so matches are first in the summary
+        viroiddb_count, rz_count = ws.route_seqs(
             str(deduped_circs),
-            str(seqs_matching_viroiddb),
-            search_results["query"].tolist(),
+            # the sequences with ribozymes may have already been written during the search
+            [
+                str(seqs_matching_viroiddb),
+                os.devnull if rz_seqs_streamed else str(rz_seqs),
+            ],
+            [viroiddb_ids, rz_ids],
+            union=str(merged_seqs),
+        )
+        logging.done(  # type: ignore
+            f"Wrote {viroiddb_count:,} sequences matching ViroidDB to {seqs_matching_viroiddb}, "
+            f"{rz_count:,} sequences with ribozymes to {rz_seqs}, and both to {merged_seqs}."
         )
-        logging.done(f"Wrote to {seqs_matching_viroiddb}")  # type: ignore
-    else:
-        logging.warning("ViroidDB sequences already emitted. Skipping.")
-    # endregion
-
-    # region: merge the two fasta files from ribozyme and viroid db
-    merged_seqs = outdir / "viroid_like.fasta"
-    if not merged_seqs.exists():
-        logging.info("Merging sequences found by ribozyme and ViroidDB searches...")
-        seen = set()
-        with merged_seqs.open("w") as f:
-            # we do viroiddb first so matches are first in the summary
-            for search_result in [seqs_matching_viroiddb, rz_seqs]:
-                for record in skbio.read(
-                    str(search_result), "fasta", constructor=skbio.DNA
-                ):
-                    if record.metadata["id"] in seen:
-                        continue
-                    f.write(f">{record.metadata['id']}\n{record}\n")
-                    seen.add(record.metadata["id"])
-        logging.done("Merged.")  # type: ignore
     else:
-        logging.warning("Sequences are already merged. Skipping.")
+        logging.warning("Sequences are already extracted. Skipping.")
     # endregion
 
     # region: fold the sequences
@@ -282,7 +352,7 @@ def easy_search(
             dbn_plus=folded_seqs_plus,
             dbn_minus=folded_seqs_minus,
             source=outdir.stem,
-            circ_tsv=outdir / "circs.tsv",
+            circ_tsv=circ_tsv,
             outfile=summary_table,
             header=True,
         )
@@ -1,23 +1,32 @@
 import logging
 from pathlib import Path
 import sys
+from typing import Optional
 
 import nimporter
+import rich_click as click
 import typer
 
 from vdsearch.nim import find_circs as fc
+from vdsearch.types import Catalog, NovelOnly, Threads
+from vdsearch.utils import typer_unpacker
 
 
+@typer_unpacker
 def find_circs(
     fasta: Path = typer.Argument(
         ...,
-        help="Path to .fasta file or '-' for stdin",
+        help="Path to .fasta file (optionally compressed with gzip, BGZF, or zstd) or '-' for stdin",
         file_okay=True,
         dir_okay=False,
         readable=True,
     ),
     output: Path = typer.Argument(
-        ..., file_okay=True, dir_okay=False, writable=True, help="Path to output file"
+        ...,
+        file_okay=True,
+        dir_okay=False,
+        writable=True,
+        help="Path to output file. If it ends with .gz, .bgz, or .zst, it will be compressed.",
     ),
     canonicalize: bool = typer.Option(
         True, help="Output canonicalized sequences instead of raw sequences"
@@ -38,6 +47,18 @@ def find_circs(
         sys.maxsize,
         help="Maximum length of the resulting monomer to be included in the output",
     ),
+    threads: int = Threads,
+    ordered: bool = typer.Option(
+        True,
+        "--ordered/--unordered",
+        help="Keep the output in the same order as the input. Unordered output may be slightly faster when using multiple threads.",
+    ),
+    dedup: bool = typer.Option(
+        False,
+        help="Only output the first copy of each monomer. Duplicates are listed next to the ID they duplicate in <output>.duplicates.tsv",
+    ),
+    catalog: Optional[Path] = Catalog,
+    novel_only: bool = NovelOnly,
 ):
     """
     Search for circular sequences.
@@ -49,6 +70,13 @@ def find_circs(
     To speed up the search, you can provide a limit on the smallest (**--min-len**) and largest input sequence lengths (**--max-len**) to consider and report.
     For reporting, you can also set the maximum reported monomer length with **--max-monomer-len**.
 
+    With more than one thread (**--threads**), the input is read in batches that are monomerized in parallel.
+
+    With **--dedup**, duplicate monomers are removed on the fly, which saves a separate `vdsearch dedup` pass.
+    Since identical circRNAs only have identical monomers once canonicalized, this should be used with **--canonicalize**.
+
+    With **--catalog**, the monomers are also compared to the ones seen in previous runs (see `vdsearch dedup`).
+
     ## References
 
     This method is based on the following paper:
@@ -64,6 +92,9 @@ def find_circs(
         f"Only monomers of length {min_len} to {max_len} will be monomerized. "
         f"Only monomers less than {max_monomer_len} nt will be included in {output}."
     )
+    if novel_only and catalog is None:
+        raise click.BadParameter("--novel-only requires a --catalog.")
+
     circs = fc.find_circs(
         str(fasta),
         str(output),
@@ -73,8 +104,20 @@ def find_circs(
         maxLen=max_len,
         maxMonomerLen=max_monomer_len,
         verbose=logging.getLogger().isEnabledFor(logging.DEBUG),
+        threads=threads,
+        ordered=ordered,
+        dedup=dedup,
+        catalogDir=str(catalog or ""),
+        novelOnly=novel_only,
     )
     # we do the max(circs[3], 1) to avoid division by zero when the time is 0ms
     mbp_per_sec = (circs[2] / 1000000) / (max(circs[3], 1) / 1000.0)
 
-    logging.done(f"{circs[0]:,} circRNAs found from {circs[1]:,} sequences ({mbp_per_sec:,.0f} Mbp/sec).")  # type: ignore
+    logging.done(f"Wrote {circs[0]:,} circRNAs found in {circs[1]:,} sequences to {output} ({mbp_per_sec:,.0f} Mbp/sec).")  # type: ignore
+    if dedup:
+        logging.done(f"{circs[4]:,} duplicate sequences removed.")  # type: ignore
+    if catalog is not None:
+        logging.done(  # type: ignore
+            f"{circs[5]:,} monomers were already in the catalog"
+            f"{' and were removed' if novel_only else ''}."
+        )
@@ -1,12 +1,278 @@
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import ContextVar
 import logging
+import re
+import shutil
 import subprocess
+import tempfile
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 import click
 import typer
+from vdsearch.cm_metadata import load_metadata
+from vdsearch.hit_cache import HitCache, fingerprint
+from vdsearch.nim import write_seqs as ws
 from vdsearch.types import FASTA, ReferenceCms, Threads
-from vdsearch.utils import check_executable_exists, typer_unpacker
+from vdsearch.utils import check_executable_exists, parse_size, typer_unpacker
+
+CPUS_PER_SHARD = 2  # Infernal's own multithreading stops paying off quickly, so we'd rather run more processes
+# added to the names of the junction windows of circular sequences
+JUNCTION_SUFFIX = "/junction"
+# Mb; cmsearch picks its filter thresholds by which of these search space sizes the search is at least
+FILTER_TIERS = (2, 20, 200, 2_000, 20_000)
+DEFAULT_MAX_EVALUE = 10.0  # cmsearch's default -E
+DEFAULT_INCLUSION_EVALUE = 0.01  # cmsearch's default --incE
+
+ShardCallback = Callable[[Path, Path], None]
+_shard_callback: ContextVar[Optional[ShardCallback]] = ContextVar(
+    "shard_callback", default=None
+)
+
+
+@contextmanager
+def on_shard_done(callback: ShardCallback):
+    """
+    Within this block, `infernal` calls `callback(fasta, tblout)` as soon as the hits of some of the sequences are
+    final, *i.e.* each time one of its shards is done, so that they can be processed while the other shards are still
+    being searched.
+
+    `fasta` has the sequences and `tblout` has all of their hits. Every sequence is in exactly one call, which is made
+    in the thread that called `infernal`. With **--triage**, the sequences that triage discarded are in one call before
+    the candidates are searched shard by shard. With **--cache**, the sequences whose hits are taken from the cache are
+    in one call before the rest are searched. With **--junctions**, the hits are only final once both the sequences
+    and their junction windows have been searched, so all of the sequences searched together are in a single call.
+    """
+    token = _shard_callback.set(callback)
+    try:
+        yield
+    finally:
+        _shard_callback.reset(token)
+
+
+def model_names(cm_file: Path) -> List[str]:
+    """The names of the models in a CM file, in the order they're in the file."""
+    return list(load_metadata(cm_file))
+
+
+def max_hit_length(cm_file: Path) -> int:
+    """The longest hit that any model in a CM file can have, *i.e.* the largest window (`W`) that cmsearch uses."""
+    windows = [
+        model["window"]
+        for model in load_metadata(cm_file).values()
+        if "window" in model
+    ]
+    if not windows:
+        raise click.ClickException(f"{cm_file} has no calibrated window lengths.")
+    return max(windows)
+
+
+def map_junction_hits(window_tblout: Path, output_tsv: Path) -> int:
+    """
+    Map the hits in the junction windows of circular sequences back to the sequences themselves.
+
+    Only the hits that span the junction are kept since the others are in the sequence's own search too. The windows
+    are written by the `junction_windows` kernel. A hit that wraps around the end of its sequence ends at a smaller
+    position than it starts on the plus strand (or a larger one on the minus strand). Hits longer than their sequence
+    are dropped since they'd cover some of it twice. Returns the number of hits kept.
+    """
+    kept = 0
+    with open(window_tblout) as f, open(output_tsv, "w") as out:
+        for line in f:
+            if line.startswith("#"):
+                out.write(line)
+                continue
+            # keep the separators so that the columns stay aligned
+            tokens = re.split(r"(\s+)", line.rstrip("\n"), maxsplit=17)
+            window_name, start, end = tokens[0], int(tokens[14]), int(tokens[16])
+            info = dict(field.split("=", 1) for field in tokens[34].split())
+            length, tail = int(info["length"]), int(info["tail"])
+            if not min(start, end) <= tail < max(start, end):
+                continue
+            if abs(end - start) + 1 > length:
+                continue
+
+            set_field(tokens, 0, window_name[: -len(JUNCTION_SUFFIX)])
+            for i, position in ((14, start), (16, end)):
+                set_field(
+                    tokens,
+                    i,
+                    str((length - tail + position - 1) % length + 1),
+                    right_aligned=True,
+                )
+            tokens[34] = "-"
+            out.write("".join(tokens) + "\n")
+            kept += 1
+    return kept
+
+
+def set_field(tokens: List[str], i: int, value: str, right_aligned: bool = False):
+    """
+    Replace a field of a tabular output row split with `re.split(r"(\s+)", row)`, growing or shrinking the separator
+    on its padded side so that the columns stay aligned.
+    """
+    separator = i - 1 if right_aligned else i + 1
+    if 0 <= separator < len(tokens):
+        tokens[separator] = " " * max(
+            len(tokens[separator]) + len(tokens[i]) - len(value), 1
+        )
+    tokens[i] = value
+
+
+def rescale_row(
+    row: str, seq_id: str, scale: float, max_evalue: Optional[float] = None
+) -> Optional[str]:
+    """
+    A tabular output row of a sequence, renamed to `seq_id` and with its E-value scaled by `scale` for a different
+    search space. If hits are reported by E-value (`max_evalue`), the inclusion mark is updated too and rows that
+    wouldn't be reported anymore are dropped by returning None.
+    """
+    tokens = re.split(r"(\s+)", row.rstrip("\n"), maxsplit=17)
+    set_field(tokens, 0, seq_id)
+    if scale != 1:
+        evalue = float(tokens[30]) * scale
+        set_field(tokens, 30, f"{evalue:.2g}", right_aligned=True)
+    else:
+        evalue = float(tokens[30])
+    if max_evalue is not None:
+        if evalue > max_evalue:
+            return None
+        tokens[32] = "!" if evalue <= DEFAULT_INCLUSION_EVALUE else "?"
+    return "".join(tokens) + "\n"
+
+
+def tblout_hits(tblout: Path) -> List[Tuple[str, str]]:
+    """The target and query names of each hit in a tabular output."""
+    with open(tblout) as f:
+        return [
+            (fields[0], fields[2])
+            for fields in (line.split(maxsplit=3) for line in f)
+            if fields and not fields[0].startswith("#")
+        ]
+
+
+def parse_options(tokens: List[str]) -> Dict[str, str]:
+    """The value of each option on an Infernal command line split into `tokens`, or an empty one for flags."""
+    options: Dict[str, str] = {}
+    i = 0
+    while i < len(tokens):
+        # options take at most one value, which never starts with a dash
+        if i + 1 < len(tokens) and not tokens[i + 1].startswith("-"):
+            options[tokens[i]] = tokens[i + 1]
+            i += 2
+        else:
+            options[tokens[i]] = ""
+            i += 1
+    return options
+
+
+def filter_tier(database_size: float) -> int:
+    """
+    Which of the `FILTER_TIERS` a search space of `database_size` Mb is in. Searches in the same tier use the same
+    filter thresholds, so the hits they find only differ in their E-values.
+    """
+    return bisect_right(FILTER_TIERS, database_size)
+
+
+def rewrite_option_settings(
+    line: str, settings: Dict[str, Optional[str]], target: Optional[str] = None
+) -> str:
+    """
+    Change the options in the `# Option settings:` comment of a tabular output, which is the command line that Infernal
+    reconstructs from the options in effect: the program, its options, then the CM file and the target file.
+
+    Each of `settings` replaces the value of an option or is added at the end of them if it wasn't set. An empty value
+    sets a flag and None removes the option. The target file is replaced by `target` if it's given. Any other line is
+    returned as is.
+    """
+    match = re.match(r"(# Option settings:\s*)(.*?)(\s*)$", line, flags=re.DOTALL)
+    if match is None:
+        return line
+    tokens = match.group(2).split()
+    if len(tokens) < 3:
+        return line
+    program, positional = tokens[0], tokens[-2:]
+    if target is not None:
+        positional[-1] = target
+    options = parse_options(tokens[1:-2])
+    for option, value in settings.items():
+        if value is None:
+            options.pop(option, None)
+        else:
+            options[option] = value
+    command = [program]
+    for option, value in options.items():
+        command.append(f"{option} {value}" if value else option)
+    return match.group(1) + " ".join(command + positional) + match.group(3)
+
+
+def merge_tblouts(
+    shard_tblouts: List[Path],
+    output_tsv: Path,
+    shard_fastas: List[Path],
+    fasta: Path,
+    models: Optional[List[str]] = None,
+    settings: Optional[Dict[str, Optional[str]]] = None,
+):
+    """
+    Merge the tabular outputs of searches of several shards as if they were from a single search.
+
+    The comments at the top and bottom are taken from the first shard (with its FASTA file swapped for the original
+    one). Its option settings name `output_tsv` as the tabular output and are changed further by `settings` (see
+    `rewrite_option_settings`), *e.g.* to name the merged text output. If `models` is given (for cmsearch), the hits
+    are grouped by model in that order and sorted by E-value within each model like cmsearch does. Otherwise (for
+    cmscan), the hits of each shard are simply concatenated.
+    """
+    settings = {"--tblout": str(output_tsv), **(settings or {})}
+    order = {name: i for i, name in enumerate(models or [])}
+    header: List[str] = []
+    footer: List[str] = []
+    hits = []  # (model index, E-value, negative score, line)
+    for i, tblout in enumerate(shard_tblouts):
+        with open(tblout) as f:
+            seen_hits = False
+            for line in f:
+                if not line.startswith("#"):
+                    seen_hits = True
+                    fields = line.split(maxsplit=17)
+                    if models is None:
+                        hits.append((0, 0.0, 0.0, line))
+                    else:
+                        hits.append(
+                            (
+                                order.get(fields[2], len(order)),
+                                float(fields[15]),
+                                -float(fields[14]),
+                                line,
+                            )
+                        )
+                elif i == 0 and not seen_hits and not footer:
+                    header.append(line)
+                elif i == 0:
+                    footer.append(line)
+
+    # the header is everything up to the column separator line since there may be no hits to tell where it ends
+    separator = next(
+        (j for j, line in enumerate(header) if line.startswith("#-")), None
+    )
+    if separator is not None:
+        footer = header[separator + 1 :] + footer
+        header = header[: separator + 1]
+
+    # sorts are stable so ties stay in shard order
+    hits.sort(key=lambda hit: hit[:3])
+    with open(output_tsv, "w") as out:
+        out.writelines(header)
+        out.writelines(hit[3] for hit in hits)
+        out.writelines(
+            rewrite_option_settings(
+                line.replace(str(shard_fastas[0]), str(fasta)), settings, str(fasta)
+            )
+            for line in footer
+        )
 
 
 @typer_unpacker
@@ -44,10 +310,78 @@ def infernal(
         None, help="The maximum E value to report.", min=0.0
     ),
     threads: int = Threads,
+    shards: int = typer.Option(
+        0,
+        min=0,
+        help=f"Number of Infernal processes to run at once on separate parts of the input. By default, there's one for every {CPUS_PER_SHARD} threads.",
+    ),
+    triage: bool = typer.Option(
+        False,
+        help="Find candidate sequences with a fast HMM-only search first and only search those with the full CMs. Only for cmsearch.",
+    ),
+    triage_evalue: float = typer.Option(
+        10.0,
+        help="The maximum E value of the HMM-only search for a sequence to be a candidate.",
+        min=0.0,
+    ),
+    triage_audit: float = typer.Option(
+        0.01,
+        help="Fraction of all sequences to also search with the full CMs to estimate how many hits the triage misses.",
+        min=0.0,
+        max=1.0,
+    ),
+    junctions: bool = typer.Option(
+        False,
+        help="Treat the sequences as circular and also find the hits that span their start and end. Only for cmsearch.",
+    ),
+    cache: Optional[Path] = typer.Option(
+        None,
+        help="Directory of a cache of the hits of each sequence that can be shared between runs. Only the sequences that aren't in it yet are searched. Only for cmsearch.",
+        file_okay=False,
+        dir_okay=True,
+    ),
+    cache_max_size: str = typer.Option(
+        "10G",
+        help="How big the --cache can get before the least recently used sequences are removed from it, e.g. 512M or 100G.",
+    ),
 ):
     """
     Run Infernal cmsearch or cmscan for provided covariance matrices.
 
+    ## Performance notes
+
+    Infernal's multithreading doesn't scale well beyond a few cores, so the input is split into **--shards** parts
+    with about the same number of bases that are searched at the same time, splitting **--threads** between them.
+    For cmsearch, the total size of the input is passed with `-Z` so that the E-values are the same as if it had been
+    searched all at once. The tabular outputs are merged into one in the same format (and the same order) as
+    cmsearch's and the text outputs are concatenated.
+
+    Most sequences have no hits at all, so with **--triage**, they are first searched with only the profile HMMs
+    (`--hmmonly`) using the lenient **--triage-evalue** and only the sequences with a hit there are searched with the
+    full CMs. The size of the whole input is still used for the E-values, so the output is the same as without triage
+    except for any hits the HMMs miss. To estimate how many that is, a random **--triage-audit** fraction of all
+    sequences is also searched with the full CMs and the hits in sequences that triage discarded are reported. If no
+    sequence passes the triage, the text output is the triage search's, with a note saying so.
+
+    ## Circular sequences
+
+    A hit that spans the arbitrary start of a circular sequence is split in two, so it can't be found by searching the
+    sequence as is. Rather than searching every sequence twice over, **--junctions** also searches a window around the
+    junction of each one: its last bases followed by its first ones, each as long as the longest possible hit. Only
+    the hits that span the junction are kept and their positions are mapped back onto the sequence, so such a hit ends
+    at a smaller position than it starts on the plus strand. The windows don't count towards the E-values.
+
+    ## Caching
+
+    The same sequences tend to turn up again and again, so with **--cache**, the hits of each sequence are stored by
+    the digest of the sequence (like the `NV_` IDs) along with a fingerprint of the CMs and the search settings. Only
+    the sequences that aren't in the cache are searched and the rest of the hits are taken from it, with their
+    E-values rescaled to the size of this input. When hits are reported by E-value, a sequence is searched again if it
+    was cached from a larger search since it could have hits that weren't reported then. cmsearch's filter thresholds
+    get stricter as the search space grows past 2, 20, 200, 2,000, and 20,000 Mb, so hits are only taken from the cache
+    if they were found in a search space of the same tier, which finds the same hits. The text output only has the
+    alignments of the sequences that were searched and ends with how many were taken from the cache.
+
     ## Note
 
     Descriptions for **--cut-nc**, **--cut-tc** and **--cut-ga** are copied directly from [Infernal's manpage](http://eddylab.org/infernal/Userguide.pdf).
@@ -86,26 +420,444 @@ def infernal(
     if output_tsv is None:
         output_tsv = Path(fasta.stem + "." + base_command + ".tblout")
 
-    command = (
-        f"{base_command} "
-        f"--cpu {threads} "
-        f"--tblout {output_tsv} "
+    if triage and cmscan:
+        raise click.BadParameter(
+            "Triage is only supported for cmsearch.", param_hint="--triage"
+        )
+    if junctions and cmscan:
+        raise click.BadParameter(
+            "Junction windows are only supported for cmsearch.",
+            param_hint="--junctions",
+        )
+    if cache is not None and cmscan:
+        raise click.BadParameter(
+            "The cache is only supported for cmsearch.", param_hint="--cache"
+        )
+    if shards == 0:
+        shards = max(threads // CPUS_PER_SHARD, 1)
+
+    thresholds = (
         f"{'--cut_ga ' if cut_ga else ''}"
         f"{'--cut_tc ' if cut_tc else ''}"
         f"{'--cut_nc ' if cut_nc else ''}"
         f"{'-E ' + str(evalue) + ' ' if evalue is not None and float(evalue) else ''}"
-        f"-o {output} '{reference_cms}' {fasta}"
     )
-    logging.info(f"Searching {fasta} using {base_command}")
-    logging.debug(f"{command=}")
-    try:
-        subprocess.run(
-            command,
-            shell=True,
-            check=True,
-        )
-    except subprocess.CalledProcessError as error:
-        raise click.Abort(
-            f"{base_command} failed with exit code {error.returncode}",
+
+    def command(
+        fasta: Path,
+        output: Path,
+        output_tsv: Path,
+        cpus: int,
+        options: str,
+        database_size: Optional[float] = None,
+    ) -> str:
+        return (
+            f"{base_command} "
+            f"--cpu {cpus} "
+            f"--tblout {output_tsv} "
+            f"{options}"
+            f"{'-Z ' + format(database_size, '.6f') + ' ' if database_size is not None else ''}"
+            f"-o {output} '{reference_cms}' {fasta}"
         )
+
+    def run(command: str):
+        logging.debug(f"{command=}")
+        try:
+            subprocess.run(
+                command,
+                shell=True,
+                check=True,
+            )
+        except subprocess.CalledProcessError as error:
+            raise click.Abort(
+                f"{base_command} failed with exit code {error.returncode}",
+            )
+
+    def search_linear(
+        fasta: Path,
+        output: Path,
+        output_tsv: Path,
+        options: str,
+        database_size: Optional[float] = None,
+        on_done: Optional[ShardCallback] = None,
+    ):
+        if shards == 1:
+            run(command(fasta, output, output_tsv, threads, options, database_size))
+            if on_done is not None:
+                on_done(fasta, output_tsv)
+            return
+
+        with tempfile.TemporaryDirectory(
+            prefix="vdsearch_infernal_", dir=Path(output_tsv).parent
+        ) as tmpdir:
+            shard_fastas = [Path(tmpdir) / f"shard{i}.fasta" for i in range(shards)]
+            _, total_bases = ws.shard_seqs(
+                str(fasta), [str(path) for path in shard_fastas]
+            )
+            # there may be fewer sequences than shards
+            shard_fastas = [path for path in shard_fastas if path.stat().st_size]
+            if not shard_fastas:
+                raise click.ClickException(f"{fasta} has no sequences to search.")
+            logging.debug(
+                f"Split {total_bases:,} nt into {len(shard_fastas)} shards to search in parallel."
+            )
+
+            # cmsearch counts both strands of the whole database, while cmscan's E-values only depend on each sequence
+            if database_size is None and not cmscan:
+                database_size = total_bases * 2 / 1e6
+            cpus = max(threads // len(shard_fastas), 1)
+            shard_outputs = [path.with_suffix(".out") for path in shard_fastas]
+            shard_tblouts = [path.with_suffix(".tblout") for path in shard_fastas]
+            with ThreadPoolExecutor(max_workers=len(shard_fastas)) as executor:
+                searches = {
+                    executor.submit(
+                        run, command(*paths, cpus, options, database_size)
+                    ): paths
+                    for paths in zip(shard_fastas, shard_outputs, shard_tblouts)
+                }
+                for done in as_completed(searches):
+                    done.result()  # re-raises a failure
+                    if on_done is not None:
+                        shard_fasta, _, shard_tblout = searches[done]
+                        on_done(shard_fasta, shard_tblout)
+
+            merge_tblouts(
+                shard_tblouts,
+                output_tsv,
+                shard_fastas,
+                fasta,
+                models=None if cmscan else model_names(reference_cms),
+                settings={"-o": str(output), "--cpu": str(threads)},
+            )
+            with open(output, "wb") as out:
+                for shard_output in shard_outputs:
+                    with open(shard_output, "rb") as f:
+                        shutil.copyfileobj(f, out)
+
+    # a hit spanning the junction has at most one base fewer than the longest hit on either side of it
+    window = max_hit_length(reference_cms) - 1 if junctions else 0
+
+    def search(
+        fasta: Path,
+        output: Path,
+        output_tsv: Path,
+        options: str,
+        database_size: Optional[float] = None,
+        on_done: Optional[ShardCallback] = None,
+    ):
+        if not junctions:
+            search_linear(fasta, output, output_tsv, options, database_size, on_done)
+            return
+
+        with tempfile.TemporaryDirectory(
+            prefix="vdsearch_junctions_", dir=Path(output_tsv).parent
+        ) as tmpdir:
+            workdir = Path(tmpdir)
+            windows = workdir / "junctions.fasta"
+            total_seqs, total_bases = ws.junction_windows(
+                str(fasta), str(windows), max(window, 1), JUNCTION_SUFFIX
+            )
+            if not total_seqs:
+                raise click.ClickException(f"{fasta} has no sequences to search.")
+            if database_size is None:
+                database_size = total_bases * 2 / 1e6
+
+            linear_output = workdir / "linear.out"
+            linear_tblout = workdir / "linear.tblout"
+            search_linear(fasta, linear_output, linear_tblout, options, database_size)
+            window_output = workdir / "windows.out"
+            window_tblout = workdir / "windows.tblout"
+            junction_tblout = workdir / "junctions.tblout"
+            # sequences of a single base have no junction to search
+            if windows.stat().st_size:
+                search_linear(
+                    windows, window_output, window_tblout, options, database_size
+                )
+                spanning = map_junction_hits(window_tblout, junction_tblout)
+                logging.debug(f"Found {spanning:,} hits spanning the junctions.")
+            else:
+                window_output.write_bytes(b"")
+                junction_tblout.write_text("")
+            merge_tblouts(
+                [linear_tblout, junction_tblout],
+                output_tsv,
+                [fasta],
+                fasta,
+                models=model_names(reference_cms),
+                settings={"-o": str(output)},
+            )
+            with open(output, "wb") as out:
+                for part in [linear_output, window_output]:
+                    with open(part, "rb") as f:
+                        shutil.copyfileobj(f, out)
+        if on_done is not None:
+            on_done(fasta, output_tsv)
+
+    def triage_search(
+        fasta: Path,
+        output: Path,
+        output_tsv: Path,
+        database_size: Optional[float] = None,
+        on_done: Optional[ShardCallback] = None,
+    ):
+        with tempfile.TemporaryDirectory(
+            prefix="vdsearch_triage_", dir=Path(output_tsv).parent
+        ) as tmpdir:
+            workdir = Path(tmpdir)
+
+            # the sample for the audit is picked up front since this is also how we learn the size of the database
+            audit_fasta = workdir / "audit.fasta"
+            total_seqs, total_bases, audited = ws.sample_seqs(
+                str(fasta), str(audit_fasta), triage_audit
+            )
+            if not total_seqs:
+                raise click.ClickException(f"{fasta} has no sequences to search.")
+            # every pass uses the size of the whole input so that the E-values are the same as without triage
+            if database_size is None:
+                database_size = total_bases * 2 / 1e6
+
+            triage_output = workdir / "triage.out"
+            triage_tblout = workdir / "triage.tblout"
+            search(
+                fasta,
+                triage_output,
+                triage_tblout,
+                f"--hmmonly -E {triage_evalue} ",
+                database_size,
+            )
+            candidates = {target for target, _ in tblout_hits(triage_tblout)}
+            logging.info(
+                f"HMM-only triage kept {len(candidates):,} of {total_seqs:,} sequences "
+                f"({len(candidates) / total_seqs:.1%}) for the full CM search."
+            )
+
+            if candidates:
+                if on_done is not None:
+                    # the sequences that triage discarded have no hits, so they're done already
+                    discarded = [
+                        seq_id
+                        for seq_id in ws.record_ids(str(fasta))
+                        if seq_id not in candidates
+                    ]
+                    if discarded:
+                        discarded_fasta = workdir / "discarded.fasta"
+                        discarded_tblout = workdir / "discarded.tblout"
+                        ws.write_seqs(str(fasta), str(discarded_fasta), discarded)
+                        discarded_tblout.write_text("")
+                        on_done(discarded_fasta, discarded_tblout)
+                candidates_fasta = workdir / "candidates.fasta"
+                ws.write_seqs(str(fasta), str(candidates_fasta), sorted(candidates))
+                search(
+                    candidates_fasta,
+                    output,
+                    output_tsv,
+                    thresholds,
+                    database_size,
+                    on_done,
+                )
+                # point the comments at the original input like they would be without triage
+                merge_tblouts([output_tsv], output_tsv, [candidates_fasta], fasta)
+            else:
+                # cmsearch won't read an empty file, so the (hitless) triage results stand in for the full search's,
+                # with the settings of the full search
+                full_settings: Dict[str, Optional[str]] = {
+                    "-o": str(output),
+                    "--hmmonly": None,
+                    "-E": None,
+                    **parse_options(thresholds.split()),
+                }
+                merge_tblouts(
+                    [triage_tblout], output_tsv, [fasta], fasta, settings=full_settings
+                )
+                with open(output, "w") as out:
+                    out.write(
+                        f"# No sequences passed the HMM-only triage (--hmmonly -E {triage_evalue}), "
+                        "so this is the output of the triage search.\n"
+                    )
+                    with open(triage_output) as f:
+                        shutil.copyfileobj(f, out)
+                if on_done is not None:
+                    on_done(fasta, output_tsv)
+
+            # search a random sample of everything with the full CM to see what the triage threw away
+            if audited:
+                audit_tblout = workdir / "audit.tblout"
+                search(
+                    audit_fasta,
+                    workdir / "audit.out",
+                    audit_tblout,
+                    thresholds,
+                    database_size,
+                )
+                missed = [
+                    target
+                    for target, _ in tblout_hits(audit_tblout)
+                    if target not in candidates
+                ]
+                report = (
+                    f"Full CM search of a random {triage_audit:.1%} of the sequences ({audited:,}) found "
+                    f"{len(missed):,} hits in {len(set(missed)):,} sequences that triage discarded"
+                )
+                if missed:
+                    logging.warning(
+                        f"{report}, so triage likely missed about {len(missed) / triage_audit:,.0f} hits in total."
+                    )
+                else:
+                    logging.info(f"{report}.")
+
+    def search_all(
+        fasta: Path,
+        output: Path,
+        output_tsv: Path,
+        database_size: Optional[float] = None,
+        on_done: Optional[ShardCallback] = None,
+    ):
+        if triage:
+            triage_search(fasta, output, output_tsv, database_size, on_done)
+        else:
+            search(fasta, output, output_tsv, thresholds, database_size, on_done)
+
+    on_done = _shard_callback.get()
+    logging.info(f"Searching {fasta} using {base_command}")
+    if cache is None:
+        search_all(fasta, output, output_tsv, on_done=on_done)
+        logging.done(f"Done searching for ribozymes using {base_command}.")  # type: ignore
+        return
+
+    help_text = subprocess.run(
+        [base_command, "-h"], capture_output=True, text=True
+    ).stdout
+    version = next((line for line in help_text.splitlines() if "INFERNAL" in line), "")
+    ids, digests, total_bases = ws.sequence_ids(str(fasta))
+    if not ids:
+        raise click.ClickException(f"{fasta} has no sequences to search.")
+    database_size = total_bases * 2 / 1e6
+    settings = fingerprint(
+        reference_cms,
+        base_command,
+        version,
+        thresholds,
+        f"filter tier {filter_tier(database_size)}",
+        f"triage {triage_evalue}" if triage else "",
+        "junctions" if junctions else "",
+    )
+    # without score cutoffs, which hits are reported and included depends on their E-values and so the search space
+    evalue_thresholds = not (cut_ga or cut_tc or cut_nc)
+    max_evalue = evalue if evalue else DEFAULT_MAX_EVALUE
+
+    with HitCache(cache, settings) as hit_cache:
+        cached = hit_cache.lookup(digests)
+
+        served: List[str] = []
+        missing: Dict[str, str] = {}  # ID to digest
+        for seq_id, digest in zip(ids, digests):
+            entry = cached.get(digest)
+            # hits that weren't reported in a bigger search might be in a smaller one
+            if entry is None or (
+                evalue_thresholds and database_size < entry[0] * (1 - 1e-9)
+            ):
+                missing[seq_id] = digest
+                continue
+            for row in entry[1]:
+                rescaled = rescale_row(
+                    row,
+                    seq_id,
+                    database_size / entry[0],
+                    max_evalue if evalue_thresholds else None,
+                )
+                if rescaled is not None:
+                    served.append(rescaled)
+        served_seqs = len(ids) - len(missing)
+        logging.info(f"{served_seqs:,} of {len(ids):,} sequences are in the cache.")
+
+        with tempfile.TemporaryDirectory(
+            prefix="vdsearch_cache_", dir=Path(output_tsv).parent
+        ) as tmpdir:
+            workdir = Path(tmpdir)
+            cached_tblout = workdir / "cached.tblout"
+            cached_tblout.write_text("".join(served))
+            # the hits taken from the cache are done before anything is searched
+            if on_done is not None and served_seqs:
+                if missing:
+                    served_fasta = workdir / "served.fasta"
+                    ws.write_seqs(
+                        str(fasta),
+                        str(served_fasta),
+                        [seq_id for seq_id in ids if seq_id not in missing],
+                    )
+                    on_done(served_fasta, cached_tblout)
+                else:
+                    on_done(fasta, cached_tblout)
+
+            missing_fasta = workdir / "missing.fasta"
+            searched_tblout = workdir / "searched.tblout"
+            if missing:
+                ws.write_seqs(str(fasta), str(missing_fasta), list(missing))
+                search_all(
+                    missing_fasta, output, searched_tblout, database_size, on_done
+                )
+
+                rows = defaultdict(list)
+                comments = []
+                with open(searched_tblout) as f:
+                    for line in f:
+                        if line.startswith("#"):
+                            comments.append(line)
+                        else:
+                            rows[line.split(maxsplit=1)[0]].append(line)
+                # sequences without hits are cached too since they're most of them
+                hit_cache.store(
+                    {digest: rows[seq_id] for seq_id, digest in missing.items()},
+                    database_size,
+                )
+                hit_cache.store_comments("".join(comments))
+            else:
+                # there's no search to take the comments from, so they come from the last one
+                searched_tblout.write_text(
+                    re.sub(
+                        r"^(# Target file:\s*).*$",
+                        lambda match: match.group(1) + str(fasta),
+                        hit_cache.comments() or "",
+                        flags=re.MULTILINE,
+                    )
+                )
+                # the header of the text output is cmsearch's banner followed by the main options
+                with open(output, "w") as out:
+                    out.writelines(
+                        line + "\n"
+                        for line in help_text.splitlines()
+                        if line.startswith("#")
+                    )
+                    out.write(
+                        f"{'# query CM file:':<41}{reference_cms}\n"
+                        f"{'# target sequence database:':<41}{fasta}\n"
+                        f"{'# tabular output of hits:':<41}{output_tsv}\n"
+                        f"# {' '.join('-' * 36)}\n"
+                    )
+            # the alignments of cached hits aren't kept
+            if served_seqs:
+                with open(output, "a") as out:
+                    out.write(
+                        f"# {served_seqs:,} sequences served from the cache, alignments omitted\n"
+                    )
+
+            merge_tblouts(
+                [searched_tblout, cached_tblout],
+                output_tsv,
+                [missing_fasta],
+                fasta,
+                models=model_names(reference_cms),
+                # the comments may be from another search
+                settings={
+                    "-o": str(output),
+                    "--cpu": str(threads),
+                    "-Z": format(database_size, ".6f"),
+                },
+            )
+
+        evicted = hit_cache.evict(parse_size(cache_max_size))
+        if evicted:
+            logging.debug(
+                f"Removed {evicted:,} least recently used sequences from the cache."
+            )
     logging.done(f"Done searching for ribozymes using {base_command}.")  # type: ignore
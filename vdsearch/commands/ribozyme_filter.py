@@ -1,11 +1,17 @@
 from enum import Enum
 import logging
+import os
+import shutil
+import tempfile
 from pathlib import Path
-from typing import Dict, Literal, Optional
+from typing import Dict, List, Literal, Optional, Set, Tuple
 
+import numpy as np
 import pandas as pd
 import typer
 
+from vdsearch.cm_metadata import load_metadata
+from vdsearch.nim import write_seqs as ws
 from vdsearch.types import ReferenceCms
 
 
@@ -16,7 +22,7 @@ class CmCutoffType(str, Enum):
 
 
 def parse_cm_file(path: Path) -> Dict[str, Dict[str, float]]:
-    """Given a path to a CM file, parse it and return a dictionary of the form:
+    """Given a path to a CM file, return the cutoffs of each model in a dictionary of the form:
 
     ```
     {
@@ -26,54 +32,18 @@ def parse_cm_file(path: Path) -> Dict[str, Dict[str, float]]:
             'NC': 32.3,
     }
     `
+
+    The cutoffs are read from the metadata sidecar of the file, which is only rebuilt if the file changed.
     """
-    cutoffs = {}
-
-    with path.open() as f:
-        last_name = ""
-        last_cutoff = {
-            "GA": 0.0,
-            "TC": 0.0,
-            "NC": 0.0,
-        }
-
-        for line in f:
-            if "INFERNAL" in line:
-                if last_name:
-                    cutoffs[last_name] = last_cutoff
-
-                last_name = ""
-                last_cutoff = {
-                    "GA": 0.0,
-                    "TC": 0.0,
-                    "NC": 0.0,
-                }
-            elif line.startswith("NAME"):
-                last_name = line.split()[1]
-            elif line.startswith("GA"):
-                last_cutoff["GA"] = float(line.split()[1])
-            elif line.startswith("TC"):
-                last_cutoff["TC"] = float(line.split()[1])
-            elif line.startswith("NC"):
-                last_cutoff["NC"] = float(line.split()[1])
-
-        # at the end, we need to add the last one
-        cutoffs[last_name] = last_cutoff
-    return cutoffs
+    return {
+        name: {cutoff: model[cutoff] for cutoff in ("GA", "TC", "NC")}
+        for name, model in load_metadata(path).items()
+    }
 
 
-def ribozyme_filter(
-    infernal_tblout: Path,
-    rnamotif_txt: Path = None,
-    rnamotif_name: str = None,
-    output_tsv: Optional[Path] = None,
-    use_cm_cutoff: bool = True,
-    cm_file: Optional[Path] = None,
-    cm_cutoff_type: Literal["GA", "TC", "NC"] = "GA",
-    use_evalue_cutoff: bool = True,
-    max_evalue: float = 0.01,
-):
-    ribozymes = pd.read_csv(
+def read_tblout(infernal_tblout: Path) -> pd.DataFrame:
+    """Read the hits in an Infernal tabular output."""
+    return pd.read_csv(
         infernal_tblout,
         delim_whitespace=True,
         comment="#",
@@ -90,130 +60,128 @@ def ribozyme_filter(
             "evalue",
             "inc",
         ],
+        # there are only a few distinct values of each, so this saves a lot of memory for large searches
+        dtype={"seq_id": "category", "ribozyme": "category", "strand": "category"},
     )
-    if ribozymes.shape[0] > 0:
-        logging.info(
-            f"Analyzing {ribozymes.shape[0]} ribozymes in {ribozymes.seq_id.unique().shape[0]} sequences to find viroid-like sequences..."
-        )
-    else:
-        logging.done("No ribozymes present to analyze.")  # type: ignore
-        return
 
-    cutoffs = parse_cm_file(cm_file) if use_cm_cutoff and cm_file else {}
-
-    rz_plus = set()
-    rz_minus = set()
-    rz_significant = set()
-
-    for rz_name, rz_df in ribozymes.groupby(["ribozyme"]):
-
-        # short circuit if we aren't doing verbose output
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
-            logging.debug(
-                f"Analyzing {rz_name=}. "
-                f"{rz_df.shape[0]} sequences, "
-                f"{rz_df.query(f'evalue < {max_evalue}').shape[0]} significant."
-            )
 
-        # all seqs with ribozymes above cutoffs are counted as significant
-        if use_cm_cutoff and cutoffs:
-            rz_plus.update(
-                rz_df.query(
-                    f"strand == '+' & score > {cutoffs[rz_name][cm_cutoff_type]}"
-                ).seq_id
-            )
-            rz_minus.update(
-                rz_df.query(
-                    f"strand == '-' & score > {cutoffs[rz_name][cm_cutoff_type]}"
-                ).seq_id
-            )
-            # signficant ribozymes are either above cutoff with extra low evalue
-            rz_significant.update(
-                rz_df.query(f"score > {cutoffs[rz_name][cm_cutoff_type]}").seq_id
-            )
+def read_rnamotif(rnamotif_txt: Path, name: Optional[str] = None) -> pd.DataFrame:
+    """
+    Read the hits in a pruned RNAmotif output. Their `descriptor` is `name` if it's given. Otherwise, it's read from
+    the sixth field that `vdsearch rnamotif` tags each hit with.
+    """
+    columns = ["seq_id", "score", "strand", "from_", "length"]
+    if name is None:
+        columns.append("descriptor")
+    rnamotifs = pd.read_csv(
+        rnamotif_txt,
+        delim_whitespace=True,
+        comment="#",
+        header=None,
+        names=columns,
+        usecols=list(range(len(columns))),
+        # the same as the categories of the Infernal hits even if the IDs look like numbers
+        dtype={"seq_id": str, "descriptor": "category"},
+    )
+    if name is not None:
+        rnamotifs["descriptor"] = name
+    return rnamotifs
+
+
+def classify(
+    ribozymes: pd.DataFrame,
+    rnamotifs: Optional[pd.DataFrame],
+    cutoffs: Dict[str, Dict[str, float]],
+    cm_cutoff_type: Literal["GA", "TC", "NC"],
+    use_evalue_cutoff: bool,
+    max_evalue: float,
+) -> Tuple[pd.DataFrame, Set[str], Set[str]]:
+    """
+    Find the viroid-like sequences among the hits of `ribozymes` and `rnamotifs`. Only the hits of a sequence matter
+    for whether it's viroid-like, so this can be run on the hits of any subset of the sequences.
 
-        if use_evalue_cutoff:
-            # we will also use the evalue cutoff to determine if a ribozyme is present
-            rz_plus.update(
-                rz_df.query(
-                    f"strand == '+' & evalue < {max_evalue ** (0.5 if max_evalue < 1 else 2)}"
-                ).seq_id
-            )
-            rz_minus.update(
-                rz_df.query(
-                    f"strand == '-' & evalue < {max_evalue ** (0.5 if max_evalue < 1 else 2)}"
-                ).seq_id
-            )
-            rz_significant.update(rz_df.query(f"evalue < {max_evalue}").seq_id)
-
-    # Parse and add RNAmotif hits
-    if rnamotif_txt and rnamotif_txt.exists():
-        rnamotifs = pd.read_csv(
-            rnamotif_txt,
-            delim_whitespace=True,
-            comment="#",
-            header=None,
-            names=["seq_id", "score", "strand", "from_", "length"],
-            usecols=[0, 1, 2, 3, 4],
+    Returns the hits, including the RNAmotif ones, with a `symmetric` column that is set for the viroid-like sequences,
+    and the IDs of the viroid-like sequences with one ribozyme and with two.
+    """
+    # each hit is classified with boolean masks over the whole table rather than family by family
+    plus_strand = (ribozymes.strand == "+").to_numpy()
+    minus_strand = (ribozymes.strand == "-").to_numpy()
+    plus = np.zeros(ribozymes.shape[0], dtype=bool)
+    minus = np.zeros(ribozymes.shape[0], dtype=bool)
+    significant = np.zeros(ribozymes.shape[0], dtype=bool)
+
+    # all seqs with ribozymes above cutoffs are counted as significant
+    if cutoffs:
+        cutoff_table = pd.Series(
+            {name: cutoff[cm_cutoff_type] for name, cutoff in cutoffs.items()},
+            dtype=float,
+        )
+        # families without a cutoff are never above it
+        cutoff = (
+            ribozymes.ribozyme.astype(object)
+            .map(cutoff_table)
+            .to_numpy(dtype=float, na_value=np.nan)
         )
-        rz_plus.update(rnamotifs.query("strand == 0").seq_id)
-        rz_minus.update(rnamotifs.query("strand == 1").seq_id)
+        above_cutoff = ribozymes.score.to_numpy() > cutoff
+        plus |= plus_strand & above_cutoff
+        minus |= minus_strand & above_cutoff
+        # signficant ribozymes are either above cutoff with extra low evalue
+        significant |= above_cutoff
+
+    if use_evalue_cutoff:
+        # we will also use the evalue cutoff to determine if a ribozyme is present
+        evalues = ribozymes.evalue.to_numpy()
+        below_strict = evalues < max_evalue ** (0.5 if max_evalue < 1 else 2)
+        plus |= plus_strand & below_strict
+        minus |= minus_strand & below_strict
+        significant |= evalues < max_evalue
+
+    seq_ids = ribozymes.seq_id
+    rz_plus = set(seq_ids[plus].unique())
+    rz_minus = set(seq_ids[minus].unique())
+    rz_significant = set(seq_ids[significant].unique())
+
+    # Add RNAmotif hits
+    if rnamotifs is not None:
+        rz_plus.update(rnamotifs.seq_id[rnamotifs.strand == 0])
+        rz_minus.update(rnamotifs.seq_id[rnamotifs.strand == 1])
         # note that there's no add to rz_significant here
         # this is since I'm not sure if the RNAmotif hits are significant
 
-        # merge the rnamotifs df into the ribozymes df
-        # iterate over rnamotifs
-        for rnamotif in rnamotifs.itertuples(index=False):
-            ribozymes = pd.concat(
-                [
-                    ribozymes,
-                    pd.DataFrame(
-                        [
-                            {
-                                "seq_id": rnamotif.seq_id,
-                                "ribozyme": rnamotif_name,
-                                "strand": "+" if rnamotif.strand == 0 else "-",
-                                "evalue": max_evalue**0.5,
-                                "from": rnamotif.from_,
-                                "to": rnamotif.from_
-                                + (
-                                    rnamotif.length * 1
-                                    if rnamotif.strand == 0
-                                    else -1 * rnamotif.length
-                                ),
-                            }
-                        ]
-                    ),
-                ],
-                ignore_index=True,
-            )
+        # merge the rnamotifs df into the ribozymes df all at once
+        on_plus = rnamotifs.strand == 0
+        ribozymes = pd.concat(
+            [
+                ribozymes.astype(
+                    {"seq_id": object, "ribozyme": object, "strand": object}
+                ),
+                pd.DataFrame(
+                    {
+                        "seq_id": rnamotifs.seq_id,
+                        "ribozyme": rnamotifs.descriptor.astype(object),
+                        "strand": np.where(on_plus, "+", "-"),
+                        "evalue": max_evalue**0.5,
+                        "from": rnamotifs.from_,
+                        "to": rnamotifs.from_
+                        + np.where(on_plus, rnamotifs.length, -rnamotifs.length),
+                    }
+                ),
+            ],
+            ignore_index=True,
+        ).astype({"seq_id": "category", "ribozyme": "category", "strand": "category"})
 
     # any sequence with a ribozyme match (even weaker than cutoff) is counted as significant if there are two
     double_rz_ids = rz_plus.intersection(rz_minus)
     # all sequences with a significant ribozyme
     single_rz_ids = rz_significant.difference(double_rz_ids)
-    # union of the two
-    ribozy_likes_ids = double_rz_ids | single_rz_ids
-
-    if len(ribozy_likes_ids) == 0:
-        logging.done("No viroid-like sequences found by ribozyme search.")  # type: ignore
-        return
-
-    logging.done(  # type: ignore
-        f"Found {len(ribozy_likes_ids)} viroid-like sequences with ribozymes. "
-        f"{len(single_rz_ids)} with one ribozyme, {len(double_rz_ids)} with two ribozymes."
-    )
-
-    logging.debug("Generating output dataframes...")
 
     # add categorical information about how many ribozymes are in the sequence
-    ribozymes.loc[ribozymes["seq_id"].isin(double_rz_ids), "symmetric"] = True
-    ribozymes.loc[ribozymes["seq_id"].isin(single_rz_ids), "symmetric"] = False
+    ribozymes.loc[ribozymes.seq_id.isin(double_rz_ids), "symmetric"] = True
+    ribozymes.loc[ribozymes.seq_id.isin(single_rz_ids), "symmetric"] = False
+    return ribozymes, single_rz_ids, double_rz_ids
 
-    single_rzs = ribozymes.loc[ribozymes.seq_id.isin(single_rz_ids)]
-    double_rzs = ribozymes.loc[ribozymes.seq_id.isin(double_rz_ids)]
-    ribozy_likes = ribozymes.loc[ribozymes.seq_id.isin(ribozy_likes_ids)]
 
+def _results(ribozy_likes: pd.DataFrame, output_tsv: Optional[Path]):
     if ribozy_likes.shape[0] and output_tsv:
         ribozy_likes.sort_values(by="evalue").to_csv(
             output_tsv,
@@ -221,13 +189,197 @@ def ribozyme_filter(
             index=False,
         )
 
+    symmetric = ribozy_likes.symmetric.astype(bool)
     return {
-        "single_rzs": single_rzs,
-        "double_rzs": double_rzs,
+        "single_rzs": ribozy_likes.loc[~symmetric],
+        "double_rzs": ribozy_likes.loc[symmetric],
         "ribozy_likes": ribozy_likes,
     }
 
 
+def _log_found(single_rz_ids: Set[str], double_rz_ids: Set[str]):
+    logging.done(  # type: ignore
+        f"Found {len(single_rz_ids) + len(double_rz_ids)} viroid-like sequences with ribozymes. "
+        f"{len(single_rz_ids)} with one ribozyme, {len(double_rz_ids)} with two ribozymes."
+    )
+
+
+def ribozyme_filter(
+    infernal_tblout: Path,
+    rnamotif_txt: Path = None,
+    rnamotif_name: str = None,
+    output_tsv: Optional[Path] = None,
+    use_cm_cutoff: bool = True,
+    cm_file: Optional[Path] = None,
+    cm_cutoff_type: Literal["GA", "TC", "NC"] = "GA",
+    use_evalue_cutoff: bool = True,
+    max_evalue: float = 0.01,
+):
+    ribozymes = read_tblout(infernal_tblout)
+    rnamotifs = (
+        read_rnamotif(rnamotif_txt, rnamotif_name)
+        if rnamotif_txt and rnamotif_txt.exists()
+        else None
+    )
+    if ribozymes.shape[0] > 0:
+        logging.info(
+            f"Analyzing {ribozymes.shape[0]} ribozymes in {ribozymes.seq_id.nunique()} sequences to find viroid-like sequences..."
+        )
+    # the RNAmotif hits are enough to find viroid-like sequences on their own
+    elif rnamotifs is not None and rnamotifs.shape[0] > 0:
+        logging.info(
+            f"Analyzing {rnamotifs.shape[0]} RNAmotif hits to find viroid-like sequences..."
+        )
+    else:
+        logging.done("No ribozymes present to analyze.")  # type: ignore
+        return
+
+    cutoffs = parse_cm_file(cm_file) if use_cm_cutoff and cm_file else {}
+
+    # short circuit if we aren't doing verbose output
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        counts = ribozymes.groupby("ribozyme", observed=True).evalue.agg(
+            total="size", significant=lambda evalues: (evalues < max_evalue).sum()
+        )
+        for rz_name, rz_counts in counts.iterrows():
+            logging.debug(
+                f"Analyzing {rz_name=}. "
+                f"{rz_counts.total} sequences, "
+                f"{rz_counts.significant} significant."
+            )
+
+    ribozymes, single_rz_ids, double_rz_ids = classify(
+        ribozymes,
+        rnamotifs,
+        cutoffs,
+        cm_cutoff_type,
+        use_evalue_cutoff,
+        max_evalue,
+    )
+
+    if not single_rz_ids and not double_rz_ids:
+        logging.done("No viroid-like sequences found by ribozyme search.")  # type: ignore
+        return
+
+    _log_found(single_rz_ids, double_rz_ids)
+    logging.debug("Generating output dataframes...")
+    return _results(ribozymes.loc[ribozymes.symmetric.notna()], output_tsv)
+
+
+class RibozymeStream:
+    """
+    Find the viroid-like sequences among the hits of an Infernal search while it's still running, with the same
+    classification as `ribozyme_filter`.
+
+    Pass `add_shard` to `vdsearch.commands.infernal.on_shard_done` while searching `fasta` so that the hits of each
+    shard are classified as soon as its search is done. The viroid-like sequences of each shard are appended to
+    `output_fasta` right away. `finish` then rewrites it in the order of `fasta`, writes `output_tsv`, and returns the
+    same tables as `ribozyme_filter` (but hits with the same E-value may be in a different order).
+    """
+
+    def __init__(
+        self,
+        fasta: Path,
+        output_fasta: Path,
+        output_tsv: Optional[Path] = None,
+        rnamotif_txt: Optional[Path] = None,
+        rnamotif_name: Optional[str] = None,
+        use_cm_cutoff: bool = True,
+        cm_file: Optional[Path] = None,
+        cm_cutoff_type: Literal["GA", "TC", "NC"] = "GA",
+        use_evalue_cutoff: bool = True,
+        max_evalue: float = 0.01,
+    ):
+        self.fasta = fasta
+        self.output_fasta = output_fasta
+        self.output_tsv = output_tsv
+        self.rnamotifs = (
+            read_rnamotif(rnamotif_txt, rnamotif_name)
+            if rnamotif_txt and rnamotif_txt.exists()
+            else None
+        )
+        self.cutoffs = parse_cm_file(cm_file) if use_cm_cutoff and cm_file else {}
+        self.cm_cutoff_type = cm_cutoff_type
+        self.use_evalue_cutoff = use_evalue_cutoff
+        self.max_evalue = max_evalue
+
+        self.total_hits = 0
+        self.single_rz_ids: Set[str] = set()
+        self.double_rz_ids: Set[str] = set()
+        self.ribozy_likes: List[pd.DataFrame] = []
+        # truncated here so that the shards can be appended to it
+        self.output_fasta.write_bytes(b"")
+
+    def add_shard(self, fasta: Path, tblout: Path):
+        """Classify the sequences in `fasta`, all of whose hits are in `tblout`."""
+        ribozymes = read_tblout(tblout)
+        self.total_hits += ribozymes.shape[0]
+        rnamotifs = self.rnamotifs
+        if rnamotifs is not None:
+            ids = ws.record_ids(str(fasta))
+            rnamotifs = rnamotifs.loc[rnamotifs.seq_id.isin(ids)]
+            self.total_hits += rnamotifs.shape[0]
+        ribozymes, single_rz_ids, double_rz_ids = classify(
+            ribozymes,
+            rnamotifs,
+            self.cutoffs,
+            self.cm_cutoff_type,
+            self.use_evalue_cutoff,
+            self.max_evalue,
+        )
+        self.single_rz_ids |= single_rz_ids
+        self.double_rz_ids |= double_rz_ids
+        if not single_rz_ids and not double_rz_ids:
+            logging.debug(f"No viroid-like sequences in {fasta}.")
+            return
+        self.ribozy_likes.append(ribozymes.loc[ribozymes.symmetric.notna()])
+
+        with tempfile.NamedTemporaryFile(
+            prefix="vdsearch_rzs_", suffix=".fasta", dir=self.output_fasta.parent
+        ) as records:
+            ws.write_seqs(
+                str(fasta), records.name, sorted(single_rz_ids | double_rz_ids)
+            )
+            with open(self.output_fasta, "ab") as out:
+                shutil.copyfileobj(records, out)
+        logging.debug(
+            f"Found {len(single_rz_ids) + len(double_rz_ids)} viroid-like sequences in {fasta}."
+        )
+
+    def finish(self):
+        """
+        Write the hits of the viroid-like sequences to `output_tsv` once every shard has been added, and put their
+        records in the same order as a run that didn't stream them would.
+        """
+        if not self.ribozy_likes:
+            if not self.total_hits:
+                logging.done("No ribozymes present to analyze.")  # type: ignore
+            else:
+                logging.done("No viroid-like sequences found by ribozyme search.")  # type: ignore
+            return
+
+        _log_found(self.single_rz_ids, self.double_rz_ids)
+        # the shards finish in any order, so the records are written again in the order of the input
+        partial = self.output_fasta.with_name(
+            f"{self.output_fasta.name}.{os.getpid()}.tmp.fasta"
+        )
+        ws.write_seqs(
+            str(self.fasta),
+            str(partial),
+            sorted(self.single_rz_ids | self.double_rz_ids),
+        )
+        partial.replace(self.output_fasta)
+
+        ribozy_likes = pd.concat(
+            [
+                shard.astype({"seq_id": object, "ribozyme": object, "strand": object})
+                for shard in self.ribozy_likes
+            ],
+            ignore_index=True,
+        ).astype({"seq_id": "category", "ribozyme": "category", "strand": "category"})
+        return _results(ribozy_likes, self.output_tsv)
+
+
 # We need to use a wrapper since, for some reason, returning values causes their return values to be printed
 def ribozyme_filter_wrapper(
     infernal_tblout: Path = typer.Argument(
@@ -240,10 +392,11 @@ def ribozyme_filter_wrapper(
     ),
     rnamotif_txt: Path = typer.Option(
         None,
-        help="Path to pruned RNAmotif .txt file for viroid-like sequences. Note that e-values will be fixed at the square root of --max-evalue. Concatenated outputs of RNAmotif are not supported.",
+        help="Path to pruned RNAmotif .txt file for viroid-like sequences, such as the output of `vdsearch rnamotif`. Note that e-values will be fixed at the square root of --max-evalue.",
     ),
     rnamotif_name: str = typer.Option(
-        None, help="Name of motif to use in the ribozyme column of the output"
+        None,
+        help="Name of motif to use in the ribozyme column of the output. Needed if the RNAmotif hits aren't tagged with their descriptor by `vdsearch rnamotif`.",
     ),
     output_tsv: Path = typer.Option(
         None,
@@ -1,29 +1,95 @@
 import logging
+import math
 import os
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List
 from pkg_resources import resource_filename  # type: ignore
 
 import click
 import typer
-from vdsearch.types import FASTA
+from vdsearch.nim import write_seqs as ws
+from vdsearch.types import FASTA, Threads
 from vdsearch.utils import check_executable_exists, typer_unpacker
 
 
+def bundled_descriptors() -> List[Path]:
+    """The RNAmotif descriptors that ship with vdsearch, one for each type of hammerhead ribozyme."""
+    return sorted(Path(resource_filename("vdsearch", "data/rnamotif")).glob("*.descr"))
+
+
+def tag_hits(rmfmt_output: Path, descriptor: str, out, comments: bool = True):
+    """
+    Copy the hits formatted by `rmfmt` to `out` with the name of their `descriptor` inserted as the sixth field, after
+    the sequence ID, score, strand, position, and length. Comments are only copied if `comments` is set.
+    """
+    with open(rmfmt_output) as f:
+        for line in f:
+            if line.startswith("#"):
+                if comments:
+                    out.write(line)
+                continue
+            fields = line.split(maxsplit=5)
+            if len(fields) < 5:
+                continue
+            out.write(" ".join([*fields[:5], descriptor, *fields[5:]]).rstrip() + "\n")
+
+
+def tagged_with(rnamotif_output: Path, descrs: List[Path]) -> bool:
+    """
+    Check that the hits in `rnamotif_output` are tagged with one of `descrs` by `tag_hits`. Outputs of older versions
+    of vdsearch have part of the structure in the sixth field instead. An output without any hits counts as tagged.
+    """
+    names = {descr.stem for descr in descrs}
+    with open(rnamotif_output) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.split(maxsplit=6)
+            if len(fields) < 5:
+                continue
+            return len(fields) > 5 and fields[5] in names
+    return True
+
+
 @typer_unpacker
 def rnamotif(
     fasta: Path = FASTA,
-    descr: Path = typer.Argument(..., file_okay=True, dir_okay=False, exists=True),
+    descrs: List[Path] = typer.Argument(
+        ...,
+        help="Paths to RNAmotif descriptors to search for",
+        file_okay=True,
+        dir_okay=False,
+        exists=True,
+    ),
     output: Path = typer.Argument(
         ...,
         help="Path to TSV output",
         file_okay=True,
         dir_okay=True,
     ),
+    threads: int = Threads,
+    shards: int = typer.Option(
+        0,
+        min=0,
+        help="Number of parts to split the input into, each of which is searched for every descriptor at once. By default, there are enough for every thread to have a search.",
+    ),
 ):
     """
     Run RNAmotif search and format for provided motif descriptions.
 
+    The hits of all the descriptors are merged into one output with the name of the descriptor that found each hit
+    (its file name without the extension) inserted after the length of the hit. That's where `ribozyme-filter` reads
+    it from unless it's given **--rnamotif-name**.
+
+    ## Performance notes
+
+    RNAmotif is single-threaded, so the input is split into **--shards** parts with about the same number of bases
+    and every part is searched for every descriptor, running up to **--threads** searches at once. The hits are in
+    the order of the descriptors, then of the shards.
+
     ## Note
 
     You must have an environment variable `EFNDATA` set to the path of the `efndata` directory from RNAmotif.
@@ -58,21 +124,71 @@ def rnamotif(
             "Please set the environment variable `EFNDATA` to the path of the `efndata` directory from RNAmotif."
         )
 
-    command = (
-        f"EFNDATA={efndata} rnamotif "
-        f"-descr {descr} {fasta} 2>/dev/null | "
-        f"rmprune | rmfmt > {output}"
-    )
-    logging.info(f"Searching for {descr.stem} in {fasta} using RNAmotif")
-    logging.debug(f"{command=}")
-    try:
-        subprocess.run(
-            command,
-            shell=True,
-            check=True,
-        )
-    except subprocess.CalledProcessError as error:
-        raise click.Abort(
-            f"RNAmotif failed with exit code {error.returncode}",
+    if shards == 0:
+        shards = max(math.ceil(threads / len(descrs)), 1)
+
+    def command(descr: Path, fasta: Path, output: Path) -> str:
+        # RNAmotif can only read plain text so compressed input is decompressed on the fly
+        decompress = ws.decompress_command(str(fasta))
+        if decompress:
+            source, fasta_arg = f"{decompress} | ", "/dev/stdin"
+        else:
+            source, fasta_arg = "", str(fasta)
+        return (
+            f"{source}EFNDATA={efndata} rnamotif "
+            f"-descr {descr} {fasta_arg} 2>/dev/null | "
+            f"rmprune | rmfmt > {output}"
         )
+
+    def run(command: str):
+        logging.debug(f"{command=}")
+        try:
+            subprocess.run(
+                command,
+                shell=True,
+                check=True,
+            )
+        except subprocess.CalledProcessError as error:
+            raise click.Abort(
+                f"RNAmotif failed with exit code {error.returncode}",
+            )
+
+    logging.info(
+        f"Searching for {', '.join(descr.stem for descr in descrs)} in {fasta} using RNAmotif"
+    )
+    with tempfile.TemporaryDirectory(
+        prefix="vdsearch_rnamotif_", dir=Path(output).parent
+    ) as tmpdir:
+        if shards == 1:
+            shard_fastas = [fasta]
+        else:
+            shard_fastas = [Path(tmpdir) / f"shard{i}.fasta" for i in range(shards)]
+            _, total_bases = ws.shard_seqs(
+                str(fasta), [str(path) for path in shard_fastas]
+            )
+            # there may be fewer sequences than shards
+            shard_fastas = [path for path in shard_fastas if path.stat().st_size]
+            logging.debug(
+                f"Split {total_bases:,} nt into {len(shard_fastas)} shards to search in parallel."
+            )
+
+        outputs = {
+            (descr, shard_fasta): Path(tmpdir) / f"{i}_{j}.txt"
+            for i, descr in enumerate(descrs)
+            for j, shard_fasta in enumerate(shard_fastas)
+        }
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            # list() re-raises the first failure
+            list(
+                executor.map(
+                    run,
+                    [command(*search, part) for search, part in outputs.items()],
+                )
+            )
+
+        with open(output, "w") as out:
+            for descr in descrs:
+                for j, shard_fasta in enumerate(shard_fastas):
+                    # the comments of the other shards are the same
+                    tag_hits(outputs[descr, shard_fasta], descr.stem, out, j == 0)
     logging.done("Done searching for ribozymes using RNAmotif.")  # type: ignore
@@ -76,9 +76,17 @@ def summarize(
         inplace=True,
     )
 
+    # IDs computed by find_circs or canonicalize while they had the final sequences in hand
+    known_ids = {}
     if circ_tsv is not None and circ_tsv.exists():
         circ_df = pd.read_csv(circ_tsv, sep="\t")
-        circ_df.drop(columns=["unit_length"], inplace=True)  # we recompute this
+        if "vdsearch_id" in circ_df.columns:
+            # the table has the full description but the FASTA reader only gives us the ID
+            ids = circ_df.seq_id.astype(str).str.split(n=1).str[0]
+            unique = ~ids.duplicated(keep=False)
+            known_ids = dict(zip(ids[unique], circ_df.vdsearch_id[unique]))
+        # we recompute the unit length and canonicalize's table has no circularity info
+        circ_df = circ_df.reindex(columns=["seq_id", "original_length", "ratio"])
     else:
         circ_df = pd.DataFrame(columns=["seq_id", "original_length", "ratio"])
 
@@ -183,8 +191,8 @@ def summarize(
 
             seq_data["source"] = source
 
-            # generate a new id based on the md5 of the canonicalized sequence
-            new_id = (
+            # generate a new id based on the hash of the canonicalized sequence, unless it was already computed
+            new_id = known_ids.get(seq_id) or (
                 "NV_"
                 + hashlib.blake2b(str(seq).encode("utf-8"), digest_size=8).hexdigest()
             )
@@ -0,0 +1,149 @@
+"""
+A persistent cache of the Infernal hits of each sequence.
+
+The same canonical circRNAs turn up in sample after sample, so their hits are kept in an SQLite database and only the
+sequences that aren't in it yet have to be searched. Entries are keyed by the `NV_` ID of the sequence (the digest of
+its uppercase sequence) and a fingerprint of the CM file and the search settings, so a cache can be shared by runs with
+different models or settings. Each entry has the tabular output rows of its sequence (possibly none) and the search
+space (`-Z`) they were found with.
+
+The least recently used entries are evicted once the cache is over its size limit. SQLite's locking lets several runs
+use the same cache at once, but only on file systems where locks work.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from vdsearch.cm_metadata import cm_fingerprint
+
+BATCH_SIZE = 500  # how many sequences to look up at once, which is under SQLite's limit on query parameters
+# roughly how many bytes an entry takes besides its rows, for the size limit
+ENTRY_OVERHEAD = 64
+
+
+def fingerprint(cm_file: Path, *settings: str) -> str:
+    """A digest of the contents of a CM file and the settings it's searched with."""
+    digest = hashlib.sha256(cm_fingerprint(cm_file).encode())
+    for setting in settings:
+        digest.update(b"\0" + setting.encode())
+    return digest.hexdigest()
+
+
+class HitCache:
+    """
+    The cached hits of one CM file and set of search settings, stored in `directory/hits.sqlite`.
+    """
+
+    def __init__(self, directory: Path, fingerprint: str):
+        directory.mkdir(parents=True, exist_ok=True)
+        # other runs may be writing to the cache, so wait for them rather than failing
+        self.connection = sqlite3.connect(directory / "hits.sqlite", timeout=600)
+        self.fingerprint = fingerprint
+        # only takes effect when the database is created, which lets it shrink after evictions
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS hits (
+                    digest TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    database_size REAL NOT NULL,
+                    rows TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (digest, fingerprint)
+                );
+                CREATE INDEX IF NOT EXISTS hits_by_last_used ON hits (last_used);
+                CREATE TABLE IF NOT EXISTS comments (
+                    fingerprint TEXT PRIMARY KEY,
+                    comments TEXT NOT NULL
+                );
+                """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, digests: Iterable[str]) -> Dict[str, Tuple[float, List[str]]]:
+        """The search space and rows of each of the `digests` that are in the cache, marking them as used."""
+        unique = list(set(digests))
+        found = {}
+        for start in range(0, len(unique), BATCH_SIZE):
+            batch = unique[start : start + BATCH_SIZE]
+            for digest, database_size, rows in self.connection.execute(
+                "SELECT digest, database_size, rows FROM hits "
+                f"WHERE fingerprint = ? AND digest IN ({', '.join('?' * len(batch))})",
+                [self.fingerprint, *batch],
+            ):
+                found[digest] = (database_size, json.loads(rows))
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE hits SET last_used = ? WHERE digest = ? AND fingerprint = ?",
+                [(time.time(), digest, self.fingerprint) for digest in found],
+            )
+        return found
+
+    def store(self, entries: Dict[str, List[str]], database_size: float):
+        """Add (or replace) the rows of each sequence, found with a search space of `database_size`."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        digest,
+                        self.fingerprint,
+                        database_size,
+                        encoded,
+                        len(encoded) + ENTRY_OVERHEAD,
+                        now,
+                    )
+                    for digest, rows in entries.items()
+                    for encoded in [json.dumps(rows)]
+                ],
+            )
+
+    def comments(self) -> Optional[str]:
+        """The comments of the last tabular output stored with `store_comments`, if any."""
+        row = self.connection.execute(
+            "SELECT comments FROM comments WHERE fingerprint = ?", [self.fingerprint]
+        ).fetchone()
+        return row[0] if row else None
+
+    def store_comments(self, comments: str):
+        """Keep the comments of a tabular output so that they can be used when every sequence is in the cache."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO comments VALUES (?, ?)",
+                [self.fingerprint, comments],
+            )
+
+    def evict(self, max_size: int) -> int:
+        """
+        Delete the least recently used entries (of any fingerprint) until the cache is at most `max_size` bytes.
+        Returns how many were deleted.
+        """
+        with self.connection:
+            deleted = self.connection.execute(
+                """
+                DELETE FROM hits WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS newer_size
+                        FROM hits
+                    )
+                    WHERE newer_size > ?
+                )
+                """,
+                [max_size],
+            ).rowcount
+        if deleted:
+            self.connection.execute("PRAGMA incremental_vacuum")
+        return deleted
@@ -10,6 +10,7 @@ import skbio
 import typer
 from numpy import product
 
+from vdsearch.nim import faidx as fx
 from vdsearch.nim import write_seqs as ws
 from vdsearch.rich_wrapper import MyTyper
 from vdsearch.types import FASTA
@@ -131,6 +132,15 @@ def clusters2fastas(
     outdir: Path = typer.Argument(
         ..., dir_okay=True, file_okay=False, help="Path to output directory"
     ),
+    max_open_files: int = typer.Option(
+        512,
+        min=1,
+        help="Maximum number of cluster files to keep open at once. Keep this below the limit from `ulimit -n`.",
+    ),
+    single_file: bool = typer.Option(
+        False,
+        help="Write every cluster into <outdir>/clusters.fasta instead, listing where each one is in <outdir>/clusters.tsv. The FASTA file must be uncompressed.",
+    ),
 ):
     """
     Write each cluster to a FASTA files.
@@ -138,20 +148,21 @@ def clusters2fastas(
     This is useful for doing per-cluster analysis with tools that expect a single FASTA file (_e.g._ alignment).
     """
 
-    # map each sequence to its cluster
-    seq_to_cluster = {}
-    cluster_df = pd.read_csv(cluster_tsv, sep="\t", names=["cluster_id", "seq_id"])
-    for cluster_id, seq_id in cluster_df.itertuples(index=False):
-        seq_to_cluster[seq_id] = cluster_id
-
-    clusters = cluster_df["cluster_id"].unique().tolist()
-
     outdir.mkdir(exist_ok=True, parents=True)
 
-    # do a call to Nim to write the FASTA files out
-    ws.write_clusters(str(fasta), str(outdir), seq_to_cluster, clusters)
+    # Nim reads the cluster TSV itself so that the mapping is never held in Python
+    clusters = ws.write_clusters(
+        str(fasta),
+        str(cluster_tsv),
+        str(outdir),
+        maxOpenFiles=max_open_files,
+        singleFile=single_file,
+    )
 
-    logging.done(f"Wrote {len(clusters)} cluster FASTA files to {outdir}")  # type: ignore
+    if single_file:
+        logging.done(f"Wrote {clusters} clusters to {outdir / 'clusters.fasta'}")  # type: ignore
+    else:
+        logging.done(f"Wrote {clusters} cluster FASTA files to {outdir}")  # type: ignore
 
 
 # rank sequences by their multiplied ribozyme E values
@@ -278,15 +289,14 @@ def realign(
 
     best_match = hit.match_id
 
-    ref: skbio.DNA
-    # get the reference
-    for seq in skbio.read(
+    # get the reference, seeking straight to it with the index (which is built the first time)
+    _, ref_seqs = fx.fetch_seqs(
         str(Path(typer.get_app_dir("vdsearch")) / "data" / "viroiddb.fasta"),
-        format="fasta",
-        constructor=skbio.DNA,
-    ):
-        if seq.metadata["id"] == best_match:
-            ref = seq
+        [best_match],
+    )
+    if not ref_seqs:
+        raise typer.BadParameter(f"{best_match} is not in ViroidDB.")
+    ref = skbio.DNA(ref_seqs[0], metadata={"id": best_match})
 
     # we have a +/- hit so we'll reverse complement the sequence
     if hit.match_qstart > hit.match_qend:
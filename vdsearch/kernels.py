@@ -0,0 +1,117 @@
+"""
+In-memory access to the Nim kernels.
+
+The commands run the kernels on files but it's often more convenient to hand them sequences directly, *e.g.* from a
+notebook or another pipeline stage. The functions here take an iterable of `(id, sequence)` pairs or the contents of
+an uncompressed FASTA file (as `bytes` or `str`) and return columns as lists or NumPy arrays.
+
+The kernels release the GIL while they run, so they can be called from several threads at once.
+"""
+
+from itertools import islice
+import sys
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+from vdsearch.nim import canonicalize as rotcanon
+from vdsearch.nim import find_circs as fc
+
+Records = Union[Iterable[Tuple[str, str]], bytes, str]
+
+CIRC_COLUMNS = ["seq_id", "monomer", "ratio", "original_length", "unit_length"]
+
+
+def _batches(records: Iterable[Tuple[str, str]], batch_size: int):
+    """Split the records into lists of IDs and sequences so that only one batch is in memory at a time."""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        ids, sequences = zip(*batch)
+        yield list(ids), list(sequences)
+
+
+def _columns(
+    names: List[str], columns: List[list], as_numpy: bool
+) -> Dict[str, Union[list, np.ndarray]]:
+    return {
+        name: np.asarray(column) if as_numpy else column
+        for name, column in zip(names, columns)
+    }
+
+
+def find_circs(
+    records: Records,
+    seed_len: int = 10,
+    min_identity: float = 0.95,
+    canonicalize: bool = True,
+    min_len: int = 1,
+    max_len: int = sys.maxsize,
+    max_monomer_len: int = sys.maxsize,
+    batch_size: int = 100_000,
+    as_numpy: bool = False,
+) -> Dict[str, Union[list, np.ndarray]]:
+    """
+    Find the circRNAs among `records` without writing them to disk.
+
+    Returns a dict with the columns `seq_id`, `monomer`, `ratio`, `original_length`, and `unit_length`, which can be
+    passed straight to `pandas.DataFrame`.
+
+    The `seq_id` of a record from a FASTA buffer is its whole header line without the `>`, description included, just
+    like in the files written by `vdsearch find-circs`. For `(id, sequence)` pairs, it's the ID as given.
+    """
+    options = dict(
+        seedLen=seed_len,
+        minIdentity=min_identity,
+        canonicalize=canonicalize,
+        minLen=min_len,
+        maxLen=max_len,
+        maxMonomerLen=max_monomer_len,
+    )
+
+    if isinstance(records, (bytes, str)):
+        return _columns(
+            CIRC_COLUMNS, list(fc.find_circs_buffer(records, **options)), as_numpy
+        )
+
+    columns: List[list] = [[] for _ in CIRC_COLUMNS]
+    for ids, sequences in _batches(records, batch_size):
+        for column, batch_column in zip(
+            columns, fc.find_circs_batch(ids, sequences, **options)
+        ):
+            column.extend(batch_column)
+    return _columns(CIRC_COLUMNS, columns, as_numpy)
+
+
+def canonicalize(
+    records: Records,
+    min_len: int = 1,
+    max_len: int = sys.maxsize,
+    batch_size: int = 100_000,
+    as_numpy: bool = False,
+) -> Dict[str, Union[list, np.ndarray]]:
+    """
+    Find the canonical rotations of `records` without writing them to disk.
+
+    Returns a dict with the columns `seq_id` and `sequence` for the records between `min_len` and `max_len` nt long.
+    The `seq_id` is set the same way as in `find_circs`.
+    """
+    if isinstance(records, (bytes, str)):
+        ids, sequences = rotcanon.canonicalize_buffer(
+            records, minLen=min_len, maxLen=max_len
+        )
+        return _columns(["seq_id", "sequence"], [ids, sequences], as_numpy)
+
+    ids = []
+    sequences = []
+    for batch_ids, batch_sequences in _batches(records, batch_size):
+        kept = [
+            i for i, seq in enumerate(batch_sequences) if min_len <= len(seq) <= max_len
+        ]
+        ids.extend(batch_ids[i] for i in kept)
+        sequences.extend(
+            rotcanon.canonicalize_batch([batch_sequences[i] for i in kept])
+        )
+    return _columns(["seq_id", "sequence"], [ids, sequences], as_numpy)
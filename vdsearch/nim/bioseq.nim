@@ -3,6 +3,10 @@ import strformat
 import hashes
 import tables
 import os
+import memfiles
+import seqio
+
+export memfiles.MemSlice, memfiles.`$`
 
 type 
   Monomer* = distinct char
@@ -183,11 +187,225 @@ proc overlapsWithStartOf*(a: Dna, b: Dna, k: int): bool {.inline.}=
       return true
   return false
 
-iterator readFasta*[T: BioString](filename: string|File): Record[T] =
+# 2-bit packed sequences
+#
+# Each base is stored in two bits, 32 to a word, with the first base in the most significant bits. Since A < C < G < T
+# both as characters and as codes, comparing words compares 32 bases at once in lexicographic order. Anything other
+# than ACGT (N, IUPAC codes, ...) is stored as an A in the words and recorded in a sorted table of escapes.
+
+const
+  basesPerWord = 32
+  invalidBase = 4'u8
+  baseLetters = ['A', 'C', 'G', 'T']
+  codeOfBase = block:
+    var table: array[char, uint8]
+    for c in char.low..char.high:
+      table[c] = invalidBase
+    for code, letter in baseLetters:
+      table[letter] = code.uint8
+      table[letter.toLowerAscii] = code.uint8
+    table
+
+type
+  PackedDna* = object
+    ## A DNA sequence packed into two bits per base. Case isn't kept.
+    words: seq[uint64]
+    len: int
+    escapes: seq[tuple[pos: int, base: char]] # bases that aren't A, C, G, or T, ordered by position
+
+proc len*(x: PackedDna): int {.inline.} = x.len
+proc hasEscapes*(x: PackedDna): bool {.inline.} = x.escapes.len > 0
+
+proc pack*(x: Dna): PackedDna =
+  ## Pack a sequence into two bits per base.
+  result.len = x.len
+  result.words = newSeq[uint64]((x.len + basesPerWord - 1) div basesPerWord)
+  for i, c in x.string:
+    var code = codeOfBase[c]
+    if code == invalidBase:
+      result.escapes.add((i, c.toUpperAscii))
+      code = 0
+    result.words[i div basesPerWord] = result.words[i div basesPerWord] or
+                                       (code.uint64 shl (62 - 2 * (i mod basesPerWord)))
+
+proc findEscape(x: PackedDna, i: int): int =
+  ## The index of the escape at position `i` or -1 if there isn't one.
+  var lo = 0
+  var hi = x.escapes.high
+  while lo <= hi:
+    let mid = (lo + hi) div 2
+    if x.escapes[mid].pos == i:
+      return mid
+    elif x.escapes[mid].pos < i:
+      lo = mid + 1
+    else:
+      hi = mid - 1
+  return -1
+
+proc code(x: PackedDna, i: int): uint8 {.inline.} =
+  ((x.words[i div basesPerWord] shr (62 - 2 * (i mod basesPerWord))) and 3).uint8
+
+proc `[]`*(x: PackedDna, i: int): char =
+  if x.hasEscapes:
+    let escape = x.findEscape(i)
+    if escape != -1:
+      return x.escapes[escape].base
+  return baseLetters[x.code(i)]
+
+proc unpack*(x: PackedDna): Dna =
+  var unpacked = newString(x.len)
+  for i in 0..<x.len:
+    unpacked[i] = baseLetters[x.code(i)]
+  for (pos, base) in x.escapes:
+    unpacked[pos] = base
+  return unpacked.Dna
+
+proc `$`*(x: PackedDna): string = x.unpack.string
+
+proc `==`*(x, y: PackedDna): bool =
+  # the unused bits of the last word are always zero so whole words can be compared
+  x.len == y.len and x.words == y.words and x.escapes == y.escapes
+
+proc hash*(x: PackedDna): Hash =
+  var h: Hash = 0
+  h = h !& hash(x.words)
+  h = h !& hash(x.len)
+  for (pos, base) in x.escapes:
+    h = h !& hash(pos) !& hash(base)
+  result = !$h
+
+proc cmp*(x, y: PackedDna): int =
+  ## Compare two sequences lexicographically, 32 bases at a time unless either of them has escapes.
+  if x.hasEscapes or y.hasEscapes:
+    for i in 0..<min(x.len, y.len):
+      if x[i] != y[i]:
+        return cmp(x[i], y[i])
+    return cmp(x.len, y.len)
+  # padding is zero (A), which sorts before everything, so a prefix compares equal and the length breaks the tie
+  for i in 0..<min(x.words.len, y.words.len):
+    if x.words[i] != y.words[i]:
+      return (if x.words[i] < y.words[i]: -1 else: 1)
+  return cmp(x.len, y.len)
+
+proc `<`*(x, y: PackedDna): bool = cmp(x, y) < 0
+proc `<=`*(x, y: PackedDna): bool = cmp(x, y) <= 0
+
+proc highBases(n: int): uint64 {.inline.} =
+  ## A mask covering the first `n` bases of a word.
+  if n <= 0: 0'u64 else: not 0'u64 shl (2 * (basesPerWord - n))
+
+proc wordAt(x: PackedDna, pos: int): uint64 {.inline.} =
+  ## The 32 bases starting at `pos`, which needn't be word aligned. Bases past the end are zero.
+  let word = pos div basesPerWord
+  let shift = 2 * (pos mod basesPerWord)
+  result = x.words[word] shl shift
+  if shift > 0 and word + 1 < x.words.len:
+    result = result or (x.words[word + 1] shr (64 - shift))
+
+proc rotationWordAt(x: PackedDna, pos: int): uint64 {.inline.} =
+  ## The 32 bases starting at `pos` of the sequence read as a circle. `x` must be at least 32 bases long.
+  let available = x.len - pos
+  result = x.wordAt(pos)
+  if available < basesPerWord:
+    result = (result and highBases(available)) or (x.wordAt(0) shr (2 * available))
+
+proc cmpRotations*(x: PackedDna, xOffset: int, y: PackedDna, yOffset: int): int =
+  ## Compare the rotation of `x` starting at `xOffset` to the rotation of `y` (of the same length) starting at `yOffset`.
+  assert x.len == y.len
+  let n = x.len
+  if n < basesPerWord or x.hasEscapes or y.hasEscapes:
+    for i in 0..<n:
+      let a = x[(xOffset + i) mod n]
+      let b = y[(yOffset + i) mod n]
+      if a != b:
+        return cmp(a, b)
+    return 0
+  var i = 0
+  while i < n:
+    var a = x.rotationWordAt((xOffset + i) mod n)
+    var b = y.rotationWordAt((yOffset + i) mod n)
+    if n - i < basesPerWord:
+      a = a and highBases(n - i)
+      b = b and highBases(n - i)
+    if a != b:
+      return (if a < b: -1 else: 1)
+    i.inc(basesPerWord)
+  return 0
+
+# Integer k-mers
+#
+# k-mers of up to 32 bases are encoded the same way as packed sequences, so they fit in a `uint64` and sort in
+# lexicographic order. Windows that contain anything other than ACGT are skipped.
+
+iterator baseCodes(x: Dna|Rna): uint8 {.inline.} =
+  for c in x.string:
+    # treat U as T so that RNA k-mers match their DNA counterparts
+    yield (if c in {'U', 'u'}: 3'u8 else: codeOfBase[c])
+
+iterator baseCodes(x: PackedDna): uint8 {.inline.} =
+  var nextEscape = 0
+  for i in 0..<x.len:
+    if nextEscape < x.escapes.len and x.escapes[nextEscape].pos == i:
+      inc nextEscape
+      yield invalidBase
+    else:
+      yield x.code(i)
+
+template kmerMask(k: int): uint64 =
+  (if k == basesPerWord: not 0'u64 else: (1'u64 shl (2 * k)) - 1)
+
+iterator kmerCodes*(x: Dna|Rna|PackedDna, k: range[1..32]): uint64 =
+  ## Yield each k-mer of `x` as an integer, computed with a rolling update instead of slicing out each k-mer.
+  let mask = kmerMask(k)
+  var code = 0'u64
+  var valid = 0 # how many ACGT bases in a row we've seen
+  for base in x.baseCodes:
+    if base == invalidBase:
+      valid = 0
+      continue
+    code = ((code shl 2) or base) and mask
+    inc valid
+    if valid >= k:
+      yield code
+
+iterator canonicalKmerCodes*(x: Dna|Rna|PackedDna, k: range[1..32]): uint64 =
+  ## Yield the smaller of each integer k-mer and its reverse complement.
+  let mask = kmerMask(k)
+  let topShift = 2 * (k - 1)
+  var forward = 0'u64
+  var reverse = 0'u64
+  var valid = 0
+  for base in x.baseCodes:
+    if base == invalidBase:
+      valid = 0
+      continue
+    forward = ((forward shl 2) or base) and mask
+    # the complement of a base is 3 minus its code
+    reverse = (reverse shr 2) or ((3 - base).uint64 shl topShift)
+    inc valid
+    if valid >= k:
+      yield min(forward, reverse)
+
+proc countKmerCodes*(x: Dna|Rna|PackedDna, k: range[1..32], canonical = false): CountTable[uint64] =
+  if canonical:
+    for code in x.canonicalKmerCodes(k):
+      result.inc(code)
+  else:
+    for code in x.kmerCodes(k):
+      result.inc(code)
+
+proc decodeKmer*(code: uint64, k: range[1..32]): Dna =
+  ## Turn an integer k-mer back into a sequence.
+  var kmer = newString(k)
+  for i in 0..<k:
+    kmer[i] = baseLetters[(code shr (2 * (k - 1 - i))) and 3]
+  return kmer.Dna
+
+iterator readFasta*[T: BioString](file: File): Record[T] =
   ## Iterate over the lines in a FASTA file, yielding one record at a time 
   var description = ""
   var sequence = ""
-  for line in filename.lines:
+  for line in file.lines:
     if line.startsWith(">"):
       if sequence != "":
         yield newRecord[T](sequence, description=description)
@@ -197,12 +415,191 @@ iterator readFasta*[T: BioString](filename: string|File): Record[T] =
       sequence &= line.strip
   yield newRecord[T](sequence, description=description)
   sequence = ""
+
+iterator readFasta*[T: BioString](filename: string, threads: Positive = 1): Record[T] =
+  ## Iterate over the records in a (possibly compressed) FASTA file.
+  let fastx = openFastx(filename, threads=threads)
+  try:
+    for record in readFasta[T](fastx.file):
+      yield record
+  finally:
+    fastx.close()
   
-iterator readFastq*[T: NucleicAcid](filename: string|File): Record[T] =
+const chunkSize = 1 shl 16 # how much of a stream to read at once
+
+type
+  FastaView* = object
+    ## A FASTA record that points into memory owned by the reader instead of being copied.
+    ## It is only valid until the reader moves on to the next record.
+    description*: MemSlice
+    sequence*: MemSlice ## empty if the record is longer than the reader's `maxLen`
+    len*: int ## the length of the sequence, even if it wasn't kept
+
+proc len*(x: MemSlice): int {.inline.} = x.size
+template `[]`*(x: MemSlice, i: int): char = cast[ptr UncheckedArray[char]](x.data)[i]
+proc write*(f: File, x: MemSlice) {.inline.} =
+  if x.size > 0:
+    discard f.writeBuffer(x.data, x.size)
+proc toUpperAscii*(x: MemSlice|string, into: var string) {.inline.} =
+  ## Copy `x` into `into`, capitalizing it along the way. Reusing `into` avoids allocating for each record.
+  into.setLen(x.len)
+  for i in 0..<x.len:
+    into[i] = x[i].toUpperAscii
+proc writeFasta*(f: File, description: string|MemSlice, sequence: string|MemSlice) =
+  ## Write a FASTA record straight from its parts without building the whole record as a string first.
+  f.write('>')
+  f.write(description)
+  f.write('\n')
+  f.write(sequence)
+  f.write('\n')
+proc writeFasta*(f: File, x: FastaView) = f.writeFasta(x.description, x.sequence)
+proc writeFasta*(w: var BufferedWriter, x: FastaView) = w.writeFasta(x.description, x.sequence)
+proc toMemSlice(x: string): MemSlice {.inline.} =
+  if x.len == 0: MemSlice() else: MemSlice(data: x[0].unsafeAddr, size: x.len)
+
+proc strip(x: MemSlice): MemSlice {.inline.} =
+  ## Remove leading and trailing whitespace without copying.
+  result = x
+  while result.size > 0 and result[0] in Whitespace:
+    result.data = cast[pointer](cast[uint](result.data) + 1)
+    dec result.size
+  while result.size > 0 and result[result.size - 1] in Whitespace:
+    dec result.size
+
+proc append(x: var string, y: MemSlice) {.inline.} =
+  let start = x.len
+  x.setLen(start + y.size) # grows geometrically so the buffer is only reallocated a handful of times
+  if y.size > 0:
+    copyMem(x[start].addr, y.data, y.size)
+
+iterator readFastaViews*(file: File, maxLen: Natural = high(int)): FastaView =
+  ## Iterate over the records in a FASTA stream, reusing the same buffers for every record.
+  ##
+  ## The stream is read in fixed-size chunks rather than line by line so that memory use is bounded by `maxLen` and
+  ## the chunk size. Once a sequence is longer than `maxLen`, its bases are counted but no longer stored.
+  var description = ""
+  var sequence = ""
+  var seqLen = 0
+  var pending = "" # whitespace that only belongs to the sequence if more bases follow on the same line
+  var seenHeader = false
+  var atLineStart = true
+  var inHeader = false
+  var lineHasBases = false
+  var chunk = newString(chunkSize)
+
+  template addToSequence(c: char) =
+    inc seqLen
+    if seqLen <= maxLen:
+      sequence.add c
+  template current(): FastaView =
+    FastaView(description: description.toMemSlice,
+              sequence: (if seqLen <= maxLen: sequence.toMemSlice else: MemSlice()),
+              len: seqLen)
+  template trimHeader() =
+    # match `lines`, which drops the carriage return of a CRLF line ending
+    if inHeader and description.len > 0 and description[^1] == '\r':
+      description.setLen(description.len - 1)
+
+  while true:
+    let n = file.readBuffer(chunk[0].addr, chunk.len)
+    if n <= 0:
+      break
+    for i in 0..<n:
+      let c = chunk[i]
+      if atLineStart:
+        atLineStart = false
+        inHeader = c == '>'
+        lineHasBases = false
+        pending.setLen(0)
+        if inHeader:
+          if seqLen > 0:
+            yield current()
+          description.setLen(0)
+          sequence.setLen(0)
+          seqLen = 0
+          seenHeader = true
+          continue
+      if c == '\n':
+        trimHeader()
+        atLineStart = true
+      elif inHeader:
+        description.add c
+      elif c in Whitespace:
+        # like `strip`, leading and trailing whitespace is dropped but whitespace between bases is kept
+        if lineHasBases:
+          pending.add c
+      else:
+        for w in pending:
+          addToSequence(w)
+        pending.setLen(0)
+        lineHasBases = true
+        addToSequence(c)
+  trimHeader()
+  if seenHeader or seqLen > 0:
+    yield current()
+
+iterator fastaViews(region: MemFile, maxLen: Natural): FastaView =
+  ## Parse the FASTA records in a region of memory, only copying the lines of multi-line records.
+  var view: FastaView
+  var seenHeader = false
+  var lines = 0 # the number of sequence lines in the current record
+  var joined = "" # where multi-line sequences are joined together
+  for line in memSlices(region):
+    if line.size > 0 and line[0] == '>':
+      if view.len > 0:
+        yield view
+      view = FastaView(description: MemSlice(data: cast[pointer](cast[uint](line.data) + 1), size: line.size - 1))
+      seenHeader = true
+      lines = 0
+      continue
+    let bases = line.strip
+    inc lines
+    view.len.inc(bases.size)
+    if view.len > maxLen:
+      view.sequence = MemSlice() # stop joining lines once the record is too long
+    elif lines == 1:
+      view.sequence = bases
+    else:
+      if lines == 2:
+        joined.setLen(0)
+        joined.append(view.sequence)
+      joined.append(bases)
+      view.sequence = joined.toMemSlice
+  if seenHeader or view.len > 0:
+    yield view
+
+iterator parseFastaViews*(data: openArray[char], maxLen: Natural = high(int)): FastaView =
+  ## Iterate over the records of FASTA data that's already in memory, *e.g.* a buffer passed in from Python.
+  if data.len > 0:
+    for view in fastaViews(MemFile(mem: data[0].unsafeAddr, size: data.len), maxLen):
+      yield view
+
+iterator readFastaViews*(filename: string, threads: Positive = 1, maxLen: Natural = high(int)): FastaView =
+  ## Iterate over the records in a FASTA file without copying them.
+  ##
+  ## Plain files are memory mapped and single-line records point straight into the mapping. Lines of multi-line
+  ## records are joined into a buffer that is reused for every record. Compressed files and stdin can't be mapped so
+  ## they're streamed instead. Either way, sequences longer than `maxLen` are skipped over without being stored.
+  if filename == "-" or filename.compressionOf != Uncompressed:
+    let fastx = openFastx(filename, threads=threads)
+    try:
+      for view in readFastaViews(fastx.file, maxLen):
+        yield view
+    finally:
+      fastx.close()
+  elif getFileSize(filename) > 0:
+    var mapped = memfiles.open(filename)
+    try:
+      for view in fastaViews(mapped, maxLen):
+        yield view
+    finally:
+      mapped.close()
+
+iterator readFastq*[T: NucleicAcid](file: File): Record[T] =
   var linesRead = 0
   var description = ""
   var sequence = ""
-  for line in filename.lines:
+  for line in file.lines:
     if linesRead mod 4 == 0:
       description = line
       description.delete(0..0) # remove the @
@@ -214,9 +611,18 @@ iterator readFastq*[T: NucleicAcid](filename: string|File): Record[T] =
       sequence = ""
     linesRead += 1
 
+iterator readFastq*[T: NucleicAcid](filename: string, threads: Positive = 1): Record[T] =
+  ## Iterate over the records in a (possibly compressed) FASTQ file.
+  let fastx = openFastx(filename, threads=threads)
+  try:
+    for record in readFastq[T](fastx.file):
+      yield record
+  finally:
+    fastx.close()
+
 iterator readFastx*[T: NucleicAcid](path: string): Record[T] =
   # Use the correct parser depending on the file extension
-  var mode = if path.splitFile.ext.toLowerAscii in [".fastq", ".fq"]: "fastq" else: "fasta"
+  var mode = if path.stripCompressionExt.splitFile.ext.toLowerAscii in [".fastq", ".fq"]: "fastq" else: "fasta"
   if mode == "fasta":
     for record in readFasta[T](path): yield record
   elif mode == "fastq":
@@ -0,0 +1,98 @@
+## BLAKE2b hashing (RFC 7693), used to identify sequences by their content.
+##
+## The digests match Python's `hashlib.blake2b(data, digest_size=n)`, which is how `summarize` makes the `NV_` IDs.
+
+import std/endians
+
+type
+  SeqDigest* = array[16, uint8] ## What we use to tell sequences apart when deduplicating them
+
+const
+  iv = [
+    0x6a09e667f3bcc908'u64, 0xbb67ae8584caa73b'u64, 0x3c6ef372fe94f82b'u64, 0xa54ff53a5f1d36f1'u64,
+    0x510e527fade682d1'u64, 0x9b05688c2b3e6c1f'u64, 0x1f83d9abfb41bd6b'u64, 0x5be0cd19137e2179'u64,
+  ]
+  sigma = [
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15],
+    [14, 10, 4, 8, 9, 15, 13, 6, 1, 12, 0, 2, 11, 7, 5, 3],
+    [11, 8, 12, 0, 5, 2, 15, 13, 10, 14, 3, 6, 7, 1, 9, 4],
+    [7, 9, 3, 1, 13, 12, 11, 14, 2, 6, 5, 10, 4, 0, 15, 8],
+    [9, 0, 5, 7, 2, 4, 10, 15, 14, 1, 11, 12, 6, 8, 3, 13],
+    [2, 12, 6, 10, 0, 11, 8, 3, 4, 13, 7, 5, 15, 14, 1, 9],
+    [12, 5, 1, 15, 14, 13, 4, 10, 0, 7, 6, 3, 9, 2, 8, 11],
+    [13, 11, 7, 14, 12, 1, 3, 9, 5, 0, 15, 4, 8, 6, 2, 10],
+    [6, 15, 14, 9, 11, 3, 0, 8, 12, 2, 13, 7, 1, 4, 10, 5],
+    [10, 2, 8, 4, 7, 6, 1, 5, 15, 11, 9, 14, 3, 12, 13, 0],
+  ]
+  blockSize = 128
+
+template rotr(x: uint64, n: int): uint64 = (x shr n) or (x shl (64 - n))
+
+proc compress(h: var array[8, uint64], data: openArray[char], offset: int, counter: uint64, last: bool) =
+  ## Mix the 128 bytes of `data` starting at `offset` into the state.
+  var m: array[16, uint64]
+  for i in 0..15:
+    littleEndian64(m[i].addr, data[offset + i * 8].unsafeAddr)
+
+  var v: array[16, uint64]
+  for i in 0..7:
+    v[i] = h[i]
+    v[i + 8] = iv[i]
+  v[12] = v[12] xor counter # the high 64 bits of the counter are always zero for inputs we can hold in memory
+  if last:
+    v[14] = not v[14]
+
+  template g(a, b, c, d: int, x, y: uint64) =
+    v[a] = v[a] + v[b] + x
+    v[d] = rotr(v[d] xor v[a], 32)
+    v[c] = v[c] + v[d]
+    v[b] = rotr(v[b] xor v[c], 24)
+    v[a] = v[a] + v[b] + y
+    v[d] = rotr(v[d] xor v[a], 16)
+    v[c] = v[c] + v[d]
+    v[b] = rotr(v[b] xor v[c], 63)
+
+  for round in 0..11:
+    let s = sigma[round mod 10]
+    g(0, 4, 8, 12, m[s[0]], m[s[1]])
+    g(1, 5, 9, 13, m[s[2]], m[s[3]])
+    g(2, 6, 10, 14, m[s[4]], m[s[5]])
+    g(3, 7, 11, 15, m[s[6]], m[s[7]])
+    g(0, 5, 10, 15, m[s[8]], m[s[9]])
+    g(1, 6, 11, 12, m[s[10]], m[s[11]])
+    g(2, 7, 8, 13, m[s[12]], m[s[13]])
+    g(3, 4, 9, 14, m[s[14]], m[s[15]])
+
+  for i in 0..7:
+    h[i] = h[i] xor v[i] xor v[i + 8]
+
+proc blake2b*(data: openArray[char], digestSize: static[range[1..64]]): array[digestSize, uint8] =
+  ## Hash `data` into a `digestSize`-byte digest.
+  var h = iv
+  h[0] = h[0] xor 0x01010000'u64 xor digestSize.uint64 # no key, fanout and depth of one
+
+  # every block but the last is compressed as is
+  var offset = 0
+  while data.len - offset > blockSize:
+    compress(h, data, offset, uint64(offset + blockSize), last = false)
+    offset.inc(blockSize)
+
+  # the last block (which is empty for empty input) is padded with zeroes
+  var lastBlock: array[blockSize, char]
+  for i in offset..<data.len:
+    lastBlock[i - offset] = data[i]
+  compress(h, lastBlock, 0, data.len.uint64, last = true)
+
+  var bytes: array[64, uint8]
+  for i in 0..7:
+    littleEndian64(bytes[i * 8].addr, h[i].addr)
+  for i in 0..<digestSize:
+    result[i] = bytes[i]
+
+proc toHex*(digest: openArray[uint8]): string =
+  ## Format a digest as lowercase hex like Python's `hexdigest`.
+  const digits = "0123456789abcdef"
+  result = newString(digest.len * 2)
+  for i, byte in digest:
+    result[2 * i] = digits[byte.int shr 4]
+    result[2 * i + 1] = digits[byte.int and 0xf]
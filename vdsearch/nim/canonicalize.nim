@@ -1,37 +1,115 @@
 import bioseq
-import cello
-import strutils
+import seqio
+import catalog
+import std/[os, strutils]
 
 import nimpy
+import gil
 
 
-proc minimalCanonicalRotation*(x:  Dna): Dna = 
-  var rotatedCanonical: Dna
-  result = x # we'll start by assuming the assuming the sequence is already rotationally canonical
-  var rc = x.reverseComplement
-  for i in 0..x.high:
-    rotatedCanonical = min($rotate($x, i), $rotate($rc, i)).toDna
-    if rotatedCanonical < result:
-      result = rotatedCanonical
+proc leastRotation(x: Dna): int =
+  ## Find the offset of the lexicographically least rotation of `x` in O(n) time without building any rotations.
+  ##
+  ## Two candidate offsets `i` and `j` are compared `k` characters at a time. When they differ, every offset
+  ## from the losing candidate up to the mismatch can't start the least rotation either, so it is skipped.
+  let n = x.len
+  var i = 0
+  var j = 1
+  var k = 0
+  while i < n and j < n and k < n:
+    var a = i + k
+    var b = j + k
+    if a >= n: a -= n
+    if b >= n: b -= n
+    if x.string[a] == x.string[b]:
+      inc k
+      continue
+    if x.string[a] > x.string[b]:
+      i += k + 1
+    else:
+      j += k + 1
+    if i == j:
+      inc j
+    k = 0
+  return min(i, j)
+
+proc rotated(x: Dna, offset: int): Dna =
+  result = newString(x.len).Dna
+  let tail = x.len - offset
+  for i in 0..<tail:
+    result.string[i] = x.string[offset + i]
+  for i in 0..<offset:
+    result.string[tail + i] = x.string[i]
 
-proc canonicalize*(infile: string, outfile: string, minLen: Natural = 1, maxLen: Natural = high(int)) {.exportpy.}=
+proc minimalCanonicalRotation*(x: Dna): Dna =
+  ## Find the lexicographically smallest rotation of either `x` or its reverse complement.
+  if x.len == 0:
+    return x
+  let rc = x.reverseComplement
+  let forwardOffset = leastRotation(x)
+  let reverseOffset = leastRotation(rc)
+  # packed, the rotations are compared 32 bases at a time unless there are bases other than ACGT
+  if cmpRotations(rc.pack, reverseOffset, x.pack, forwardOffset) < 0:
+    return rc.rotated(reverseOffset)
+  return x.rotated(forwardOffset)
+
+proc canonicalize*(infile: string, outfile: string, minLen: Natural = 1, maxLen: Natural = high(int),
+                   outTsv: bool = true) {.releasesGil, exportpy.}=
+  ## Write the canonical rotation of each sequence in `infile` to `outfile`.
+  ## If `outTsv` is true, the length and `NV_` ID of each one is also written to `<outfile>.tsv`.
 
   # Warn the user if they compiled wrong
   if not defined(danger):
     echo "Not compiled with -d:danger. This will likely cause severe slowdowns."
 
-  let outfileFile = open(outfile, fmWrite) # the output file as an opend File object
-  defer: outfileFile.close()
-  var tmp = toRecord[Dna](Dna"", "") # only allocate a temporary record once
-  for record in readFasta[Dna](infile):
+  let output = openFastx(outfile, fmWrite) # compressed if the extension says so
+  defer: output.close()
+  var outfileWriter = initBufferedWriter(output.file) # records are written out in large blocks
+  defer: outfileWriter.flush()
+
+  var outTsvFile: File
+  defer: outTsvFile.close()
+  var outTsvWriter: BufferedWriter
+  defer: outTsvWriter.flush()
+  if outTsv:
+    outTsvFile = open(changeFileExt(outfile.stripCompressionExt, "tsv"), fmWrite)
+    outTsvWriter = initBufferedWriter(outTsvFile)
+    outTsvWriter.writeRow("seq_id", "unit_length", "vdsearch_id")
+
+  var sequence = "" # only allocate a buffer for the sequence once
+  for view in readFastaViews(infile, maxLen=maxLen):
     
     # bail to prevent slowdowns on giant sequences
-    if record.len < minLen or record.len > maxLen:
+    if view.len < minLen or view.len > maxLen:
       continue
 
     # we capitalize since otherwise it breaks rev comp
-    record.sequence = record.sequence.string.toUpperAscii().Dna
+    view.sequence.toUpperAscii(sequence)
     
-    tmp.sequence = record.sequence.minimalCanonicalRotation
-    tmp.description = record.description
-    writeLine outfileFile, tmp.asFasta
\ No newline at end of file
+    let canonical = sequence.Dna.minimalCanonicalRotation.string
+    outfileWriter.writeFasta(view.description, canonical)
+    # the ID is computed while we have the canonical rotation in hand so that summarize doesn't need to rehash it
+    if outTsv:
+      outTsvWriter.writeRow(view.description, canonical.len, vdsearchId(canonical))
+
+proc canonicalize_batch*(sequences: seq[string]): seq[string] {.releasesGil, exportpy.} =
+  ## Find the canonical rotation of each of the (in-memory) sequences.
+  var sequence = ""
+  for x in sequences:
+    x.toUpperAscii(sequence)
+    result.add(sequence.Dna.minimalCanonicalRotation.string)
+
+proc canonicalize_buffer*(fasta: string, minLen: Natural = 1, maxLen: Natural = high(int)): (seq[string], seq[string]) {.releasesGil, exportpy.} =
+  ## Canonicalize the records of an uncompressed FASTA file that's already in memory.
+  ## Returns the IDs (the whole header lines, as in the output of `canonicalize`) and canonical rotations of the
+  ## records in the size range.
+  var ids: seq[string]
+  var canonical: seq[string]
+  var sequence = ""
+  for view in parseFastaViews(fasta, maxLen=maxLen):
+    if view.len < minLen or view.len > maxLen:
+      continue
+    view.sequence.toUpperAscii(sequence)
+    ids.add($view.description)
+    canonical.add(sequence.Dna.minimalCanonicalRotation.string)
+  return (ids, canonical)
@@ -0,0 +1,186 @@
+## A persistent catalog of the sequences seen in previous runs.
+##
+## The catalog is a directory of append-only segment files. Each segment is a sorted list of 8-byte BLAKE2b digests of
+## uppercase sequences (the same digests as in the `NV_` IDs from `summarize`), so looking a sequence up is a binary
+## search in each memory-mapped segment. A run adds the new sequences it saw as a new segment, which is written to a
+## temporary file and renamed into place so that other runs never see half a segment. Once there are too many
+## segments, they're merged into one while holding an exclusive lock so that nobody opens a segment that's about to be
+## deleted.
+
+import std/[os, memfiles, algorithm, heapqueue, sets, times, strformat, strutils]
+import blake2
+
+const
+  segmentExt = ".seg"
+  magic = "VDSCAT01" # the start of every segment, followed by the digests
+  maxSegments = 16 # how many segments there can be before they're merged
+
+type
+  Catalog* = object
+    ## An open catalog. Look sequences up with `contains`, `add` new ones, and `commit` the additions.
+    dir: string
+    segments: seq[MemFile]
+    pending: HashSet[uint64] # keys added in this run, not committed yet
+
+proc flock(fd: cint, operation: cint): cint {.importc, header: "<sys/file.h>".}
+var
+  LOCK_SH {.importc, header: "<sys/file.h>".}: cint
+  LOCK_EX {.importc, header: "<sys/file.h>".}: cint
+
+proc catalogKey*(sequence: string): uint64 =
+  ## The digest of an (uppercase) sequence as stored in the catalog.
+  ## The bytes are read big-endian so that sorting the keys sorts the hex IDs.
+  for byte in blake2b(sequence, 8):
+    result = (result shl 8) or byte.uint64
+
+proc vdsearchId*(key: uint64): string =
+  ## The `NV_` ID of the sequence with this key, matching the one made by `summarize`.
+  "NV_" & key.toHex(16).toLowerAscii
+
+proc vdsearchId*(sequence: string): string =
+  ## The `NV_` ID of an (uppercase) sequence, matching the one made by `summarize`.
+  "NV_" & blake2b(sequence, 8).toHex
+
+template withLock(dir: string, operation: cint, body: untyped) =
+  ## Hold a shared or exclusive lock on the catalog while running `body`.
+  var lockFile: File
+  if not open(lockFile, dir / ".lock", fmAppend):
+    raise newException(IOError, "Unable to open the catalog lock in " & dir)
+  try:
+    if flock(lockFile.getOsFileHandle.cint, operation) != 0:
+      raise newException(IOError, "Unable to lock the catalog in " & dir)
+    body
+  finally:
+    lockFile.close() # releases the lock
+
+iterator segmentPaths(dir: string): string =
+  for kind, path in walkDir(dir):
+    if kind == pcFile and path.endsWith(segmentExt):
+      yield path
+
+proc keyCount(segment: MemFile): int {.inline.} = (segment.size - magic.len) div sizeof(uint64)
+
+proc key(segment: MemFile, i: int): uint64 {.inline.} =
+  cast[ptr UncheckedArray[uint64]](cast[uint](segment.mem) + magic.len.uint)[i]
+
+proc mapSegment(path: string): MemFile =
+  result = memfiles.open(path)
+  var valid = result.size >= magic.len
+  for i in 0..<magic.len:
+    valid = valid and cast[ptr UncheckedArray[char]](result.mem)[i] == magic[i]
+  if not valid:
+    result.close()
+    raise newException(IOError, &"{path} is not a catalog segment")
+
+proc openCatalog*(dir: string): Catalog =
+  ## Open the catalog in `dir`, creating it if it doesn't exist yet.
+  createDir(dir)
+  result.dir = dir
+  # segments are only deleted while the exclusive lock is held and stay readable once mapped
+  withLock(dir, LOCK_SH):
+    for path in segmentPaths(dir):
+      result.segments.add(mapSegment(path))
+
+proc contains*(c: Catalog, key: uint64): bool =
+  ## Whether a sequence with this key was committed to the catalog before it was opened.
+  for segment in c.segments:
+    var lo = 0
+    var hi = segment.keyCount - 1
+    while lo <= hi:
+      let mid = (lo + hi) div 2
+      let found = segment.key(mid)
+      if found == key:
+        return true
+      elif found < key:
+        lo = mid + 1
+      else:
+        hi = mid - 1
+  return false
+
+proc add*(c: var Catalog, key: uint64) =
+  ## Queue a key to be added to the catalog by `commit`.
+  c.pending.incl(key)
+
+proc addIfNovel*(c: var Catalog, key: uint64): bool =
+  ## Queue a key to be added unless it's already in the catalog or was queued earlier in this run. Returns whether it
+  ## was novel.
+  if key in c or c.pending.containsOrIncl(key):
+    return false
+  return true
+
+proc writeSegment(dir: string, keys: openArray[uint64]) =
+  ## Write a sorted list of keys as a new segment, making it visible all at once.
+  # unique even if several runs add to the catalog at the same time
+  var name = ""
+  while name == "" or fileExists(dir / (name & segmentExt)):
+    let now = getTime()
+    name = &"{now.toUnix}-{now.nanosecond:09}-{getCurrentProcessId()}-{getThreadId()}"
+  let temporary = dir / ("." & name & ".tmp")
+  var f: File
+  if not open(f, temporary, fmWrite):
+    raise newException(IOError, &"Unable to write {temporary}")
+  try:
+    f.write(magic)
+    if keys.len > 0 and f.writeBuffer(keys[0].unsafeAddr, keys.len * sizeof(uint64)) != keys.len * sizeof(uint64):
+      raise newException(IOError, &"Unable to write {temporary}")
+  finally:
+    f.close()
+  moveFile(temporary, dir / (name & segmentExt))
+
+proc compact(dir: string) =
+  ## Merge all of the segments into one.
+  withLock(dir, LOCK_EX):
+    var paths: seq[string]
+    for path in segmentPaths(dir):
+      paths.add(path)
+    if paths.len <= 1:
+      return
+    var segments: seq[MemFile]
+    defer:
+      for segment in segments.mitems:
+        segment.close()
+    for path in paths:
+      segments.add(mapSegment(path))
+
+    # k-way merge, dropping keys that are in more than one segment
+    var total = 0
+    for segment in segments:
+      total.inc(segment.keyCount)
+    var merged = newSeqOfCap[uint64](total)
+    var next = initHeapQueue[(uint64, int, int)]() # key, segment, position
+    for i, segment in segments:
+      if segment.keyCount > 0:
+        next.push((segment.key(0), i, 0))
+    while next.len > 0:
+      let (key, i, position) = next.pop()
+      if merged.len == 0 or merged[^1] != key:
+        merged.add(key)
+      if position + 1 < segments[i].keyCount:
+        next.push((segments[i].key(position + 1), i, position + 1))
+
+    writeSegment(dir, merged)
+    for path in paths:
+      removeFile(path)
+
+proc commit*(c: var Catalog) =
+  ## Add the queued keys that aren't in the catalog yet as a new segment.
+  var novel: seq[uint64]
+  for key in c.pending:
+    if key notin c:
+      novel.add(key)
+  c.pending.clear()
+  if novel.len == 0:
+    return
+  novel.sort()
+  writeSegment(c.dir, novel)
+
+  var segments = 0
+  for _ in segmentPaths(c.dir):
+    inc segments
+  if segments > maxSegments:
+    compact(c.dir)
+
+proc close*(c: var Catalog) =
+  for segment in c.segments.mitems:
+    segment.close()
+  c.segments.setLen(0)
@@ -0,0 +1,229 @@
+## Removing duplicate sequences within a memory budget.
+##
+## Records are streamed and the digest of each (uppercased) sequence is kept in a hash set, so a record is written out
+## the first time its sequence is seen. If the set outgrows the budget, the rest is finished on disk:
+##
+## 1. The digests seen so far and the digest and index of every remaining record are split into partitions on disk by
+##    the first byte of the digest.
+## 2. Each partition (or, if it's too big, each slice of it) is deduplicated with a hash set in turn. Since a
+##    partition is in input order, everything but the first copy of a digest is a duplicate. The indices of the
+##    duplicates are written to a scratch file as sorted runs.
+## 3. The input is read again from where the spilling began and the runs are merged to skip the duplicates.
+##
+## The records that were written before spilling are first occurrences no matter what comes later, so the output is
+## the same as if everything had fit in memory.
+##
+## The first occurrences can also be checked against (and added to) a persistent catalog of previous runs.
+
+import nimpy
+import gil
+import std/[os, sets, heapqueue, tempfiles, strformat]
+import bioseq
+import seqio
+import blake2
+import catalog
+import faidx
+
+const
+  bytesPerDigest = 64 # roughly what a digest costs in a hash set, counting empty slots and the copy made when growing
+  partitions = 64 # how many files the digests are split between when spilling
+  partitionBuffer = 1 shl 16 # how much of each partition to buffer before writing it out
+  entriesPerRead = 4096 # how many spilled digests or indices to read at once
+  seenBeforeSpill = -1 # the index given to digests that were already in memory when spilling began
+
+type
+  SpillEntry = object
+    digest: SeqDigest
+    index: int
+
+  Run = object
+    ## A sorted list of the indices of duplicates stored in the scratch file.
+    offset: int # in indices, not bytes
+    count: int
+
+  RunReader = object
+    run: Run
+    read: int # how many indices of the run have been used up
+    buffer: seq[int]
+    bufferStart: int
+
+iterator spilledEntries(path: string): SpillEntry =
+  var f = open(path)
+  defer: f.close()
+  var buffer = newSeq[SpillEntry](entriesPerRead)
+  while true:
+    let n = f.readBuffer(buffer[0].addr, buffer.len * sizeof(SpillEntry)) div sizeof(SpillEntry)
+    if n == 0:
+      break
+    for i in 0..<n:
+      yield buffer[i]
+
+proc peek(r: var RunReader, f: File): int =
+  ## The next index in the run, reading more of it from `f` if needed. The run must not be exhausted.
+  if r.read - r.bufferStart == r.buffer.len:
+    r.bufferStart = r.read
+    r.buffer.setLen(min(entriesPerRead, r.run.count - r.read))
+    f.setFilePos((r.run.offset + r.read) * sizeof(int))
+    if f.readBuffer(r.buffer[0].addr, r.buffer.len * sizeof(int)) != r.buffer.len * sizeof(int):
+      raise newException(IOError, "Unable to read the indices of duplicates back from the scratch directory")
+  return r.buffer[r.read - r.bufferStart]
+
+proc findDuplicates(scratch: string, maxMemory: int): tuple[runs: seq[Run], path: string] =
+  ## Deduplicate each partition, writing the indices of the duplicates to a scratch file as sorted runs.
+  result.path = scratch / "duplicates"
+  var f = open(result.path, fmWrite)
+  defer: f.close()
+  var writer = initBufferedWriter(f)
+  defer: writer.flush()
+  var written = 0
+
+  for partition in 0..<partitions:
+    let path = scratch / $partition
+    let entries = getFileSize(path) div sizeof(SpillEntry)
+    if entries == 0:
+      continue
+
+    # partitions that are too big are handled in slices by the second byte of the digest
+    let slices = clamp((entries * bytesPerDigest + maxMemory - 1) div maxMemory, 1, 256)
+    for slice in 0..<slices:
+      let bytes = (slice * 256 div slices) ..< ((slice + 1) * 256 div slices)
+      var seen = initHashSet[SeqDigest]()
+      var run = Run(offset: written)
+      for entry in spilledEntries(path):
+        if entry.digest[1].int in bytes and seen.containsOrIncl(entry.digest):
+          var index = entry.index
+          writer.addRaw(index.addr, sizeof(int))
+          inc run.count
+      written.inc(run.count)
+      if run.count > 0:
+        result.runs.add(run)
+
+proc dedup*(infile: string,
+            outfile: string,
+            maxMemory: Positive = 4 shl 30,
+            scratchDir: string = "",
+            threads: Natural = 1,
+            catalogDir: string = "",
+            novelOnly: bool = false
+           ): (int, int, bool, int) {.releasesGil, exportpy.} =
+  ## Write the first copy of each sequence in `infile` to `outfile`, ignoring case, using about `maxMemory` bytes.
+  ##
+  ## If the digests don't fit in memory, they're spilled to a temporary directory in `scratchDir` (or the system's
+  ## temporary directory if it's empty).
+  ##
+  ## If `catalogDir` is given, the sequences are looked up in the catalog there and the new ones are added to it. With
+  ## `novelOnly`, sequences that are already in the catalog are left out of the output.
+  ##
+  ## Returns the number of sequences, the number of duplicates removed, whether anything had to be spilled, and the
+  ## number of sequences that were already in the catalog.
+  ##
+  ## An uncompressed `outfile` is indexed as it's written, so that later steps can seek straight to the records they
+  ## need.
+  var fai = initFaiWriter(outfile) # closed last so that it's newer than the output
+  defer: fai.close()
+  let output = openFastx(outfile, fmWrite, threads=max(threads, 1)) # compressed if the extension says so
+  defer: output.close()
+  var writer = initBufferedWriter(output.file)
+  defer: writer.flush()
+
+  let maxDigests = max(maxMemory div bytesPerDigest, 1)
+  var seen = initHashSet[SeqDigest]()
+  var sequence = "" # the uppercased sequence, reused for every record
+  var total = 0
+  var duplicates = 0
+
+  var spillStart = -1 # the index of the first record that's deduplicated on disk
+  var scratch = ""
+  var partitionFiles: seq[File]
+  var partitionWriters: seq[BufferedWriter]
+
+  var known = 0
+  var seenBefore: Catalog
+  if catalogDir != "":
+    seenBefore = openCatalog(catalogDir)
+  defer: seenBefore.close()
+
+  template emit(view: FastaView) =
+    ## Write out a first occurrence, checking it against the catalog. `sequence` must hold it in uppercase.
+    var novel = true
+    if catalogDir != "":
+      novel = seenBefore.addIfNovel(catalogKey(sequence))
+      if not novel:
+        inc known
+    if novel or not novelOnly:
+      fai.add(writer, view.description, view.sequence.len)
+      writer.writeFasta(view)
+
+  template spill(d: SeqDigest, i: int) =
+    var entry = SpillEntry(digest: d, index: i)
+    partitionWriters[entry.digest[0].int mod partitions].addRaw(entry.addr, sizeof(SpillEntry))
+
+  try:
+    for view in readFastaViews(infile, threads=max(threads, 1)):
+      view.sequence.toUpperAscii(sequence)
+      let digest = blake2b(sequence, 16)
+      if spillStart != -1:
+        spill(digest, total)
+      elif digest in seen:
+        inc duplicates
+      elif seen.len < maxDigests:
+        seen.incl(digest)
+        emit(view)
+      else:
+        if infile == "-":
+          raise newException(IOError, "Not enough memory to deduplicate stdin. Please use a file or raise the memory limit.")
+        spillStart = total
+        scratch = createTempDir("vdsearch_dedup_", "", scratchDir)
+        for partition in 0..<partitions:
+          partitionFiles.add(open(scratch / $partition, fmWrite))
+          partitionWriters.add(initBufferedWriter(partitionFiles[^1], partitionBuffer))
+        for seenDigest in seen:
+          spill(seenDigest, seenBeforeSpill)
+        seen = initHashSet[SeqDigest]() # free the memory for the next pass
+        spill(digest, total)
+      inc total
+
+    if spillStart == -1:
+      seenBefore.commit()
+      return (total, duplicates, false, known)
+
+    for partition in 0..<partitions:
+      partitionWriters[partition].flush()
+      partitionFiles[partition].close()
+    partitionFiles.setLen(0)
+
+    let (runs, duplicatesPath) = findDuplicates(scratch, maxMemory)
+
+    # merge the runs while reading the rest of the input again
+    var duplicatesFile = open(duplicatesPath)
+    defer: duplicatesFile.close()
+    var readers = newSeq[RunReader](runs.len)
+    var next = initHeapQueue[(int, int)]() # the next duplicate of each run and the run it's from
+    for i, run in runs:
+      readers[i].run = run
+      next.push((readers[i].peek(duplicatesFile), i))
+
+    var index = 0
+    for view in readFastaViews(infile, threads=max(threads, 1)):
+      if index >= spillStart:
+        if next.len > 0 and next[0][0] == index:
+          let (_, i) = next.pop()
+          inc readers[i].read
+          if readers[i].read < readers[i].run.count:
+            next.push((readers[i].peek(duplicatesFile), i))
+          inc duplicates
+        else:
+          if catalogDir != "":
+            view.sequence.toUpperAscii(sequence)
+          emit(view)
+      inc index
+    if index != total:
+      raise newException(IOError, &"{infile} changed while it was being deduplicated")
+
+    seenBefore.commit()
+    return (total, duplicates, true, known)
+  finally:
+    for f in partitionFiles:
+      f.close()
+    if scratch != "":
+      removeDir(scratch)
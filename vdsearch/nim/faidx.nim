@@ -0,0 +1,248 @@
+## Random access to FASTA records through a samtools-style `.fai` index.
+##
+## Each line of the index has the name (the first word of the header) of a record, its length, the offset of its first
+## base in the file, and how many bases and bytes there are per line. With that, a record can be read straight out of
+## the memory-mapped file instead of scanning everything before it, so pulling a few hits out of a huge file costs
+## time proportional to the hits. The kernels that write deduplicated FASTA files write the index as they go.
+##
+## Only uncompressed files whose records have lines of the same length (other than the last) can be indexed. The index is only trusted if it's at least as new as the file itself.
+
+import nimpy
+import gil
+import std/[os, memfiles, strutils, strformat, sets, tables, algorithm, times]
+import bioseq
+import seqio
+
+type
+  FaiEntry* = object
+    name*: string
+    length*: int # in bases
+    offset*: int # of the first base
+    lineBases*: int
+    lineWidth*: int # in bytes, counting the line break
+
+  FaiWriter* = object
+    ## Indexes a FASTA file while it's being written with a `BufferedWriter`.
+    file: File
+    writer: BufferedWriter
+    enabled: bool
+    path: string
+
+proc firstWord*(x: MemSlice|string, into: var string) =
+  ## Copy the first whitespace-delimited word of `x` into `into`.
+  var start = 0
+  while start < x.len and x[start] in Whitespace:
+    inc start
+  var stop = start
+  while stop < x.len and x[stop] notin Whitespace:
+    inc stop
+  into.setLen(stop - start)
+  for i in start..<stop:
+    into[i - start] = x[i]
+
+proc faiPath*(fasta: string): string = fasta & ".fai"
+
+proc canIndex*(fasta: string): bool =
+  ## Whether `fasta` is a file that can have an index, *i.e.* not stdin and not compressed.
+  fasta != "-" and fasta.compressionOf == Uncompressed
+
+proc hasIndex*(fasta: string): bool =
+  ## Whether `fasta` has an index that's up to date.
+  fasta.canIndex and fileExists(fasta.faiPath) and fileExists(fasta) and
+    getLastModificationTime(fasta.faiPath) >= getLastModificationTime(fasta)
+
+proc writeEntry(w: var BufferedWriter, entry: FaiEntry) =
+  w.writeRow(entry.name, entry.length, entry.offset, entry.lineBases, entry.lineWidth)
+
+proc initFaiWriter*(fasta: string): FaiWriter =
+  ## Start indexing `fasta`, which must be written from the beginning. Does nothing if it can't be indexed.
+  if not fasta.canIndex:
+    return
+  if not open(result.file, fasta.faiPath, fmWrite):
+    raise newException(IOError, &"Unable to write {fasta.faiPath}")
+  result.enabled = true
+  result.path = fasta.faiPath
+  result.writer = initBufferedWriter(result.file)
+
+proc add*(w: var FaiWriter, fasta: BufferedWriter, description: string|MemSlice, length: int) =
+  ## Index a single-line record that is about to be written to `fasta`.
+  if not w.enabled:
+    return
+  var entry = FaiEntry(length: length, lineBases: length, lineWidth: length + 1)
+  description.firstWord(entry.name)
+  entry.offset = fasta.position + description.len + 2 # after the '>' and the line break
+  w.writer.writeEntry(entry)
+
+proc close*(w: var FaiWriter) =
+  ## Finish the index. Call this after the FASTA file is closed so that the index is newer than it.
+  if w.enabled:
+    w.writer.flush()
+    w.file.close()
+    w.enabled = false
+
+proc abort*(w: var FaiWriter) =
+  ## Delete the index of a FASTA file that couldn't be written in full. Otherwise, the index would be newer than the
+  ## partial file and so trusted. Closing the writer afterwards does nothing.
+  if w.enabled:
+    w.file.close()
+    w.enabled = false
+    discard tryRemoveFile(w.path)
+
+proc buildIndex(region: MemFile, path: string): seq[FaiEntry] =
+  ## Index every record of a FASTA file. The lines of a record must all be the same length, except for the last one.
+  let data = cast[ptr UncheckedArray[char]](region.mem)
+  var entry: FaiEntry
+  var inRecord = false
+  var lines = 0 # in the current record
+  var shortLine = false # whether a line shorter than the first one has been seen, which must be the last line
+  var pos = 0
+  while pos < region.size:
+    var stop = pos
+    while stop < region.size and data[stop] != '\n':
+      inc stop
+    let next = min(stop + 1, region.size)
+    if stop > pos and data[stop - 1] == '\r':
+      dec stop
+
+    if data[pos] == '>':
+      if inRecord:
+        result.add(entry)
+      entry = FaiEntry(offset: next)
+      MemSlice(data: data[pos + 1].addr, size: stop - pos - 1).firstWord(entry.name)
+      inRecord = true
+      lines = 0
+      shortLine = false
+    elif inRecord:
+      let bases = stop - pos
+      inc lines
+      if lines == 1:
+        entry.lineBases = bases
+        entry.lineWidth = next - pos
+      elif bases > entry.lineBases or (shortLine and bases > 0):
+        raise newException(ValueError, &"{path} can't be indexed since the lines of {entry.name} are different lengths")
+      shortLine = shortLine or bases < entry.lineBases
+      entry.length.inc(bases)
+    elif stop > pos:
+      raise newException(ValueError, &"{path} doesn't start with a FASTA header")
+    pos = next
+  if inRecord:
+    result.add(entry)
+
+proc readIndex(fasta: string): seq[FaiEntry] =
+  for line in lines(fasta.faiPath):
+    let fields = line.split('\t')
+    if fields.len < 5:
+      raise newException(ValueError, &"{fasta.faiPath} is not a FASTA index")
+    result.add(FaiEntry(name: fields[0], length: fields[1].parseInt, offset: fields[2].parseInt,
+                        lineBases: fields[3].parseInt, lineWidth: fields[4].parseInt))
+
+proc writeIndex(fasta: string, entries: seq[FaiEntry]) =
+  var f: File
+  if not open(f, fasta.faiPath, fmWrite):
+    raise newException(IOError, &"Unable to write {fasta.faiPath}")
+  defer: f.close()
+  var writer = initBufferedWriter(f)
+  defer: writer.flush()
+  for entry in entries:
+    writer.writeEntry(entry)
+
+proc loadIndex*(fasta: string, region: MemFile): seq[FaiEntry] =
+  ## Read the index of `fasta` (which is mapped to `region`), building it and trying to save it if it's out of date.
+  if fasta.hasIndex:
+    return readIndex(fasta)
+  result = buildIndex(region, fasta)
+  try:
+    writeIndex(fasta, result)
+  except IOError:
+    discard # e.g. a read-only directory, so the index is only used this once
+
+template mismatch(entry: FaiEntry) =
+  raise newException(IOError, &"The index doesn't match the FASTA file at {entry.name}. Please delete the .fai file.")
+
+proc fetchHeader*(region: MemFile, entry: FaiEntry): MemSlice =
+  ## The header of an indexed record, which is the line before its first base.
+  let data = cast[ptr UncheckedArray[char]](region.mem)
+  var stop = entry.offset - 1 # the line break after the header
+  if entry.offset == region.size and data[stop] != '\n':
+    stop = region.size # an empty record at the very end of a file without a final line break
+  elif stop <= 0 or stop >= region.size or data[stop] != '\n':
+    mismatch(entry)
+  if data[stop - 1] == '\r':
+    dec stop
+  var start = stop
+  while start > 0 and data[start - 1] != '\n':
+    dec start
+  if data[start] != '>':
+    mismatch(entry)
+  result = MemSlice(data: data[start + 1].addr, size: stop - start - 1)
+
+proc fetchSequence*(region: MemFile, entry: FaiEntry, into: var string): MemSlice =
+  ## The sequence of an indexed record. Single-line records point straight into `region` while the lines of longer
+  ## ones are joined in `into`.
+  let data = cast[ptr UncheckedArray[char]](region.mem)
+  if entry.length == 0:
+    return MemSlice()
+  if entry.lineBases <= 0 or entry.offset < 0:
+    mismatch(entry)
+  let last = entry.offset + (entry.length - 1) div entry.lineBases * entry.lineWidth + (entry.length - 1) mod entry.lineBases
+  if last >= region.size:
+    mismatch(entry)
+  if entry.length <= entry.lineBases:
+    return MemSlice(data: data[entry.offset].addr, size: entry.length)
+  into.setLen(entry.length)
+  var copied = 0
+  var pos = entry.offset
+  while copied < entry.length:
+    let n = min(entry.lineBases, entry.length - copied)
+    copyMem(into[copied].addr, data[pos].addr, n)
+    copied.inc(n)
+    pos.inc(entry.lineWidth)
+  return MemSlice(data: into[0].addr, size: entry.length)
+
+iterator indexedRecords*(fasta: string, ids: HashSet[string]): tuple[description, sequence: MemSlice] =
+  ## Seek to the records whose names are in `ids`, in the order they're in the file.
+  if getFileSize(fasta) > 0:
+    var region = memfiles.open(fasta)
+    defer: region.close()
+    var wanted: seq[FaiEntry]
+    for entry in loadIndex(fasta, region):
+      if entry.name in ids:
+        wanted.add(entry)
+    wanted.sort(proc (a, b: FaiEntry): int = cmp(a.offset, b.offset))
+    var joined = ""
+    for entry in wanted:
+      yield (region.fetchHeader(entry), region.fetchSequence(entry, joined))
+
+proc faidx*(infile: string) {.releasesGil, exportpy.} =
+  ## Write an index of `infile` to `<infile>.fai`, like `samtools faidx` does.
+  if not infile.canIndex:
+    raise newException(ValueError, &"{infile} can't be indexed since it's compressed")
+  var region = memfiles.open(infile)
+  defer: region.close()
+  writeIndex(infile, buildIndex(region, infile))
+
+proc fetch_seqs*(infile: string, ids: seq[string]): (seq[string], seq[string]) {.releasesGil, exportpy.} =
+  ## Read the records named by `ids` out of `infile` using its index, building the index first if there isn't one.
+  ## Returns the headers and sequences in the order of `ids`, leaving out the ones that aren't found.
+  let idSet = toHashSet(ids)
+  var found = initTable[string, (string, string)]()
+  var name = ""
+  template keep(description, sequence: MemSlice) =
+    description.firstWord(name)
+    if name in idSet and name notin found:
+      found[name] = ($description, $sequence)
+
+  try:
+    for (description, sequence) in indexedRecords(infile, idSet):
+      keep(description, sequence)
+  except ValueError:
+    # files with lines of different lengths can't be indexed, so they're scanned instead
+    for view in readFastaViews(infile):
+      keep(view.description, view.sequence)
+  var descriptions: seq[string]
+  var sequences: seq[string]
+  for id in ids:
+    if id in found:
+      descriptions.add(found[id][0])
+      sequences.add(found[id][1])
+  return (descriptions, sequences)
@@ -1,52 +1,285 @@
 import nimpy
-import std/[os, monotimes, times, strformat, strutils]
+import gil
+import std/[os, monotimes, times, strformat, strutils, locks, deques, tables]
 import bioseq
+import seqio
+import blake2
+import catalog
+import faidx
 from canonicalize import minimalCanonicalRotation
 
 
-func cirit(x: Dna, seedLen = 10, minIdentity=0.95): Dna = 
-
-  # prevent an error from the seed being larger than the sequence
-  if x.len < seedLen:
-    return Dna""
-  
-  # find the seed (short sequence at the end that must match exactly)
-  let seed = x[^seedLen..^1]
-
-  # search the sequence for it
-  let idx = ($x).find($seed, last = x.len - seedLen)
-  
-  # find returns -1 if not found, so if it is -1, there's no match
-  if idx == -1:
-    return Dna""
-  
-  # compare the start of the sequence to the seed
-  let maxMismatches = (idx.float * (1.0 - minIdentity)).int
-  var mismatches = 0
-  for i in 0..idx:
-    if x[i] != x[ x.high - idx + i - seedLen + 1]:
-      inc mismatches
+func monomerPeriod*(x: Dna, seedLen = 10, minIdentity = 0.95): tuple[unitLen, copies: int] =
+  ## Find the length of the repeating unit of `x` and how many copies of it there are.
+  ##
+  ## Copies are peeled off the end of the sequence one at a time. The last `seedLen` bases (the seed) must occur
+  ## earlier in the sequence and everything up to that occurrence must match the bases before the seed at the end with
+  ## at least `minIdentity` identity. The seed is found with a prefix-function (KMP) scan that stops at its first
+  ## occurrence, so peeling off a copy costs time proportional to the length of that copy and the sequence is only
+  ## scanned once no matter how many copies it has.
+  ##
+  ## Returns `(0, 0)` if `x` isn't a tandem repeat.
+  let s = x.string
+  var unitLen = s.len
+  var copies = 1
+  var failure = newSeq[int](seedLen) # the prefix function of the seed
+
+  # there has to be room for the seed and something else before it
+  while unitLen > seedLen:
+    let seedStart = unitLen - seedLen
+
+    # compute the prefix function of the seed (the short sequence at the end that must match exactly)
+    var k = 0
+    for i in 1..<seedLen:
+      while k > 0 and s[seedStart + i] != s[seedStart + k]:
+        k = failure[k - 1]
+      if s[seedStart + i] == s[seedStart + k]:
+        inc k
+      failure[i] = k
+
+    # search the sequence for the first occurrence of the seed that ends before the seed itself starts
+    var idx = -1
+    k = 0
+    for i in 0..seedStart:
+      while k > 0 and s[i] != s[seedStart + k]:
+        k = failure[k - 1]
+      if s[i] == s[seedStart + k]:
+        inc k
+      if k == seedLen:
+        idx = i - seedLen + 1
+        break
+    if idx == -1:
+      break
+
+    # everything before the seed is one copy of the unit
+    let period = seedStart - idx
+    if period == 0:
+      break
+
+    # compare the start of the sequence to the copy at the end
+    let maxMismatches = (idx.float * (1.0 - minIdentity)).int
+    var mismatches = 0
+    for i in 0..idx:
+      if s[i] != s[period + i]:
+        inc mismatches
     if mismatches > maxMismatches:
-      return Dna""
+      break
+
+    unitLen = period
+    inc copies
+
+  if copies == 1:
+    return (0, 0)
+  return (unitLen, copies)
+
+type
+  CircOptions = object
+    ## Settings needed to turn an input record into an output circRNA.
+    seedLen: int
+    minIdentity: float
+    canonicalize: bool
+    minLen: int
+    maxLen: int
+    maxMonomerLen: int
+    dedup: bool
+    computeKeys: bool # for the catalog and the IDs in the TSV
+
+  Deduplicator = object
+    ## Keeps the first occurrence of each monomer and records which ID every later copy is a duplicate of.
+    representatives: Table[SeqDigest, string]
+    duplicatesFile: File
+    duplicatesWriter: BufferedWriter
+    duplicates: int
+
+  CircColumns = object
+    ## The circRNAs found by the in-memory API, one column per field.
+    ids: seq[string]
+    monomers: seq[string]
+    ratios: seq[float]
+    originalLengths: seq[int]
+    unitLengths: seq[int]
+
+  CircStats = object
+    ## Tracking variables of the reader thread.
+    totalSeqs: int
+    totalBases: int
+
+  InputBatch = object
+    index: int
+    descriptions: seq[string]
+    sequences: seq[string]
+
+  CircBatch = object
+    index: int
+    descriptions: seq[string]
+    sequences: seq[string]
+    originalLens: seq[int]
+    digests: seq[SeqDigest] # only computed when deduplicating
+    keys: seq[uint64] # only computed when checking a catalog or writing a TSV
+
+  PipelineShutdown = object of CatchableError
+
+  Pipeline = object
+    ## State shared between the reader, the workers, and the writer.
+    ## Everything except `opts`, `infile`, `threads`, `verbose`, and `readerStats` must only be touched while holding
+    ## `lock`.
+    lock: Lock
+    workAvailable: Cond # signalled when a batch is added to `pending` or the reader finishes
+    resultAvailable: Cond # signalled when a batch is added to `finished` or the reader finishes
+    spaceAvailable: Cond # signalled when the writer has written a batch
+    pending: Deque[InputBatch]
+    finished: Table[int, CircBatch]
+    batchesRead: int
+    batchesWritten: int
+    maxInFlight: int
+    readerDone: bool
+    shutdown: bool # set if the writer fails so that the other threads stop instead of waiting for it
+    error: string
+    workers: int
+    opts: CircOptions
+    infile: string
+    threads: int
+    verbose: bool
+    readerStats: CircStats # only written by the reader
+
+const
+  batchRecords = 4096 # maximum number of records handed to a worker at once
+  batchBases = 4_000_000 # ... or the maximum number of bases, whichever comes first
+
+proc inRange(x: FastaView|string, opts: CircOptions): bool {.inline.} =
+  ## Check whether an input sequence is within the size range before doing anything with it.
+  x.len >= opts.minLen and x.len <= opts.maxLen
+
+proc toCirc(sequence: Dna, opts: CircOptions, circ: var Dna): bool =
+  ## Monomerize (and optionally canonicalize) an uppercase sequence, storing the result in `circ`.
+  ## Returns `false` if the sequence isn't a circRNA that should be included in the output.
+  let (unitLen, _) = sequence.monomerPeriod(opts.seedLen, opts.minIdentity)
+  if unitLen < opts.minLen or unitLen > opts.maxMonomerLen:
+    return false
+
+  circ = sequence[0 ..< unitLen]
+
+  # we only pay the price of canonicalizing if we're going to output
+  if opts.canonicalize:
+    circ = minimalCanonicalRotation(circ)
+  return true
+
+proc writeCirc(outfileWriter: var BufferedWriter, fai: var FaiWriter, outTsvWriter: var BufferedWriter, outTsv: bool,
+               description: string|MemSlice, sequence: string, originalLen: int, key: uint64) =
+  fai.add(outfileWriter, description, sequence.len)
+  outfileWriter.writeFasta(description, sequence)
+
+  # Write out the ratio between the original and monomerized sequence length to a TSV file
+  # This is useful since finding the original might take a long time
+  # The ID is computed here since we already have the final sequence in hand, so summarize doesn't need to rehash it
+  if outTsv:
+    outTsvWriter.writeRow(description, originalLen / sequence.len, originalLen, sequence.len, vdsearchId(key))
+
+proc isDuplicate(d: var Deduplicator, description: string|MemSlice, digest: SeqDigest): bool =
+  ## Check whether a monomer has been seen before, noting it as a duplicate if so and as a representative otherwise.
+  d.representatives.withValue(digest, representative):
+    d.duplicatesWriter.writeRow(description, representative[])
+    inc d.duplicates
+    return true
+  do:
+    d.representatives[digest] = $description
+    return false
 
-  return x[0..x.high - idx - seedLen]
+proc readBatches(p: ptr Pipeline) {.thread.} =
+  ## Read the input into batches and queue them up for the workers.
+  ## Sequences outside the size range are counted and dropped here without ever being copied.
+  var batch: InputBatch
+  var batchLen = 0
+
+  # tracking variables for progress reporting
+  var totalSeqs = 0
+  var totalBases = 0
+  var lastBaseCount = 0
+  var lastTime = getMonoTime()
 
-func monomerize(record: Record[Dna], seedLen=10, minIdentity=0.95): Record[Dna] =
-  # first, try to see if the sequence is a circRNA
-  var monomerized = record.cirit(seedLen, minIdentity)
+  template queueBatch() =
+    acquire(p.lock)
+    # don't get too far ahead of the writer or the finished batches pile up in memory
+    while p.batchesRead - p.batchesWritten >= p.maxInFlight and not p.shutdown:
+      wait(p.spaceAvailable, p.lock)
+    if p.shutdown:
+      release(p.lock)
+      raise newException(PipelineShutdown, "The writer stopped")
+    batch.index = p.batchesRead
+    p.pending.addLast(move batch)
+    inc p.batchesRead
+    signal(p.workAvailable)
+    release(p.lock)
+    batch = InputBatch()
+    batchLen = 0
 
-  # if not, go on
-  if monomerized == Dna"":
-    return toRecord[Dna](monomerized, record.description)
+  try:
+    for view in readFastaViews(p.infile, threads=p.threads, maxLen=p.opts.maxLen):
+      inc totalSeqs
+      totalBases.inc(view.len)
 
-  var newMonomer: Dna
-  while monomerized != Dna"":
-    newMonomer = monomerized.cirit(seedLen, minIdentity)
-    if newMonomer == Dna"":
+      if p.verbose and totalSeqs mod 10000000 == 0:
+        let elapsed = (getMonoTime() - lastTime).inMilliseconds.int
+        let rate = (((totalBases - lastBaseCount).float / 1000000) / (max(elapsed, 1) / 1000)).int # the number of Mb divided by seconds
+        stderr.writeLine(&"                    Processed {($totalSeqs).insertSep(',')} sequences at {($rate).insertSep(',')} Mbp/sec")
+        lastBaseCount = totalBases
+        lastTime = getMonoTime()
+
+      if not view.inRange(p.opts):
+        continue
+      batchLen.inc(view.len)
+      batch.descriptions.add($view.description)
+      batch.sequences.add("")
+      view.sequence.toUpperAscii(batch.sequences[^1])
+      if batch.descriptions.len >= batchRecords or batchLen >= batchBases:
+        queueBatch()
+    if batch.descriptions.len > 0:
+      queueBatch()
+  except PipelineShutdown:
+    discard # the writer has its own error to report
+  except CatchableError as e:
+    acquire(p.lock)
+    p.error = e.msg
+    release(p.lock)
+  p.readerStats.totalSeqs = totalSeqs
+  p.readerStats.totalBases = totalBases
+
+  # wake everyone up so they can notice that there's no more input
+  acquire(p.lock)
+  p.readerDone = true
+  for _ in 0..<p.workers:
+    signal(p.workAvailable)
+  signal(p.resultAvailable)
+  release(p.lock)
+
+proc processBatches(p: ptr Pipeline) {.thread.} =
+  ## Take batches off the queue and find the circRNAs in them until the input runs out.
+  while true:
+    acquire(p.lock)
+    while p.pending.len == 0 and not p.readerDone and not p.shutdown:
+      wait(p.workAvailable, p.lock)
+    if p.pending.len == 0 or p.shutdown:
+      release(p.lock)
       break
-    monomerized = newMonomer
+    let batch = p.pending.popFirst()
+    release(p.lock)
 
-  return toRecord[Dna](monomerized, record.description)
+    var circs = CircBatch(index: batch.index)
+    var circ: Dna
+    for i in 0..batch.sequences.high:
+      if toCirc(batch.sequences[i].Dna, p.opts, circ):
+        circs.descriptions.add(batch.descriptions[i])
+        circs.sequences.add(circ.string)
+        circs.originalLens.add(batch.sequences[i].len)
+        if p.opts.dedup:
+          circs.digests.add(blake2b(circ.string, 16))
+        if p.opts.computeKeys:
+          circs.keys.add(catalogKey(circ.string))
+
+    acquire(p.lock)
+    p.finished[batch.index] = move circs
+    signal(p.resultAvailable)
+    release(p.lock)
 
 proc find_circs*(infile: string,
                  outfile: string,
@@ -57,28 +290,81 @@ proc find_circs*(infile: string,
                  minLen: Natural = 1,
                  maxLen: Natural = high(int),
                  maxMonomerLen: Natural = high(int),
-                 verbose: bool = false
-                ): (int, int, int, int) {.exportpy.} =
+                 verbose: bool = false,
+                 threads: Natural = 1,
+                 ordered: bool = true,
+                 dedup: bool = false,
+                 catalogDir: string = "",
+                 novelOnly: bool = false
+                ): (int, int, int, int, int, int) {.releasesGil, exportpy.} =
+  ## Find the circRNAs in `infile` and write their monomers to `outfile`.
+  ##
+  ## With more than one thread, a reader thread splits the input into batches that are monomerized by a pool of
+  ## `threads` workers. If `ordered` is false, batches are written as soon as they are done rather than in input order.
+  ##
+  ## If `dedup` is true, only the first copy of each monomer is written out and every later copy is listed next to
+  ## the ID it duplicates in `<outfile>.duplicates.tsv`. This is only meaningful for canonicalized monomers.
+  ##
+  ## An uncompressed `outfile` is indexed in `<outfile>.fai` as it's written.
+  ##
+  ## The TSV has the `NV_` ID of each monomer so that later steps don't need to hash it again.
+  ##
+  ## If `catalogDir` is given, the monomers that are written out are looked up in the catalog there and the new ones
+  ## are added to it. With `novelOnly`, monomers that are already in the catalog are left out of the output.
+  ##
+  ## Returns the number of circRNAs written out (*i.e.* not counting duplicates or, with `novelOnly`, the ones already
+  ## in the catalog), sequences, bases, the time taken in milliseconds, the number of duplicates, and the number of
+  ## monomers that were already in the catalog.
 
   # Warn the user if they compiled wrong
   if not defined(danger):
     echo "Not compiled with -d:danger. This will likely cause severe slowdowns."
 
-  let outfileFile = open(outfile, fmWrite) # the output file as an opend File object
-  defer: outfileFile.close()
+  var fai = initFaiWriter(outfile) # closed last so that it's newer than the output
+  defer: fai.close()
+  let output = openFastx(outfile, fmWrite, threads=max(threads, 1)) # compressed if the extension says so
+  defer: output.close()
+  var outfileWriter = initBufferedWriter(output.file) # records are written out in large blocks
+  defer: outfileWriter.flush()
 
   var outTsvFile: File
   defer: outTsvFile.close()
+  var outTsvWriter: BufferedWriter
+  defer: outTsvWriter.flush()
 
   if outTsv:
-    outTsvFile = open(changeFileExt(outfile, "tsv"), fmWrite) # the output file as an opend File object
-    outTsvFile.writeLine("seq_id", "\t", "ratio", "\t", "original_length", "\t", "unit_length")
+    outTsvFile = open(changeFileExt(outfile.stripCompressionExt, "tsv"), fmWrite) # the output file as an opend File object
+    outTsvWriter = initBufferedWriter(outTsvFile)
+    outTsvWriter.writeRow("seq_id", "ratio", "original_length", "unit_length", "vdsearch_id")
+
+  let opts = CircOptions(seedLen: seedLen, minIdentity: minIdentity, canonicalize: canonicalize,
+                         minLen: minLen, maxLen: maxLen, maxMonomerLen: maxMonomerLen, dedup: dedup,
+                         computeKeys: outTsv or catalogDir != "")
+
+  var deduplicator: Deduplicator
+  defer: deduplicator.duplicatesFile.close()
+  defer: deduplicator.duplicatesWriter.flush()
+  if dedup:
+    deduplicator.duplicatesFile = open(changeFileExt(outfile.stripCompressionExt, "") & ".duplicates.tsv", fmWrite)
+    deduplicator.duplicatesWriter = initBufferedWriter(deduplicator.duplicatesFile)
+    deduplicator.duplicatesWriter.writeRow("seq_id", "representative")
 
-  var monomerized: Record[Dna]
-  var originalLen = 0
+  var known = 0
+  var seenBefore: Catalog
+  if catalogDir != "":
+    seenBefore = openCatalog(catalogDir)
+  defer: seenBefore.close()
+
+  template skipKnown(key: uint64): bool =
+    ## Check a monomer against the catalog, returning whether to leave it out.
+    var skip = false
+    if catalogDir != "" and not seenBefore.addIfNovel(key):
+      inc known
+      skip = novelOnly
+    skip
 
   # tracking variables
-  var count = 0
+  var count = 0 # of circRNAs written out
   var totalSeqs = 0
   var totalBases = 0
 
@@ -87,43 +373,175 @@ proc find_circs*(infile: string,
   var lastTime = getMonoTime()
   var startTime = getMonoTime()
 
-  let infileFile = if infile == "-": stdin else: open(infile, fmRead) # the input file as an opend File object
-  defer: infileFile.close()
+  if threads <= 1:
+    var sequence = "" # reused for every record so that we don't allocate each time
+    var circ: Dna
+    try:
+      # over-length sequences are only counted, never held in memory
+      for view in readFastaViews(infile, maxLen=maxLen): # stdin if infile is "-"
+
+        inc totalSeqs
+        totalBases.inc(view.len)
+
+        if verbose and totalSeqs mod 10000000 == 0:
+          let elapsed = (getMonoTime() - lastTime).inMilliseconds.int
+          let rate = (((totalBases - lastBaseCount).float / 1000000) / (elapsed / 1000)).int # the number of Mb divided by seconds
+          stderr.writeLine(&"                    Processed {($totalSeqs).insertSep(',')} sequences at {($rate).insertSep(',')} Mbp/sec")
+          lastBaseCount = totalBases
+          lastTime = getMonoTime()
+
+        # bail early if the sequence is completely out of the size range
+        if not view.inRange(opts):
+          continue
+
+        # we have to capitalize because the input is not always uppercase
+        view.sequence.toUpperAscii(sequence)
+        if toCirc(sequence.Dna, opts, circ):
+          if dedup and deduplicator.isDuplicate(view.description, blake2b(circ.string, 16)):
+            continue
+          let key = if opts.computeKeys: catalogKey(circ.string) else: 0'u64
+          if skipKnown(key):
+            continue
+          writeCirc(outfileWriter, fai, outTsvWriter, outTsv, view.description, circ.string, view.len, key)
+          inc count
+    except CatchableError:
+      fai.abort() # the output is incomplete
+      raise
+
+    seenBefore.commit()
+    return (count, totalSeqs, totalBases, (getMonoTime() - startTime).inMilliseconds.int, deduplicator.duplicates,
+            known)
 
-  for record in readFasta[Dna](infileFile):
+  var p = Pipeline(pending: initDeque[InputBatch](), maxInFlight: threads * 4, workers: threads, opts: opts,
+                   infile: infile, threads: threads, verbose: verbose)
+  initLock(p.lock)
+  initCond(p.workAvailable)
+  initCond(p.resultAvailable)
+  initCond(p.spaceAvailable)
+  defer:
+    deinitCond(p.spaceAvailable)
+    deinitCond(p.resultAvailable)
+    deinitCond(p.workAvailable)
+    deinitLock(p.lock)
 
-    inc totalSeqs
-    totalBases.inc(record.len)
+  var reader: Thread[ptr Pipeline]
+  var workers = newSeq[Thread[ptr Pipeline]](threads)
+  createThread(reader, readBatches, addr p)
+  for i in 0..<threads:
+    createThread(workers[i], processBatches, addr p)
 
-    if verbose and totalSeqs mod 10000000 == 0:
-      let elapsed = (getMonoTime() - lastTime).inMilliseconds.int
-      let rate = (((totalBases - lastBaseCount).float / 1000000) / (elapsed / 1000)).int # the number of Mb divided by seconds
-      stderr.writeLine(&"                    Processed {($totalSeqs).insertSep(',')} sequences at {($rate).insertSep(',')} Mbp/sec")
-      lastBaseCount = totalBases
-      lastTime = getMonoTime()
+  # this thread writes the finished batches out
+  try:
+    acquire(p.lock)
+    while not (p.readerDone and p.batchesWritten == p.batchesRead):
+      var batch: CircBatch
+      var found = false
+      var next = p.batchesWritten
+      if not ordered:
+        for index in p.finished.keys:
+          next = index
+          break
+      found = p.finished.pop(next, batch)
+      if not found:
+        wait(p.resultAvailable, p.lock)
+        continue
+      inc p.batchesWritten
+      signal(p.spaceAvailable)
+      release(p.lock)
+      for i in 0..batch.sequences.high:
+        if dedup and deduplicator.isDuplicate(batch.descriptions[i], batch.digests[i]):
+          continue
+        let key = if opts.computeKeys: batch.keys[i] else: 0'u64
+        if skipKnown(key):
+          continue
+        writeCirc(outfileWriter, fai, outTsvWriter, outTsv, batch.descriptions[i], batch.sequences[i],
+                  batch.originalLens[i], key)
+        inc count
+      acquire(p.lock)
+    release(p.lock)
+  except CatchableError:
+    fai.abort() # the output is incomplete
+    raise
+  finally:
+    # the lock isn't held here since writing is the only thing that can fail
+    # the other threads must be done with `p` before it's destroyed, so wake them up to stop if the writer failed
+    acquire(p.lock)
+    p.shutdown = true
+    for _ in 0..<p.workers:
+      signal(p.workAvailable)
+    signal(p.spaceAvailable)
+    release(p.lock)
+    joinThread(reader)
+    joinThreads(workers)
 
-    # bail early if the sequence is completely out of the size range
-    originalLen = record.len
-    if originalLen < minLen or originalLen > maxLen:
+  if p.error != "":
+    fai.abort() # the output is incomplete
+    raise newException(IOError, p.error)
+
+  totalSeqs = p.readerStats.totalSeqs
+  totalBases = p.readerStats.totalBases
+
+  seenBefore.commit()
+  return (count, totalSeqs, totalBases, (getMonoTime() - startTime).inMilliseconds.int, deduplicator.duplicates,
+          known)
+
+proc add(columns: var CircColumns, description: string|MemSlice, circ: Dna, originalLen: int) =
+  columns.ids.add($description)
+  columns.monomers.add(circ.string)
+  columns.ratios.add(originalLen / circ.len)
+  columns.originalLengths.add(originalLen)
+  columns.unitLengths.add(circ.len)
+
+template toTuple(columns: var CircColumns): untyped =
+  # nimpy turns tuples into Python tuples
+  (move columns.ids, move columns.monomers, move columns.ratios, move columns.originalLengths, move columns.unitLengths)
+
+proc find_circs_batch*(ids: seq[string],
+                       sequences: seq[string],
+                       seedLen: Natural = 10,
+                       minIdentity: float = 0.95,
+                       canonicalize: bool = true,
+                       minLen: Natural = 1,
+                       maxLen: Natural = high(int),
+                       maxMonomerLen: Natural = high(int),
+                      ): (seq[string], seq[string], seq[float], seq[int], seq[int]) {.releasesGil, exportpy.} =
+  ## Find the circRNAs among in-memory sequences instead of a file.
+  ##
+  ## Returns the IDs, monomers, ratios, original lengths, and unit lengths of the circRNAs as parallel lists.
+  if ids.len != sequences.len:
+    raise newException(ValueError, &"Got {ids.len} IDs but {sequences.len} sequences")
+  let opts = CircOptions(seedLen: seedLen, minIdentity: minIdentity, canonicalize: canonicalize,
+                         minLen: minLen, maxLen: maxLen, maxMonomerLen: maxMonomerLen)
+  var columns: CircColumns
+  var sequence = ""
+  var circ: Dna
+  for i in 0..sequences.high:
+    if not sequences[i].inRange(opts):
       continue
+    sequences[i].toUpperAscii(sequence)
+    if toCirc(sequence.Dna, opts, circ):
+      columns.add(ids[i], circ, sequences[i].len)
+  return columns.toTuple
 
-    # we have to capitalize because the input is not always uppercase
-    record.sequence = record.sequence.string.toUpperAscii().Dna
-    
-    monomerized = record.monomerize(seedLen, minIdentity)
-
-    if minLen <= monomerized.len and monomerized.len <= maxMonomerLen:
-      
-      # we only pay the price of canonicalizing if we're going to output
-      if canonicalize:
-        monomerized = toRecord[Dna](minimalCanonicalRotation(monomerized), monomerized.description)
-
-      writeLine(outfileFile, monomerized.asFasta())
-      inc count
-      
-      # Write out the ratio between the original and monomerized sequence length to a TSV file
-      # This is useful since finding the original might take a long time
-      if outTsv:
-        writeLine(outTsvFile, monomerized.description, "\t", originalLen / monomerized.len, "\t", originalLen, "\t", monomerized.len)
-
-  return (count, totalSeqs, totalBases, (getMonoTime() - startTime).inMilliseconds.int)
\ No newline at end of file
+proc find_circs_buffer*(fasta: string,
+                        seedLen: Natural = 10,
+                        minIdentity: float = 0.95,
+                        canonicalize: bool = true,
+                        minLen: Natural = 1,
+                        maxLen: Natural = high(int),
+                        maxMonomerLen: Natural = high(int),
+                       ): (seq[string], seq[string], seq[float], seq[int], seq[int]) {.releasesGil, exportpy.} =
+  ## Like `find_circs_batch` but for the contents of an uncompressed FASTA file that's already in memory.
+  ## The IDs are the whole header lines (without the `>`), as in the output of `find_circs`.
+  let opts = CircOptions(seedLen: seedLen, minIdentity: minIdentity, canonicalize: canonicalize,
+                         minLen: minLen, maxLen: maxLen, maxMonomerLen: maxMonomerLen)
+  var columns: CircColumns
+  var sequence = ""
+  var circ: Dna
+  for view in parseFastaViews(fasta, maxLen=maxLen):
+    if not view.inRange(opts):
+      continue
+    view.sequence.toUpperAscii(sequence)
+    if toCirc(sequence.Dna, opts, circ):
+      columns.add(view.description, circ, view.len)
+  return columns.toTuple
@@ -0,0 +1,43 @@
+## Releasing Python's global interpreter lock (GIL) while the kernels run.
+##
+## nimpy converts the arguments of an exported proc to Nim values before its body runs and converts the result back
+## afterwards, so the body itself never touches a Python object. Marking it with `releasesGil` lets other Python threads
+## (*e.g.* more kernel calls in a `ThreadPoolExecutor`, or a progress bar) run in the meantime.
+
+import std/[dynlib, macros]
+
+type
+  PyThreadState = pointer
+
+# The interpreter's C API is looked up at runtime, just like nimpy does, instead of being linked against. If it can't
+# be found (e.g. outside of Python), the GIL is simply left alone.
+let python = loadLib()
+let saveThread = if python.isNil: nil
+                 else: cast[proc (): PyThreadState {.cdecl, gcsafe.}](python.symAddr("PyEval_SaveThread"))
+let restoreThread = if python.isNil: nil
+                    else: cast[proc (state: PyThreadState) {.cdecl, gcsafe.}](python.symAddr("PyEval_RestoreThread"))
+
+proc releaseGil(): PyThreadState =
+  ## Release the GIL, returning the state needed to take it back.
+  if saveThread.isNil or restoreThread.isNil:
+    return nil
+  return saveThread()
+
+proc acquireGil(state: PyThreadState) =
+  if not state.isNil:
+    restoreThread(state)
+
+macro releasesGil*(p: untyped): untyped =
+  ## Run the body of a proc without holding the GIL. List it before `exportpy` in the pragmas.
+  ## The body must not call back into Python.
+  result = p
+  let body = p.body
+  let state = genSym(nskLet, "state")
+  let release = bindSym"releaseGil"
+  let acquire = bindSym"acquireGil"
+  result.body = quote do:
+    let `state` = `release`()
+    try:
+      `body`
+    finally:
+      `acquire`(`state`)
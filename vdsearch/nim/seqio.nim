@@ -0,0 +1,211 @@
+## Opening sequence files for the kernels.
+##
+## Compressed files are detected by their extension and transparently piped through an external (de)compressor so
+## that the kernels can keep working with plain `File` objects. Where the format allows it, the (de)compressor is run
+## with multiple threads.
+
+import std/[os, strformat, strutils, macros]
+from std/memfiles import MemSlice
+from std/posix import popen, pclose
+
+type
+  Compression* = enum
+    Uncompressed, Gzip, Bgzf, Zstd
+
+  FastxFile* = object
+    ## A sequence file opened with `openFastx`. Read from or write to `file` and then call `close`.
+    file*: File
+    path: string
+    mode: FileMode
+    piped: bool
+
+  BufferedWriter* = object
+    ## Collects output in memory and writes it to `file` in large blocks. Call `flush` when you're done.
+    file: File
+    buffer: string
+    capacity: int
+    flushed: int # how many bytes have been written to `file` so far
+
+const compressionExts = {
+  ".gz": Gzip, ".gzip": Gzip,
+  ".bgz": Bgzf, ".bgzf": Bgzf,
+  ".zst": Zstd, ".zstd": Zstd,
+}
+
+proc compressionOf*(path: string): Compression =
+  ## Guess how a file is compressed from its extension.
+  let ext = path.splitFile.ext.toLowerAscii
+  for (compressedExt, compression) in compressionExts:
+    if ext == compressedExt:
+      return compression
+  return Uncompressed
+
+proc stripCompressionExt*(path: string): string =
+  ## Remove the compression extension (if any) from a path, *e.g.* `circs.fasta.gz` becomes `circs.fasta`.
+  if path.compressionOf == Uncompressed:
+    return path
+  return path.changeFileExt("")
+
+proc isBgzf(path: string): bool =
+  ## Check the gzip header for the BGZF extra field so that we can use a parallel decompressor.
+  var f: File
+  if not open(f, path, fmRead):
+    return false
+  defer: f.close()
+  var header: array[14, uint8]
+  if f.readBytes(header, 0, header.len) != header.len:
+    return false
+  # gzip magic number, FEXTRA flag set, and a "BC" subfield
+  return header[0] == 0x1f and header[1] == 0x8b and (header[3] and 0x04) != 0 and
+         header[12] == uint8('B') and header[13] == uint8('C')
+
+proc requireExe(candidates: openArray[string], purpose: string): string =
+  ## Return the first of the `candidates` that's installed or raise an `IOError`.
+  for candidate in candidates:
+    if findExe(candidate) != "":
+      return candidate
+  let names = candidates.join(" or ")
+  raise newException(IOError, &"Unable to find {names} to {purpose}. Are you sure that it's installed?")
+
+proc decompressCommand(path: string, compression: Compression, threads: int): string =
+  let quoted = path.quoteShell
+  case compression
+  of Uncompressed:
+    raise newException(ValueError, &"{path} is not compressed")
+  of Gzip, Bgzf:
+    # plain gzip files can only be decompressed on one core but BGZF blocks can be decompressed in parallel
+    let tool = if path.isBgzf: requireExe(["bgzip", "pigz", "gzip"], &"decompress {path}")
+               else: requireExe(["pigz", "gzip"], &"decompress {path}")
+    case tool
+    of "bgzip": &"bgzip -dc -@ {threads} {quoted}"
+    of "pigz": &"pigz -dc -p {threads} {quoted}"
+    else: &"gzip -dc {quoted}"
+  of Zstd:
+    discard requireExe(["zstd"], &"decompress {path}")
+    &"zstd -dcq {quoted}"
+
+proc decompressor*(path: string, threads: Positive = 1): string =
+  ## The shell command that writes the decompressed contents of `path` to stdout, or `""` if it isn't compressed.
+  ## For tools that can only read plain text.
+  let compression = path.compressionOf
+  if compression == Uncompressed:
+    return ""
+  return decompressCommand(path, compression, threads)
+
+proc compressCommand(path: string, compression: Compression, threads: int): string =
+  let quoted = path.quoteShell
+  case compression
+  of Uncompressed:
+    raise newException(ValueError, &"{path} is not compressed")
+  of Gzip:
+    let tool = requireExe(["pigz", "gzip"], &"compress {path}")
+    if tool == "pigz": &"pigz -c -p {threads} > {quoted}" else: &"gzip -c > {quoted}"
+  of Bgzf:
+    discard requireExe(["bgzip"], &"compress {path}")
+    &"bgzip -c -@ {threads} > {quoted}"
+  of Zstd:
+    discard requireExe(["zstd"], &"compress {path}")
+    &"zstd -cq -T{threads} > {quoted}"
+
+proc openFastx*(path: string, mode: FileMode = fmRead, threads: Positive = 1): FastxFile =
+  ## Open a sequence file for reading or writing, (de)compressing it if its extension says it's compressed.
+  ##
+  ## A path of `-` reads from stdin or writes to stdout.
+  result = FastxFile(path: path, mode: mode)
+  if path == "-":
+    result.file = if mode == fmRead: stdin else: stdout
+    return
+  let compression = path.compressionOf
+  if compression == Uncompressed:
+    result.file = open(path, mode)
+    return
+  if mode notin {fmRead, fmWrite}:
+    raise newException(IOError, &"Compressed files can only be read or written, not opened with {mode}: {path}")
+  if mode == fmRead and not fileExists(path):
+    raise newException(IOError, &"cannot open: {path}")
+  let command = if mode == fmRead: decompressCommand(path, compression, threads)
+                else: compressCommand(path, compression, threads)
+  let pipeMode: cstring = if mode == fmRead: "r" else: "w"
+  result.file = popen(command.cstring, pipeMode)
+  if result.file == nil:
+    raise newException(IOError, &"Unable to run `{command}`")
+  result.piped = true
+
+proc close*(f: FastxFile) =
+  ## Close the file, waiting for the (de)compressor to finish if there is one.
+  if f.file == stdin or f.file == stdout:
+    return
+  if not f.piped:
+    f.file.close()
+    return
+  # a reader that stops early makes the decompressor exit with SIGPIPE, which is fine
+  let stoppedEarly = f.mode == fmRead and not f.file.endOfFile
+  let status = pclose(f.file)
+  if status != 0 and not stoppedEarly:
+    let action = if f.mode == fmRead: "decompress" else: "compress"
+    raise newException(IOError, &"Unable to {action} {f.path}")
+
+proc initBufferedWriter*(file: File, capacity: Positive = 1 shl 20): BufferedWriter =
+  ## Create a writer that holds up to `capacity` bytes before writing them to `file`.
+  BufferedWriter(file: file, buffer: newStringOfCap(capacity), capacity: capacity)
+
+proc flush*(w: var BufferedWriter) =
+  ## Write out everything that's buffered.
+  if w.buffer.len == 0:
+    return
+  if w.file.writeBuffer(w.buffer[0].addr, w.buffer.len) != w.buffer.len:
+    raise newException(IOError, "Unable to write output")
+  w.flushed.inc(w.buffer.len)
+  w.buffer.setLen(0) # keeps the allocation so that the buffer is reused
+
+proc position*(w: BufferedWriter): int {.inline.} =
+  ## How many bytes have been added to the writer, *i.e.* the offset in the output that the next byte will go to.
+  w.flushed + w.buffer.len
+
+template flushIfFull(w: var BufferedWriter) =
+  if w.buffer.len >= w.capacity:
+    w.flush()
+
+proc add*(w: var BufferedWriter, x: string) {.inline.} =
+  w.buffer.add x
+  w.flushIfFull()
+
+proc add*(w: var BufferedWriter, x: char) {.inline.} =
+  w.buffer.add x
+  w.flushIfFull()
+
+proc addRaw*(w: var BufferedWriter, data: pointer, size: int) {.inline.} =
+  ## Add `size` bytes starting at `data`, *e.g.* to write out binary records.
+  if size > 0:
+    let start = w.buffer.len
+    w.buffer.setLen(start + size)
+    copyMem(w.buffer[start].addr, data, size)
+    w.flushIfFull()
+
+proc add*(w: var BufferedWriter, x: MemSlice) {.inline.} =
+  w.addRaw(x.data, x.size)
+
+proc add*(w: var BufferedWriter, x: int) {.inline.} =
+  w.buffer.addInt x
+  w.flushIfFull()
+
+proc add*(w: var BufferedWriter, x: float) {.inline.} =
+  w.buffer.addFloat x # formatted the same way as `$`
+  w.flushIfFull()
+
+proc writeFasta*(w: var BufferedWriter, description: string|MemSlice, sequence: string|MemSlice) =
+  ## Write a FASTA record straight from its parts without building the whole record as a string first.
+  w.add '>'
+  w.add description
+  w.add '\n'
+  w.add sequence
+  w.add '\n'
+
+macro writeRow*(w: var BufferedWriter, fields: varargs[typed]): untyped =
+  ## Write a tab-separated row, *e.g.* `writer.writeRow(id, ratio, length)`.
+  result = newStmtList()
+  for i, field in fields:
+    if i > 0:
+      result.add newCall(bindSym"add", w, newLit('\t'))
+    result.add newCall(bindSym"add", w, field)
+  result.add newCall(bindSym"add", w, newLit('\n'))
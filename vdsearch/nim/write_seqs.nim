@@ -1,32 +1,365 @@
 import bioseq
+import seqio
+import faidx
+import catalog
 import nimpy
-import std/[sets, tables, os, strutils]
+import gil
+import std/[sets, tables, os, strformat, strutils, sequtils, lists, memfiles, heapqueue, random]
 
-proc write_seqs*(infile: string, outfile: string, ids: seq[string]): void {.exportpy.} =
+proc write_seqs*(infile: string, outfile: string, ids: seq[string]): void {.releasesGil, exportpy.} =
+  ## Write the records of `infile` whose IDs are in `ids` to `outfile`, in the order they're in `infile`.
+  ##
+  ## If `infile` has an up-to-date `.fai` index, the records are read by seeking straight to them.
   let idSet = toHashSet(ids)
-  let outfileFile = open(outfile, fmWrite) # the output file as an opend File object
-  defer: outfileFile.close()
-  for record in readFasta[Dna](infile):
+  let output = openFastx(outfile, fmWrite) # compressed if the extension says so
+  defer: output.close()
+  var outfileWriter = initBufferedWriter(output.file) # records are written out in large blocks
+  defer: outfileWriter.flush()
+
+  if infile.hasIndex:
+    for (description, sequence) in indexedRecords(infile, idSet):
+      outfileWriter.writeFasta(description, sequence)
+    return
+
+  var id = "" # reused so that we don't allocate for every record
+  for view in readFastaViews(infile):
     # Infernal only reports the ID, not the full header so we have to parse it
     # I'm not a fan of this trying to guess FASTA header format
-    if record.description.splitWhitespace()[0] in idSet:
-      outfileFile.writeLine(record.asFasta())
+    view.description.firstWord(id)
+    if id in idSet:
+      outfileWriter.writeFasta(view)
 
-proc write_clusters*(infile: string, outdir: string, mapping: Table[string, string], clusters: seq[string]): void {.exportpy.} =
-  ## Write out a fasta file for each cluster.
-  ## 
-  ## Note: `outdir` must exist and be writable or the function will fail.  
+proc route_seqs*(infile: string, outfiles: seq[string], ids: seq[seq[string]], union: string = ""): seq[int] {.releasesGil, exportpy.} =
+  ## Write the records of `infile` whose IDs are in `ids[i]` to `outfiles[i]` for every `i` in a single pass.
+  ##
+  ## If `union` is given, every record that's in any of the ID sets is also written there once, with its header trimmed
+  ## to the ID. The records of `ids[0]` come first, then those of `ids[1]` that aren't in `ids[0]`, and so on, each in
+  ## the order they're in `infile`. Only the records that don't belong to the first set are held in memory until the
+  ## end.
+  ##
+  ## Returns the number of records written to each of `outfiles`.
+  if outfiles.len != ids.len:
+    raise newException(ValueError, &"Got {outfiles.len} output files but {ids.len} ID sets")
 
-  var outfiles = initTable[string, File]()
+  # which outputs each ID goes to, in order
+  var routes = initTable[string, seq[int]]()
+  for i, idSet in ids:
+    for id in idSet:
+      let destinations = addr routes.mgetOrPut(id, @[])
+      if destinations[].len == 0 or destinations[][^1] != i: # an ID could be listed twice in the same set
+        destinations[].add(i)
 
+  var outputs: seq[FastxFile]
+  var writers: seq[BufferedWriter]
+  var unionOutput: FastxFile
+  var unionWriter: BufferedWriter
+  var later = newSeq[string](ids.len) # union records that come after the ones of the first set
+  var unionSeen = initHashSet[string]()
+  result = newSeq[int](ids.len)
   try:
-    for cluster in clusters:
-      outfiles[cluster] = open(outdir / cluster & ".fasta", fmWrite) # the output file as an opend File object
+    for outfile in outfiles:
+      outputs.add(openFastx(outfile, fmWrite)) # compressed if the extension says so
+      writers.add(initBufferedWriter(outputs[^1].file))
+    if union != "":
+      unionOutput = openFastx(union, fmWrite)
+      unionWriter = initBufferedWriter(unionOutput.file)
+
+    var id = "" # reused so that we don't allocate for every record
+    template route(description, sequence: MemSlice) =
+      description.firstWord(id)
+      routes.withValue(id, destinations):
+        for i in destinations[]:
+          writers[i].writeFasta(description, sequence)
+          inc result[i]
+        if union != "" and not unionSeen.containsOrIncl(id):
+          let first = destinations[][0]
+          if first == 0:
+            unionWriter.writeFasta(id, sequence)
+          else:
+            later[first].add('>')
+            later[first].add(id)
+            later[first].add('\n')
+            later[first].add($sequence)
+            later[first].add('\n')
+
+    if infile.hasIndex:
+      var wanted = initHashSet[string]()
+      for id in routes.keys:
+        wanted.incl(id)
+      for (description, sequence) in indexedRecords(infile, wanted):
+        route(description, sequence)
+    else:
+      for view in readFastaViews(infile):
+        route(view.description, view.sequence)
 
-    for record in readFasta[Dna](infile):
-      let clusterFile = outfiles[mapping[record.description]]
-      clusterFile.writeLine(record.asFasta())
-  
+    if union != "":
+      for records in later:
+        unionWriter.add(records)
+  finally:
+    for i in 0..outputs.high:
+      writers[i].flush()
+      outputs[i].close()
+    if union != "":
+      unionWriter.flush()
+      unionOutput.close()
+
+proc shard_seqs*(infile: string, outfiles: seq[string]): (int, int) {.releasesGil, exportpy.} =
+  ## Split `infile` into one shard per file in `outfiles` with about the same number of bases in each, *e.g.* to
+  ## search them in parallel. Each record goes to the shard with the fewest bases so far.
+  ##
+  ## Returns the number of sequences and bases in `infile`.
+  if outfiles.len == 0:
+    raise newException(ValueError, "At least one shard is needed")
+  var outputs: seq[FastxFile]
+  var writers: seq[BufferedWriter]
+  var smallest = initHeapQueue[(int, int)]() # the number of bases in each shard and its index
+  var totalSeqs = 0
+  var totalBases = 0
+  try:
+    for i, outfile in outfiles:
+      outputs.add(openFastx(outfile, fmWrite)) # compressed if the extension says so
+      writers.add(initBufferedWriter(outputs[^1].file))
+      smallest.push((0, i))
+    for view in readFastaViews(infile):
+      let (bases, i) = smallest.pop()
+      writers[i].writeFasta(view)
+      smallest.push((bases + view.len, i))
+      inc totalSeqs
+      totalBases.inc(view.len)
   finally:
-    for cluster in clusters:
-      outfiles[cluster].close()
+    for i in 0..outputs.high:
+      writers[i].flush()
+      outputs[i].close()
+  return (totalSeqs, totalBases)
+
+proc sample_seqs*(infile: string, outfile: string, fraction: float, seed: int = 0): (int, int, int) {.releasesGil, exportpy.} =
+  ## Write a random sample of about `fraction` of the records in `infile` to `outfile`. The same `seed` picks the same
+  ## records from the same input.
+  ##
+  ## Returns the number of sequences and bases in `infile` and the number of sequences in the sample.
+  if fraction < 0.0 or fraction > 1.0:
+    raise newException(ValueError, &"The fraction to sample must be between 0 and 1, not {fraction}")
+  var rng = initRand(seed)
+  var output = openFastx(outfile, fmWrite)
+  defer: output.close()
+  var writer = initBufferedWriter(output.file)
+  defer: writer.flush()
+  var totalSeqs = 0
+  var totalBases = 0
+  var sampled = 0
+  for view in readFastaViews(infile):
+    inc totalSeqs
+    totalBases.inc(view.len)
+    if rng.rand(1.0) < fraction:
+      writer.writeFasta(view)
+      inc sampled
+  return (totalSeqs, totalBases, sampled)
+
+proc junction_windows*(infile: string, outfile: string, window: Positive, suffix: string): (int, int) {.releasesGil, exportpy.} =
+  ## Write the wrap-around junction of each circular sequence in `infile` to `outfile`, *i.e.* its last `window` bases
+  ## followed by its first `window` bases. Searching these along with the sequences finds the hits that span the
+  ## arbitrary start of a circular sequence without searching it twice. Sequences that aren't longer than `window` only
+  ## have all but one of their bases on either side, so that the junction is in their window only once, and those with
+  ## a single base have no window.
+  ##
+  ## Each window is named after its sequence with `suffix` added and its description has the length of the sequence
+  ## and how many bases come from its end, *e.g.* `>seq1/junction length=359 tail=150`, so that positions in the
+  ## window can be mapped back to the sequence.
+  ##
+  ## Returns the number of sequences and bases in `infile`.
+  var output = openFastx(outfile, fmWrite)
+  defer: output.close()
+  var writer = initBufferedWriter(output.file)
+  defer: writer.flush()
+  var id = "" # reused so that we don't allocate for every record
+  var totalSeqs = 0
+  var totalBases = 0
+  for view in readFastaViews(infile):
+    inc totalSeqs
+    totalBases.inc(view.len)
+    if view.len < 2:
+      continue
+    let tail = min(window, view.len - 1) # as many bases come from the start too
+    view.description.firstWord(id)
+    writer.add '>'
+    writer.add id
+    writer.add suffix
+    writer.add " length="
+    writer.add view.len
+    writer.add " tail="
+    writer.add tail
+    writer.add '\n'
+    writer.addRaw(view.sequence[view.len - tail].addr, tail)
+    writer.addRaw(view.sequence[0].addr, tail)
+    writer.add '\n'
+  return (totalSeqs, totalBases)
+
+proc decompress_command*(infile: string, threads: Positive = 1): string {.exportpy.} =
+  ## The shell command that decompresses `infile` to stdout the way the kernels do, or `""` if it isn't compressed.
+  ## This lets external tools that only read plain text take the same files as the kernels.
+  decompressor(infile, threads)
+
+proc record_ids*(infile: string): seq[string] {.releasesGil, exportpy.} =
+  ## The ID of each record in `infile`, in order. Unlike `sequence_ids`, the sequences are only skipped over.
+  var id = "" # reused so that we don't allocate for every record
+  for view in readFastaViews(infile):
+    view.description.firstWord(id)
+    result.add(id)
+
+proc sequence_ids*(infile: string): (seq[string], seq[string], int) {.releasesGil, exportpy.} =
+  ## The ID and `NV_` ID (the digest of the uppercase sequence) of each record in `infile`, *e.g.* to look sequences
+  ## up by their content.
+  ##
+  ## Returns the IDs, the `NV_` IDs, and the number of bases in `infile`.
+  var ids: seq[string]
+  var digests: seq[string]
+  var totalBases = 0
+  var id = "" # reused so that we don't allocate for every record
+  var upper = ""
+  for view in readFastaViews(infile):
+    view.description.firstWord(id)
+    view.sequence.toUpperAscii(upper)
+    ids.add(id)
+    digests.add(vdsearchId(upper))
+    totalBases.inc(view.len)
+  return (ids, digests, totalBases)
+
+type
+  FilePool = object
+    ## Keeps at most `capacity` of a set of files open, closing the least recently used one to make room for another.
+    ## A file is truncated the first time it's opened and appended to after that.
+    capacity: int
+    paths: seq[string]
+    files: seq[File] # nil while closed
+    created: seq[bool]
+    recent: DoublyLinkedList[int] # the open files, most recently used first
+    nodes: seq[DoublyLinkedNode[int]]
+    openCount: int
+
+proc initFilePool(paths: seq[string], capacity: Positive): FilePool =
+  FilePool(capacity: capacity, paths: paths, files: newSeq[File](paths.len), created: newSeq[bool](paths.len),
+           nodes: newSeq[DoublyLinkedNode[int]](paths.len))
+
+proc get(p: var FilePool, i: int): File =
+  ## The `i`th file, opening it if needed.
+  if not p.files[i].isNil:
+    if p.recent.head != p.nodes[i]:
+      p.recent.remove(p.nodes[i])
+      p.recent.prepend(p.nodes[i])
+    return p.files[i]
+
+  if p.openCount >= p.capacity:
+    let oldest = p.recent.tail
+    p.files[oldest.value].close()
+    p.files[oldest.value] = nil
+    p.recent.remove(oldest)
+    dec p.openCount
+
+  if not open(p.files[i], p.paths[i], if p.created[i]: fmAppend else: fmWrite):
+    raise newException(IOError, &"Unable to write {p.paths[i]}")
+  p.created[i] = true
+  p.nodes[i] = newDoublyLinkedNode(i)
+  p.recent.prepend(p.nodes[i])
+  inc p.openCount
+  return p.files[i]
+
+proc close(p: var FilePool) =
+  ## Close every file, creating the ones that were never written to so that every path exists.
+  for i in 0..p.files.high:
+    if not p.files[i].isNil:
+      p.files[i].close()
+      p.files[i] = nil
+  # empty the pool first, or `get` would try to make room by closing a file that's already closed
+  p.openCount = 0
+  p.recent = initDoublyLinkedList[int]()
+  for i in 0..p.files.high:
+    if not p.created[i]:
+      discard p.get(i)
+      p.files[i].close()
+      p.files[i] = nil
+  p.openCount = 0
+  p.recent = initDoublyLinkedList[int]()
+
+proc readClusters(clusterTsv: string): tuple[clusters: seq[string], membership: Table[string, int]] =
+  ## Read a cluster TSV from MMseqs2, with the representative of a cluster and one of its members on each line.
+  ## Returns the clusters in the order they're first seen and which one each member is in.
+  var clusterIndices = initTable[string, int]()
+  for line in lines(clusterTsv):
+    if line.len == 0:
+      continue
+    let fields = line.split('\t', maxsplit = 1)
+    if fields.len != 2:
+      raise newException(ValueError, &"{clusterTsv} is not a cluster TSV: {line}")
+    let cluster = clusterIndices.mgetOrPut(fields[0], result.clusters.len)
+    if cluster == result.clusters.len:
+      result.clusters.add(fields[0])
+    result.membership[fields[1]] = cluster
+
+proc write_clusters*(infile: string, clusterTsv: string, outdir: string, maxOpenFiles: Positive = 512,
+                     singleFile: bool = false): int {.releasesGil, exportpy.} =
+  ## Write the sequences of each cluster in `clusterTsv` to their own FASTA file in `outdir`.
+  ##
+  ## At most `maxOpenFiles` files are kept open at once, so there can be more clusters than the operating system lets
+  ## us have open files.
+  ##
+  ## If `singleFile` is true, all of the clusters are written to `outdir/clusters.fasta` instead, one after another.
+  ## Each cluster is listed with the byte offset and size of its records in `outdir/clusters.tsv` and the file has a
+  ## `.fai` index too, so both whole clusters and single sequences can be read by seeking. This needs an uncompressed
+  ## `infile`, which is read through its own index.
+  ##
+  ## Records that aren't in any cluster are left out. Returns the number of clusters.
+  ##
+  ## Note: `outdir` must exist and be writable or the function will fail.
+  let (clusters, membership) = readClusters(clusterTsv)
+  var id = "" # reused so that we don't allocate for every record
+
+  if not singleFile:
+    var pool = initFilePool(clusters.mapIt(outdir / it & ".fasta"), maxOpenFiles)
+    defer: pool.close()
+    for view in readFastaViews(infile):
+      view.description.firstWord(id)
+      let cluster = membership.getOrDefault(id, -1)
+      if cluster != -1:
+        pool.get(cluster).writeFasta(view)
+    return clusters.len
+
+  if not infile.canIndex:
+    raise newException(ValueError, &"{infile} must be uncompressed to write the clusters to a single file")
+
+  # group the records of each cluster using the index, then seek to them cluster by cluster
+  var region = memfiles.open(infile)
+  defer: region.close()
+  var members = newSeq[seq[FaiEntry]](clusters.len)
+  for entry in loadIndex(infile, region):
+    let cluster = membership.getOrDefault(entry.name, -1)
+    if cluster != -1:
+      members[cluster].add(entry)
+
+  let outfile = outdir / "clusters.fasta"
+  var fai = initFaiWriter(outfile) # closed last so that it's newer than the output
+  defer: fai.close()
+  var output: File
+  if not open(output, outfile, fmWrite):
+    raise newException(IOError, &"Unable to write {outfile}")
+  defer: output.close()
+  var writer = initBufferedWriter(output)
+  defer: writer.flush()
+  let clusterIndexPath = outdir / "clusters.tsv"
+  var clusterIndex: File
+  if not open(clusterIndex, clusterIndexPath, fmWrite):
+    raise newException(IOError, &"Unable to write {clusterIndexPath}")
+  defer: clusterIndex.close()
+  var clusterIndexWriter = initBufferedWriter(clusterIndex)
+  defer: clusterIndexWriter.flush()
+  clusterIndexWriter.writeRow("cluster_id", "offset", "size", "count")
+
+  var joined = ""
+  for cluster, entries in members:
+    let start = writer.position
+    for entry in entries:
+      let description = region.fetchHeader(entry)
+      let sequence = region.fetchSequence(entry, joined)
+      fai.add(writer, description, sequence.len)
+      writer.writeFasta(description, sequence)
+    clusterIndexWriter.writeRow(clusters[cluster], start, writer.position - start, entries.len)
+  return clusters.len
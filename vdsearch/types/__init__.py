@@ -28,3 +28,15 @@ ViroidDB: Path = typer.Option(
     file_okay=True,
     dir_okay=False,
 )
+
+Catalog: Path = typer.Option(
+    None,
+    help="Directory of a catalog of the sequences seen in previous runs. New sequences are added to it and it is created if it doesn't exist.",
+    file_okay=False,
+    dir_okay=True,
+)
+
+NovelOnly: bool = typer.Option(
+    False,
+    help="Only output sequences that aren't in the --catalog yet.",
+)
@@ -1,7 +1,9 @@
 import functools
+import gzip
 import logging
 import shutil
-from typing import Callable, Optional
+from pathlib import Path
+from typing import IO, Callable, Optional
 
 from typer.models import ParameterInfo
 import rich_click as click
@@ -22,6 +24,33 @@ def check_executable_exists(
         )
 
 
+def open_compressed(path: Path, mode: str = "rt") -> IO:
+    """
+    Open a file, transparently (de)compressing it if it ends with .gz.
+    """
+    if Path(path).suffix.lower() == ".gz":
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def parse_size(size: str) -> int:
+    """
+    Turn a human-readable size like `4G`, `512M`, or `1000` (bytes) into a number of bytes.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise click.BadParameter(
+            f"Invalid size '{size}'. Use a number of bytes or a number followed by K, M, G, or T."
+        )
+
+
 def typer_unpacker(f: Callable):
     """
     Make a Typer function into a normal function.